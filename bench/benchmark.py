@@ -0,0 +1,250 @@
+#!/usr/bin/python3
+"""Benchmarks of the file-based database and the CLI paths.
+
+Generates a synthetic ~/.invoice style tree (or reuses one given by
+--data), times the common operations and prints the results as JSON so
+that runs can be compared over time. A tree given by --data is left as
+it was, invoices created by the benchmark give their numbers back and
+the cache is only removed from generated trees.
+"""
+
+import os, sys, io, re, gc, json, time, random, shutil, argparse, tempfile, platform, datetime, contextlib, statistics, tracemalloc
+
+base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(base_dir, "lib"))
+
+import logging
+logging.basicConfig(level=logging.ERROR)
+
+import invoice.db
+import invoice.db.query
+import invoice.db.invoices
+import invoice.pdf
+import invoice.cli
+
+words = "consulting development support hosting training review design testing maintenance audit".split()
+
+def generate(root, companies, invoices, years, seed=0):
+    """Create a data tree with 'companies' customers and 'invoices' per year."""
+    rng = random.Random(seed)
+    names = ["customer-{0:04}".format(n) for n in range(companies)]
+    first_year = 2000
+    with open(os.path.join(root, "config"), "w") as stream:
+        stream.write("")
+    os.makedirs(os.path.join(root, "tmp"), exist_ok=True)
+    for year in range(first_year, first_year + years):
+        companies_path = os.path.join(root, str(year), "data", "companies")
+        income_path = os.path.join(root, str(year), "data", "income")
+        for path in companies_path, income_path, os.path.join(root, str(year), "output"):
+            os.makedirs(path, exist_ok=True)
+        for name in ["my-company"] + names:
+            with open(os.path.join(companies_path, name), "w") as stream:
+                stream.write("Name: {0} s.r.o.\n".format(name.title()))
+                for line in range(rng.randint(1, 3)):
+                    stream.write("Address: Street {0}\n".format(rng.randint(1, 200)))
+                stream.write("Number: {0:08}\n".format(rng.randint(0, 10**8)))
+                if rng.random() < 0.3:
+                    stream.write("Comment: Registered in {0}\n".format(year))
+        for number in range(1, invoices + 1):
+            month = 1 + (number - 1) * 12 // invoices
+            date = "{0}{1:02}{2:02}".format(year, month, rng.randint(1, 28))
+            with open(os.path.join(income_path, "{0}-{1:03}-{2}".format(
+                    date, number, rng.choice(names))), "w") as stream:
+                for item in range(rng.randint(1, 10)):
+                    stream.write("Item: {0}: {1}\n".format(rng.randint(1, 500) * 100, rng.choice(words)))
+                due = rng.choice(["", "+14", "+30", "{0}-{1:02}-28", "{0}{1:02}28"])
+                if due:
+                    stream.write("Due: {0}\n".format(due.format(year, month)))
+                paid = rng.choice(["", "{0}-{1:02}-27", "{0}{1:02}27"])
+                if paid:
+                    stream.write("Paid: {0}\n".format(paid.format(year, month)))
+                if rng.random() < 0.2:
+                    stream.write("# Internal comment\n")
+                    stream.write("Note: Thank you for your business.\n")
+    return first_year + years - 1
+
+class LegacyInvoiceData(invoice.db.invoices.InvoiceData):
+    """The regex based parser used before the single pass one, for comparison."""
+    _line_regex = re.compile(r"^([A-Z][a-zA-Z-]*):\s+(.*?)\s+$")
+    _comment_regex = re.compile(r"^\s*#")
+    _date_regex = re.compile(r"^(\d{4})-?(\d{2})-?(\d{2})$")
+    _item_regex = re.compile(r"^(-?\d+)[:;]\s*(.*)$")
+
+    def _parse(self, stream):
+        self._data = self._item._selector.copy()
+        for f in self._fields:
+            self._data[f] = None
+        for f in self._multivalue_fields:
+            self._data[f] = []
+        for n, line in enumerate(stream):
+            if self._comment_regex.match(line):
+                continue
+            match = self._line_regex.match(line)
+            if not match:
+                logging.warning("Ignoring {0}:{1}: {2}".format(n, self._item._name, line))
+                continue
+            key, value = match.groups()
+            key = key.lower().replace("-", "_")
+            if key in self._fields:
+                self._data[key] = value
+            elif key in self._multivalue_fields:
+                self._data[key].append(value)
+            else:
+                logging.warning("Key ignored: {0}".format(key))
+
+    def _parse_date(self, date):
+        match = self._date_regex.match(date)
+        if not match:
+            raise ValueError("Bad date format: {0}".format(date))
+        logging.debug("Date match: {0}".format(match.groups()))
+        return datetime.date(*(int(f) for f in match.groups()))
+
+    def _postprocess_items(self):
+        items = []
+        for item in self.item:
+            match = self._item_regex.match(item)
+            if not match:
+                raise ValueError("Bad item format: {0}".format(item))
+            price, description = match.groups()
+            items.append((description, int(price)))
+        del self._data["item"]
+        self._data["items"] = items
+        self._data["sum"] = sum(item[1] for item in items)
+
+def measure(function, repeat):
+    times = []
+    for run in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return {"runs": repeat, "min": min(times), "median": statistics.median(times), "max": max(times)}
+
+def application(root, year, *argv):
+    result = invoice.cli.Application(
+        template_path=os.path.join(base_dir, "templates"),
+        argv=["--user-data", root, "--year", str(year)] + list(argv))
+    logging.getLogger().setLevel(logging.ERROR)
+    return result
+
+def run_cli(root, year, *argv):
+    with contextlib.redirect_stdout(io.StringIO()):
+        application(root, year, *argv).run()
+
+def benchmarks(root, year, generated=True):
+    data_path = os.path.join(root, "{year}", "data", "{directory}")
+    cache_path = os.path.join(root, "{year}", "cache", "{directory}")
+
+    def database(cache=False):
+        return invoice.db.Database(year=year, data_path=data_path,
+            cache_path=cache_path if cache else None)
+
+    warm = database()
+    items = sorted(warm.invoices)
+    middle = items[len(items) // 2]
+    company = middle.company_name
+
+    def new_invoice():
+        item = warm.invoices.new(company)
+        os.unlink(item._path)
+        warm.invoices._invalidate()
+        # Give the number back without leaving a backup file.
+        warm.invoices._storage.release(item.number, warm.invoices._last_number)
+
+    cases = {
+        "scan": lambda: list(database().invoices),
+        "select-number": lambda: warm.invoices[middle.number],
+        "select-name": lambda: warm.invoices[middle._name],
+        "select-company": lambda: warm.invoices.select({"company_name": company}),
+        "parse-all": lambda: [item.data() for item in database().invoices],
+        "parse-legacy": lambda: [LegacyInvoiceData(item) for item in items],
+        "parse-fast": lambda: [invoice.db.invoices.InvoiceData(item) for item in items],
+        "parse-bulk": lambda: warm.invoices.data_many(items),
+        "new": new_invoice,
+        "delete-company-check": lambda: bool(database().invoices.select({"company_name": company})),
+        "query-unpaid-q3": lambda: list(invoice.db.query.Query(
+            date_from="{0}0701".format(year), date_to="{0}0930".format(year), unpaid=True).items(database().invoices)),
+        "cli-list": lambda: run_cli(root, year, "list"),
+        "cli-summary": lambda: run_cli(root, year, "summary"),
+    }
+
+    cases["render-pdf"] = lambda: invoice.pdf.render_invoice(middle.data(),
+        warm.companies["my-company"].data(), warm.companies[company].data())
+
+    def summary_without_cache():
+        shutil.rmtree(os.path.join(root, str(year), "cache"), ignore_errors=True)
+        run_cli(root, year, "summary")
+    if generated:
+        cases["cli-summary-cold"] = summary_without_cache
+    else:
+        logging.warning("Using existing data, skipping the cold cache benchmark.")
+
+    try:
+        import tempita
+    except ImportError:
+        logging.warning("Tempita not available, skipping template benchmarks.")
+    else:
+        renderer = application(root, year, "list")
+        cases["render-tex"] = lambda: renderer._render_tex(middle)
+    return cases
+
+def memory(root):
+    """Return memory in bytes per invoice held by items and data of all years."""
+    data_path = os.path.join(root, "{year}", "data", "{directory}")
+    databases = [invoice.db.Database(year=year, data_path=data_path)
+        for year in invoice.db.History.find_years(data_path)]
+    gc.collect()
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    items = [item for db in databases for item in db.invoices]
+    scanned = tracemalloc.get_traced_memory()[0]
+    data = [item.data() for item in items]
+    parsed = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return {"invoices": len(items), "items": (scanned - start) / len(items),
+        "data": (parsed - scanned) / len(items)}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--companies", type=int, default=50)
+    parser.add_argument("--invoices", type=int, default=1000, help="invoices per year")
+    parser.add_argument("--years", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--data", help="existing data directory to use instead of generating one")
+    parser.add_argument("--only", action="append", help="run only the named benchmark")
+    parser.add_argument("--output", "-o", help="write JSON results to a file")
+    parser.add_argument("--memory", action="store_true", help="measure memory per loaded invoice")
+    args = parser.parse_args()
+
+    root = args.data or tempfile.mkdtemp(prefix="invoice-bench-")
+    try:
+        if args.data:
+            year = max(invoice.db.History.find_years(os.path.join(root, "{year}")))
+        else:
+            year = generate(root, args.companies, args.invoices, args.years)
+        results = {}
+        for name, function in sorted(benchmarks(root, year, not args.data).items()):
+            if args.only and name not in args.only:
+                continue
+            results[name] = measure(function, args.repeat)
+        if args.memory:
+            results["memory"] = memory(root)
+    finally:
+        if not args.data:
+            shutil.rmtree(root)
+
+    report = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "parameters": {"companies": args.companies, "invoices": args.invoices,
+            "years": args.years, "repeat": args.repeat, "data": args.data},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as stream:
+            json.dump(report, stream, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+if __name__ == "__main__":
+    main()
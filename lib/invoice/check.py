@@ -0,0 +1,146 @@
+#!/usr/bin/python3
+"""Validation of invoice and company data.
+
+Every data file is parsed, in a pool of processes when there are many
+of them, and all problems are collected instead of stopping at the
+first one. Facts gathered from the parsed invoices are then checked
+across files: gaps and duplicates in invoice numbers, invoices of
+unknown companies and payments dated before the invoice.
+"""
+
+import os, collections, concurrent.futures
+
+import logging
+log = logging.getLogger()
+
+import invoice.db
+from invoice.db.invoices import parse_date
+
+Problem = collections.namedtuple("Problem", ("year", "name", "message", "warning"))
+Facts = collections.namedtuple("Facts", ("date", "paid", "company_name"))
+
+chunk_size = 200
+_databases = {}
+
+class _Collector(logging.Handler):
+    """Handler keeping messages of warnings logged while parsing."""
+    def __init__(self):
+        logging.Handler.__init__(self, logging.WARNING)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+def _database(config, year):
+    """Return database of a year reused by the process, without data cache."""
+    if year not in _databases:
+        config = dict(config, archive_path=config.get("archive_path") and config["archive_path"].format(year=year))
+        _databases[year] = invoice.db.Database(year=year, cache_path=None, **config)
+    return _databases[year]
+
+def check_files(config, year, directory, names):
+    """Parse data files of a year and return problems and facts by name."""
+    db = _database(config, year)
+    list_ = db.invoices if directory == db.invoices._directory else db.companies
+    item_class = list_._item_class()
+    problems = []
+    facts = {}
+    collector = _Collector()
+    log.addHandler(collector)
+    try:
+        for name in names:
+            item = item_class(list_, name, year=year, **list_._regex.match(name).groupdict())
+            del collector.messages[:]
+            try:
+                data = item._data_class()(item)
+            except (ValueError, LookupError, OSError) as error:
+                problems.append(Problem(year, name, str(error), False))
+                continue
+            finally:
+                problems.extend(Problem(year, name, message, True) for message in collector.messages)
+            if list_ is db.invoices:
+                facts[name] = Facts(data.date, data.paid, item.company_name)
+    finally:
+        log.removeHandler(collector)
+    return problems, facts
+
+def _check_numbers(year, numbers):
+    problems = []
+    names = collections.defaultdict(list)
+    for name, number in numbers.items():
+        names[number].append(name)
+    for number, duplicates in sorted(names.items()):
+        if len(duplicates) > 1:
+            for name in sorted(duplicates):
+                problems.append(Problem(year, name, "Duplicate invoice number {0}.".format(number), False))
+    missing = sorted(set(range(1, max(names, default=0) + 1)) - set(names))
+    ranges = []
+    for number in missing:
+        if ranges and ranges[-1][1] == number - 1:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+    for first, last in ranges:
+        gap = str(first) if first == last else "{0}-{1}".format(first, last)
+        problems.append(Problem(year, None, "Missing invoice numbers: {0}.".format(gap), False))
+    return problems
+
+def _check_invoices(year, facts, companies):
+    problems = []
+    for name, fact in sorted(facts.items()):
+        if fact.company_name not in companies:
+            problems.append(Problem(year, name, "Company not found: {0}".format(fact.company_name), False))
+        if fact.paid:
+            try:
+                paid = parse_date(fact.paid)
+            except ValueError as error:
+                problems.append(Problem(year, name, str(error), False))
+                continue
+            if paid < fact.date:
+                problems.append(Problem(year, name, "Paid on {0} before the issue date {1}.".format(
+                    paid, fact.date), False))
+    return problems
+
+def check(databases, config, jobs=None):
+    """Check all invoices and companies of the databases.
+
+    The 'config' dictionary holds the Database arguments used to open
+    the same databases in worker processes. Returns problems sorted by
+    year and name, and the number of files checked.
+    """
+    tasks = []
+    numbers = {}
+    companies = {}
+    for db in databases:
+        year = int(db.invoices._year)
+        try:
+            lists = [(list_, sorted(item._name for item in list_)) for list_ in (db.invoices, db.companies)]
+        except FileNotFoundError as error:
+            log.warning("No data for year %s: %s", year, error)
+            continue
+        numbers[year] = dict((item._name, item.number) for item in db.invoices)
+        companies[year] = set(item.name for item in db.companies)
+        for list_, names in lists:
+            tasks.extend((year, list_._directory, names[offset:offset+chunk_size])
+                for offset in range(0, len(names), chunk_size))
+
+    problems = []
+    facts = collections.defaultdict(dict)
+    files = sum(len(names) for year, directory, names in tasks)
+    jobs = min(jobs or os.cpu_count() or 1, len(tasks))
+    if jobs > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = dict((executor.submit(check_files, config, *task), task) for task in tasks)
+            results = [(futures[future][0], future.result())
+                for future in concurrent.futures.as_completed(futures)]
+    else:
+        results = [(task[0], check_files(config, *task)) for task in tasks]
+    for year, (file_problems, file_facts) in results:
+        problems.extend(file_problems)
+        facts[year].update(file_facts)
+
+    for year in sorted(companies):
+        problems.extend(_check_numbers(year, numbers[year]))
+        problems.extend(_check_invoices(year, facts[year], companies[year]))
+    problems.sort(key=lambda problem: (problem.year, problem.name or "", problem.warning))
+    return problems, files
@@ -2,50 +2,163 @@
 # encoding: utf-8
 from __future__ import print_function
 
-import os, sys, argparse, datetime, subprocess
+import os, re, sys, io, collections, argparse, datetime, subprocess, tempfile, shutil, time, contextlib, traceback
 import logging
 logging.basicConfig(level=logging.DEBUG)
 log = logging.getLogger()
 
 import invoice.db
+import invoice.db.storage
+import invoice.db.query
+import invoice.db.index
+import invoice.daemon
+import invoice.depends
+import invoice.template
+import invoice.export
+import invoice.watch
+import invoice.report
+import invoice.profile
+import invoice.reconcile
+import invoice.fakturoid
 
 class SanityCheckError(Exception):
     pass
 
+class GenerationError(Exception):
+    pass
+
 class Application:
     my_company = "my-company"
 
     editor = os.environ.get("EDITOR") or "vim"
     viewer = os.environ.get("PAGER") or "less"
     tex_program = "pdflatex"
+    renderer = "tex"
     pdf_program = "xdg-open"
+    data_cache = True
+    template = "invoice"
+    template_cache = True
+    storage = "files"
+    sqlite_path = None
+    fakturoid_url = invoice.fakturoid.default_url
+    fakturoid_slug = None
+    fakturoid_user = None
+    fakturoid_key = None
 
-    def __init__(self, template_path):
-        self._parse_args()
+    def __init__(self, template_path, argv=None):
+        self._parser = None
+        self._databases = {}
+        self._commands = None
+        self._parse_args(argv)
+        self._config = {}
         exec(open(os.path.expanduser(os.path.join(self.args.user_data, "config"))).read(),
-            {"__builtins__": None}, self.__dict__)
-        self.year = self.args.__dict__.pop("year")
+            {"__builtins__": None}, self._config)
+        self.__dict__.update(self._config)
         self.user_path = os.path.expanduser(self.args.__dict__.pop("user_data"))
-        self.method = self.args.__dict__.pop("method")
         self.data_path = os.path.join(self.user_path, "{year}", "data", "{directory}")
         self.tmp_path = os.path.join(self.user_path, "tmp")
         self.output_path =  os.path.join(self.user_path, "{year}", "output")
-        self.template_path = template_path
-        self.db = invoice.db.Database(
-            year = self.year,
-            data_path = self.data_path)
+        self.cache_path = os.path.join(self.user_path, "{year}", "cache", "{directory}")
+        self.archive_path = os.path.join(self.user_path, "{year}", "archive")
+        self.sqlite_path = self.sqlite_path or os.path.join(self.user_path, "invoice.sqlite")
+        self.template_path = template_path = os.path.abspath(template_path)
+        self.templates = invoice.template.TemplateLoader(template_path,
+            os.path.join(self.user_path, "cache", "templates") if self.template_cache else None)
+        self.company_index = invoice.db.index.CompanyIndex(
+            os.path.join(self.user_path, "cache", "company-index.{0}".format(self.storage)))
+        self._use_args()
+
+    def _use_args(self):
+        # The default is computed here for a long running daemon.
+        self.year = self.args.__dict__.pop("year") or datetime.date.today().year
+        self.method = self.args.__dict__.pop("method")
+        self.profile = self.args.__dict__.pop("profile")
+        self.profile_json = self.args.__dict__.pop("profile_json")
+        self.cprofile = self.args.__dict__.pop("cprofile")
+        self.db = self._database(self.year)
+        self.history = None
+        self.years = years = self.args.__dict__.pop("years")
+        if years:
+            self.history = invoice.db.History(
+                [self._database(year) for year in self._parse_years(years)])
+
+    _years_regex = re.compile(r"^([0-9]{4})?(-)?([0-9]{4})?$")
+
+    def _parse_years(self, years, storage=None):
+        """Parse a comma separated list of years and ranges like 2015-2017 or 2015-.
+
+        Open ranges and 'all' are completed from the years found in the
+        configured or the given storage.
+        """
+        found = self._find_years(storage)
+        if years == "all":
+            return found
+        result = set()
+        for part in years.split(","):
+            match = self._years_regex.match(part.strip())
+            if not match or not (match.group(1) or match.group(3)):
+                self._parser.error("argument --years/-Y: bad year or range: '{0}'".format(part))
+            first, dash, last = match.groups()
+            if not dash:
+                result.add(int(first))
+                continue
+            first = int(first) if first else min(found, default=int(last))
+            last = int(last) if last else max(found, default=first)
+            if first > last:
+                self._parser.error("argument --years/-Y: empty range: '{0}'".format(part))
+            result.update(range(first, last + 1))
+        return sorted(result)
+
+    def _find_years(self, storage=None):
+        """Return years available in the configured storage, including frozen ones."""
+        if (storage or self.storage) == "sqlite":
+            years = invoice.db.storage.SQLiteStorage.years(invoice.db.storage.connect(self.sqlite_path))
+            if storage is None:
+                years = sorted(set(years) | set(year for year in invoice.db.History.find_years(self.data_path)
+                    if os.path.exists(self.archive_path.format(year=year))))
+            return years
+        return invoice.db.History.find_years(self.data_path)
 
-    def _parse_args(self):
+    def _database(self, year, storage=None):
+        """Return database for a year, databases of the configured storage are reused."""
+        year = int(year)
+        if storage is None and year in self._databases:
+            return self._databases[year]
+        db = invoice.db.Database(
+            year = year,
+            data_path = self.data_path,
+            cache_path = self.cache_path if self.data_cache else None,
+            storage = storage or self.storage,
+            sqlite_path = self.sqlite_path,
+            index = self.company_index if storage is None else None,
+            archive_path = self.archive_path.format(year=year) if storage is None else None)
+        if storage is None:
+            self._databases[year] = db
+        return db
+
+    def _parse_args(self, argv=None):
+        if self._parser is None:
+            self._parser = self._create_parser()
+        self.args = self._parser.parse_args(argv)
+        log.setLevel(self.args.__dict__.pop("log_level"))
+        log.debug("Arguments: %s", self.args)
+
+    def _create_parser(self):
         parser = argparse.ArgumentParser(
             description = "Pavel Šimerda's invoice CLI application.",
             conflict_handler = "resolve")
         parser.add_argument("--year", "-y", action="store")
         parser.add_argument("--user-data", "-d", action="store")
+        parser.add_argument("--years", "-Y", action="store",
+            help="work with multiple years in list and summary, e.g. 2015-2017, 2015- or all")
         parser.add_argument("--debug", "-D", action="store_const", dest="log_level", const=logging.DEBUG)
+        parser.add_argument("--profile", action="store_true",
+            help="print counts and times of file scans, parsing, caches, templates and subprocesses")
+        parser.add_argument("--profile-json", metavar="FILE", help="write the profile to a JSON file")
+        parser.add_argument("--cprofile", metavar="FILE", help="write cProfile statistics to a file")
         #parser.add_argument("--verbose", "-v", action="store_const", dest="log_level", const=logging.INFO)
         #parser.add_argument("--config", "-C", action="store")
         parser.set_defaults(
-            year = datetime.date.today().year,
             user_data = "~/.invoice",
             log_level = logging.INFO)
 
@@ -64,42 +177,247 @@ class Application:
                 subparser = subparsers.add_parser(action+suffix, help=method.__doc__)
                 if method == self.do_pdf:
                     subparser.add_argument("--generate", "-g", action="store_true")
-                if action == "delete":
+                    subparser.add_argument("--all", "-a", action="store_true")
+                    subparser.add_argument("--jobs", "-j", type=int, default=os.cpu_count())
+                    subparser.add_argument("--combine", "-c", action="store_true",
+                        help="compile many invoices in a single TeX run and split the result")
+                    subparser.add_argument("--combined", metavar="FILE",
+                        help="also write all selected invoices into a single PDF file")
+                if method in (self.do_list, self.do_summary, self.do_pdf):
+                    self._add_query_arguments(subparser)
+                if action in ("delete", "pdf"):
                     subparser.add_argument("--force", "-f", action="store_true")
                 if action == "new":
                     subparser.add_argument("name" if suffix else "company_name")
-                if action in ("show", "pdf", "edit", "paid", "delete"):
+                if action == "pdf":
+                    subparser.add_argument("selector", nargs="*")
+                elif action in ("show", "edit", "paid", "delete"):
                     subparser.add_argument("selector", nargs="?")
                 if action == "paid":
                     subparser.add_argument("date")
                 subparser.set_defaults(method=method)
 
-        self.args = parser.parse_args()
-        log.setLevel(self.args.__dict__.pop("log_level"))
-        log.debug("Arguments: {0}".format(self.args))
+        subparser = subparsers.add_parser("export", help=self.do_export.__doc__)
+        subparser.add_argument("--format", "-F", choices=sorted(invoice.export.formats), default="jsonl")
+        subparser.add_argument("--output", "-o")
+        self._add_query_arguments(subparser)
+        subparser.set_defaults(method=self.do_export)
+
+        subparser = subparsers.add_parser("report", help=self.do_report.__doc__)
+        subparser.add_argument("--by", "-b", choices=sorted(invoice.report.reports), default="month")
+        self._add_query_arguments(subparser)
+        subparser.set_defaults(method=self.do_report)
+
+        subparser = subparsers.add_parser("company-invoices", help=self.do_company_invoices.__doc__)
+        subparser.add_argument("name")
+        subparser.set_defaults(method=self.do_company_invoices)
+
+        subparser = subparsers.add_parser("sync", help=self.do_sync.__doc__)
+        subparser.add_argument("--to", dest="target", choices=("files", "sqlite"), required=True)
+        subparser.set_defaults(method=self.do_sync)
+
+        subparser = subparsers.add_parser("watch", help=self.do_watch.__doc__)
+        subparser.add_argument("--jobs", "-j", type=int, default=os.cpu_count())
+        subparser.add_argument("--poll", action="store_true", help="poll for changes instead of using inotify")
+        subparser.add_argument("--interval", type=float, default=1.0, help="polling interval in seconds")
+        subparser.set_defaults(method=self.do_watch)
+
+        subparser = subparsers.add_parser("reconcile", help=self.do_reconcile.__doc__)
+        subparser.add_argument("statement", help="CSV bank statement, '-' for standard input")
+        subparser.add_argument("--dry-run", "-n", action="store_true", help="only print the report")
+        subparser.add_argument("--encoding", default="utf-8-sig")
+        subparser.add_argument("--delimiter")
+        for field in sorted(invoice.reconcile.columns):
+            subparser.add_argument("--{0}-column".format(field.replace("_", "-")), dest=field,
+                metavar="NAME", help="name of the {0} column".format(field.replace("_", " ")))
+        subparser.set_defaults(method=self.do_reconcile)
+
+        subparser = subparsers.add_parser("import-fakturoid", help=self.do_import_fakturoid.__doc__)
+        subparser.add_argument("--url", help="API URL, e.g. of a local test server")
+        subparser.add_argument("--jobs", "-j", type=int, default=4, help="concurrent requests")
+        subparser.add_argument("--full", action="store_true", help="import all records, not only updated ones")
+        subparser.set_defaults(method=self.do_import_fakturoid)
+
+        subparser = subparsers.add_parser("freeze-year", help=self.do_freeze_year.__doc__)
+        subparser.add_argument("--force", "-f", action="store_true")
+        subparser.set_defaults(method=self.do_freeze_year)
+
+        subparser = subparsers.add_parser("unfreeze", help=self.do_unfreeze.__doc__)
+        subparser.set_defaults(method=self.do_unfreeze)
+
+        subparser = subparsers.add_parser("check", help=self.do_check.__doc__)
+        subparser.add_argument("--jobs", "-j", type=int, default=os.cpu_count())
+        subparser.set_defaults(method=self.do_check)
+
+        subparser = subparsers.add_parser("daemon", help=self.do_daemon.__doc__)
+        subparser.set_defaults(method=self.do_daemon)
+
+        return parser
+
+    @staticmethod
+    def _add_query_arguments(subparser):
+        group = subparser.add_argument_group("invoice filters")
+        group.add_argument("--from", dest="date_from", help="issued on or after a date")
+        group.add_argument("--to", dest="date_to", help="issued on or before a date")
+        group.add_argument("--company", help="issued to a company")
+        group.add_argument("--unpaid", action="store_true", help="without payment date")
+        group.add_argument("--overdue", action="store_true", help="unpaid after due date")
+        group.add_argument("--min-sum", type=int, help="with total of at least this amount")
 
     def run(self):
+        """Run the selected command and return exit status."""
+        with self._profiling():
+            return self._run()
+
+    @contextlib.contextmanager
+    def _profiling(self):
+        """Collect counters and timers while running a command if requested."""
+        if not (self.profile or self.profile_json or self.cprofile):
+            yield
+            return
+        invoice.profile.start()
+        profiler = None
+        if self.cprofile:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+        try:
+            with invoice.profile.timer("command"):
+                yield
+        finally:
+            if profiler:
+                profiler.disable()
+                profiler.dump_stats(self.cprofile)
+            invoice.profile.stop()
+            if self.profile_json:
+                invoice.profile.dump(self.profile_json)
+            if self.profile:
+                invoice.profile.report()
+
+    def _run(self):
         try:
             self.method(**vars(self.args))
         except (SanityCheckError) as error:
             print("Error: {0} Use '--force' to suppress this check.".format(error), file=sys.stderr)
             if log.isEnabledFor(logging.DEBUG):
                 raise
-        except invoice.db.DatabaseError as error:
+            return 1
+        except (invoice.db.DatabaseError, GenerationError, invoice.fakturoid.FakturoidError) as error:
             print("Error: {0}".format(error), file=sys.stderr)
             if log.isEnabledFor(logging.DEBUG):
                 raise
+            return 1
+        finally:
+            self.db.flush()
+            if self.history:
+                self.history.flush()
+            self.company_index.save()
+        return 0
+
+    def _call(self, command):
+        """Run an external interactive program.
+
+        When serving a daemon request, the program is run by the client.
+        """
+        invoice.profile.count("subprocess.call")
+        if self._commands is not None:
+            self._commands.append(command)
+        else:
+            subprocess.call(command)
+
+    def do_daemon(self):
+        """Serve commands over a Unix socket keeping the database loaded.
+
+        The 'invoice' script forwards commands to a running daemon
+        unless '--user-data' is given. Restart the daemon after changing
+        the configuration.
+        """
+        invoice.daemon.Server(invoice.daemon.socket_path(self.user_path), self._serve).serve()
+
+    def _serve(self, request):
+        """Run a command for a daemon client.
 
-    def do_list(self):
+        The command runs in the client's working directory and its output,
+        including log messages, is captured for the client.
+        """
+        stdout, stderr = io.StringIO(), io.StringIO()
+        for attr, variable in ("editor", "EDITOR"), ("viewer", "PAGER"):
+            if attr not in self._config:
+                setattr(self, attr, request["environ"].get(variable) or getattr(type(self), attr))
+        cwd = os.getcwd()
+        try:
+            os.chdir(request.get("cwd") or cwd)
+        except OSError as error:
+            log.warning("Cannot use client directory, running locally: %s", error)
+            return {"status": None}
+        self._commands = []
+        handlers = log.handlers[:]
+        handler = logging.StreamHandler(stderr)
+        handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+        log.handlers[:] = [handler]
+        try:
+            with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+                try:
+                    self._parse_args(request["argv"])
+                    self.args.__dict__.pop("user_data")
+                    self._use_args()
+                except SystemExit as error:
+                    return {"status": error.code, "stdout": stdout.getvalue(),
+                        "stderr": stderr.getvalue(), "commands": []}
+                if self.method in (self.do_daemon, self.do_reconcile):
+                    # The statement is read by the client.
+                    return {"status": None}
+                if self.method == self.do_watch:
+                    # Watching never ends, it would block the daemon.
+                    return {"status": None}
+                if self.method == self.do_export and not self.args.output:
+                    # Standard output is streamed by the client, files by the daemon.
+                    return {"status": None}
+                if self.storage != "files" and self.method in (self.do_new, self.do_edit,
+                        self.do_new_company, self.do_edit_company):
+                    # Editing without files needs to read the result back.
+                    return {"status": None}
+                for db in self._databases.values():
+                    # Data files may have been edited since the last request.
+                    db.expire()
+                try:
+                    status = self.run()
+                except Exception:
+                    traceback.print_exc()
+                    status = 1
+            return {"status": status, "stdout": stdout.getvalue(),
+                "stderr": stderr.getvalue(), "commands": self._commands}
+        finally:
+            log.handlers[:] = handlers
+            self._commands = None
+            os.chdir(cwd)
+
+    def _invoices(self):
+        """Return invoice list of the selected year or years."""
+        return self.history.invoices if self.history else self.db.invoices
+
+    def _data(self, items):
+        """Return data objects for a list of items."""
+        if self.history:
+            return self.history.data(items)
+        return self.db.invoices.data_many(items)
+
+    def _query_data(self, query):
+        """Return (item, data) pairs of invoices matching a query."""
+        if query.needs_data:
+            return query.data(self._invoices())
+        invoices = query.candidates(self._invoices())
+        return zip(invoices, self._data(invoices))
+
+    def do_list(self, **query):
         """List invoices."""
-        for item in sorted(self.db.invoices):
+        for item in invoice.db.query.Query(**query).items(self._invoices()):
             print(item)
 
-    def do_summary(self):
+    def do_summary(self, **query):
         """Show invoice summary."""
         total = paid = 0
-        for invoice in sorted(self.db.invoices):
-            data = invoice.data()
+        for item, data in self._query_data(invoice.db.query.Query(**query)):
             log.debug(data._data)
             print("{number:7} {date!s:10} {due!s:10} {paid!s:10} {sum:>6} {company_name}"
                 .format(**data._data))
@@ -112,10 +430,182 @@ class Application:
         print("Paid:  {0:6}".format(paid))
         print("Unpaid: {0:6}".format(total-paid))
 
+    def do_export(self, format, output, **query):
+        """Export invoice data as JSON lines, CSV or YAML.
+
+        Invoices are written as they are parsed. Use '--years' to export
+        multiple years. With a daemon running, '--output' files are written
+        by the daemon and standard output by the invoice script itself.
+        """
+        write = invoice.export.formats[format]
+        query = invoice.db.query.Query(**query)
+        records = invoice.export.records(query.data(self._invoices())
+            if query.needs_data else query.candidates(self._invoices()))
+        if output:
+            with open(output, "w", newline="" if format == "csv" else None) as stream:
+                write(stream, records)
+        else:
+            write(sys.stdout, records)
+
+    def do_report(self, by, **query):
+        """Show revenue by month or company, receivables aging or days to payment."""
+        function, header = invoice.report.reports[by]
+        facts = invoice.report.Facts.load(data for item, data in self._query_data(invoice.db.query.Query(**query)))
+        row_format = "{0:16}" + "".join(" {{{0}:>10}}".format(i) for i in range(1, len(header)))
+        print(row_format.format(*header))
+        for row in function(facts):
+            print(row_format.format(*row))
+
+    def do_sync(self, target):
+        """Copy data between data files and the SQLite database.
+
+        Items are written to and removed from the target storage so that
+        it matches the other one. Use '--years' to synchronize multiple
+        years.
+        """
+        source = "sqlite" if target == "files" else "files"
+        years = self._parse_years(self.years, source) if self.years else [self.year]
+        for year in years:
+            source_db = self._database(year, source)
+            target_db = self._database(year, target)
+            for name in "companies", "invoices":
+                source_list = getattr(source_db, name)
+                target_list = getattr(target_db, name)
+                try:
+                    source_list._storage.version()
+                except FileNotFoundError:
+                    # Not an empty source, the target must not be emptied.
+                    print("{0} {1}: not found in {2}, skipped".format(year, name, source))
+                    continue
+                if target == "sqlite":
+                    target_list._storage.ensure()
+                else:
+                    os.makedirs(target_list._path, exist_ok=True)
+                written, removed = invoice.db.storage.sync(
+                    source_list._storage, target_list._storage, source_list._regex)
+                print("{0} {1}: {2} written, {3} removed".format(year, name, written, removed))
+                target_list._invalidate()
+                target_list._storage.flush()
+
+    def do_import_fakturoid(self, url, jobs, full):
+        """Import companies and invoices from Fakturoid.
+
+        Subjects are written as companies of the year, invoices to the
+        year they were issued in. Only records updated since the last
+        import are fetched unless '--full' is given, an interrupted import
+        continues where it stopped.
+        """
+        if not (self.fakturoid_slug and self.fakturoid_user and self.fakturoid_key):
+            raise invoice.fakturoid.FakturoidError("Set fakturoid_slug, fakturoid_user and fakturoid_key in the config.")
+        start = time.time()
+        client = invoice.fakturoid.Client(url or self.fakturoid_url, self.fakturoid_slug,
+            self.fakturoid_user, self.fakturoid_key, jobs=jobs)
+        importer = invoice.fakturoid.Importer(client, self._import_database, self.year,
+            os.path.join(self.user_path, "cache", "fakturoid.json"))
+        if full:
+            importer.reset()
+        counts = importer.run()
+        print("Imported {0} subjects and {1} invoices, {2} files written, {3} skipped in {4:.2f} s.".format(
+            counts["subjects"], counts["invoices"], counts["written"], counts["skipped"], time.time() - start))
+
+    def _import_database(self, year):
+        """Return database of a year with its lists created in the storage."""
+        db = self._database(year)
+        for list_ in db.companies, db.invoices:
+            if isinstance(list_._storage, invoice.db.storage.SQLiteStorage):
+                list_._storage.ensure()
+            elif isinstance(list_._storage, invoice.db.storage.FileStorage):
+                os.makedirs(list_._path, exist_ok=True)
+        return db
+
+    def do_freeze_year(self, force):
+        """Pack a closed year into a read-only archive.
+
+        Companies and invoices of the year, or of the years given by
+        '--years', are written with their parsed data into a single
+        archive file and removed from the configured storage. Frozen
+        years are read from the archive, use 'unfreeze' to change them.
+        """
+        import invoice.db.archive
+
+        years = self.history.years if self.history else [int(self.year)]
+        for year in years:
+            if year >= datetime.date.today().year and not force:
+                raise SanityCheckError("Year {0} is not closed yet.".format(year))
+        for year in years:
+            archive_path = self.archive_path.format(year=year)
+            if os.path.exists(archive_path):
+                print("{0}: already frozen".format(year))
+                continue
+            db = self._database(year, self.storage)
+            lists = db.companies, db.invoices
+            sections = []
+            for list_ in lists:
+                items = sorted(list_)
+                sections.append((list_._directory, invoice.db.archive.data_format(list_),
+                    [(item._name, list_._storage.read(item._name), data._data)
+                        for item, data in zip(items, self._freeze_data(list_, items))]))
+            invoice.db.archive.write(archive_path, sections)
+
+            archive = invoice.db.archive.Archive(archive_path)
+            for directory, digest, items in sections:
+                positions = [archive.find(directory, name) for name, text, data in items]
+                if any(position is None or archive.text(position) != text
+                        for position, (name, text, data) in zip(positions, items)):
+                    os.remove(archive_path)
+                    raise invoice.db.DatabaseError("Archive verification failed: {0}".format(archive_path))
+            for list_, (directory, digest, items) in zip(lists, sections):
+                list_._storage.drop([name for name, text, data in items])
+            self._databases.pop(year, None)
+            print("{0}: {1} companies and {2} invoices frozen in {3}".format(
+                year, len(sections[0][2]), len(sections[1][2]), archive_path))
+
+    def _freeze_data(self, list_, items):
+        """Return data of items to be frozen, naming the item that cannot be parsed."""
+        try:
+            return list_.data_many(items)
+        except (ValueError, LookupError):
+            for item in items:
+                try:
+                    item.data()
+                except (ValueError, LookupError) as error:
+                    raise invoice.db.DatabaseError("Cannot freeze {0}, {1}/{2}: {3}".format(
+                        list_._year, list_._directory, item._name, error))
+            raise
+
+    def do_unfreeze(self):
+        """Restore a frozen year to the configured storage.
+
+        Use '--years' to restore multiple years.
+        """
+        years = self.history.years if self.history else [int(self.year)]
+        for year in years:
+            archive_path = self.archive_path.format(year=year)
+            if not os.path.exists(archive_path):
+                print("{0}: not frozen".format(year))
+                continue
+            source_db = self._database(year)
+            target_db = self._database(year, self.storage)
+            counts = []
+            for name in "companies", "invoices":
+                source_list = getattr(source_db, name)
+                target_list = getattr(target_db, name)
+                if self.storage == "sqlite":
+                    target_list._storage.ensure()
+                else:
+                    os.makedirs(target_list._path, exist_ok=True)
+                written, removed = invoice.db.storage.sync(
+                    source_list._storage, target_list._storage, source_list._regex)
+                target_list._storage.flush()
+                counts.append(written)
+            os.remove(archive_path)
+            self._databases.pop(year, None)
+            print("{0}: {1} companies and {2} invoices restored".format(year, *counts))
+
     def do_new(self, company_name):
         """Create and edit a new invoice."""
         item = self.db.invoices.new(company_name)
-        self._edit(item._path)
+        self._edit_item(item)
 
     def do_edit(self, selector):
         """Edit invoice in external editor.
@@ -123,18 +613,107 @@ class Application:
         The external editor is determined by EDITOR environment variable
         using 'vim' as the default. Item is edited in-place.
         """
-        self._edit(self.db.invoices[selector]._path)
+        self._edit_item(self.db.invoices[selector])
 
     def do_paid(self, selector, date):
-        path = self.db.invoices[selector]._path
-        with open(path, "a") as stream:
-            stream.write("Paid: {0}\n".format(date))
-        self._show(path)
+        item = self.db.invoices[selector]
+        item._list._storage.append(item._name, "Paid: {0}\n".format(date))
+        item._list.expire([item._name])
+        self._show_item(item)
+
+    def do_reconcile(self, statement, dry_run, encoding, delimiter, **names):
+        """Mark invoices paid according to a bank statement.
+
+        Incoming payments in a CSV statement are matched to unpaid
+        invoices of the year, or of the years given by '--years', by
+        variable symbol or by amount and the bank account of the company.
+        All matched invoices are written at once, unmatched and ambiguous
+        payments are reported.
+        """
+        start = time.time()
+        databases = self.history.databases if self.history else [self.db]
+        query = invoice.db.query.Query(unpaid=True)
+        unpaid = [pair for db in databases for pair in query.data(db.invoices)]
+        companies = [(item.name, item.data()) for db in databases for item in db.companies]
+        reconciler = invoice.reconcile.Reconciler(unpaid, companies)
+
+        names = dict((field, name) for field, name in names.items() if name)
+        if statement == "-":
+            stream = io.TextIOWrapper(sys.stdin.buffer, encoding=encoding, newline="")
+        else:
+            stream = open(statement, encoding=encoding, newline="")
+        counts = collections.Counter()
+        paid = collections.OrderedDict()
+        try:
+            for payment in invoice.reconcile.read_payments(stream, delimiter, names):
+                if isinstance(payment, ValueError):
+                    counts["unmatched"] += 1
+                    print("ERROR     {0}".format(payment))
+                    continue
+                if payment.amount <= 0:
+                    counts["skipped"] += 1
+                    continue
+                status, matches, reason = reconciler.match(payment)
+                counts[status] += 1
+                if status == "paid":
+                    item, data = matches[0]
+                    paid[item] = payment.date
+                print("{0:<9} line {1}: {2} {3} {4}: {5}{6}".format(status.upper(), payment.line,
+                    payment.date, payment.amount, payment.symbol or "-", reason,
+                    "".join(" {0}".format(item) for item, data in matches)))
+        except ValueError as error:
+            raise invoice.db.DatabaseError(str(error))
+        finally:
+            stream.close()
+
+        if not dry_run:
+            texts = collections.OrderedDict()
+            for item, date in paid.items():
+                storage = item._list._storage
+                text = storage.read(item._name)
+                if text and not text.endswith("\n"):
+                    text += "\n"
+                texts.setdefault(storage, []).append((item._name, "{0}Paid: {1}\n".format(text, date)))
+            for storage, items in texts.items():
+                storage.write_many(items)
+            for item in paid:
+                item._list.expire([item._name])
+        print()
+        print("{0} {1} of {2} payments ({3} ambiguous, {4} unmatched, {5} outgoing) in {6:.2f} s.".format(
+            "Would mark paid" if dry_run else "Marked paid", counts["paid"], sum(counts.values()),
+            counts["ambiguous"], counts["unmatched"], counts["skipped"], time.time() - start))
 
     def _edit(self, path):
-        log.debug("Editing file: {0}".format(path))
+        log.debug("Editing file: %s", path)
         assert os.path.exists(path)
-        subprocess.call((self.editor, path))
+        self._call((self.editor, path))
+
+    def _edit_item(self, item):
+        """Edit item in place or through a temporary file."""
+        item._list._storage.check_writable()
+        if item._path:
+            self._edit(item._path)
+            item._list.expire([item._name])
+            return
+        storage = item._list._storage
+        with tempfile.NamedTemporaryFile("w", prefix="{0}-".format(item._name), delete=False) as stream:
+            stream.write(storage.read(item._name))
+        try:
+            self._edit(stream.name)
+            with open(stream.name) as result:
+                storage.write(item._name, result.read())
+        finally:
+            os.unlink(stream.name)
+        item._list.expire([item._name])
+
+    def _show_item(self, item):
+        """View item in place or through a temporary file."""
+        if item._path:
+            return self._show(item._path)
+        with tempfile.NamedTemporaryFile("w", prefix="{0}-".format(item._name)) as stream:
+            stream.write(item._list._storage.read(item._name))
+            stream.flush()
+            self._show(stream.name, os.path.join(item._list._directory, item._name))
 
     def do_show(self, selector):
         """View invoice in external viewer.
@@ -143,63 +722,467 @@ class Application:
         using 'less' as the default.
         """
         item = self.db.invoices[selector]
-        self._show(item._path)
+        self._show_item(item)
 
-    def do_pdf(self, selector, generate):
+    def do_pdf(self, selector, generate, force, all, jobs, combine, combined, **query):
         """Generate and view a PDF invoice.
 
+        With more selectors, '--all' or filters, all matching invoices
+        are viewed, or with '--generate' their PDF files are generated in
+        parallel without viewing them.
+
+        PDF files are only generated again when the invoice, the
+        companies, the template or the configuration have changed
+        since the last run, unless '--force' is used.
+
+        With '--combine', invoices rendered by TeX are compiled together
+        in one TeX run per job and the resulting PDF file is split into
+        the invoice files. '--combined' additionally keeps all selected
+        invoices in a single PDF file for printing or mailing.
+
         This requires Tempita 0.5.
         """
-        import tempita
-        invoice = self.db.invoices[selector]
+        query = invoice.db.query.Query(**query)
+        if combine or combined:
+            invoices = self._select_invoices(selector, all, query)
+            if not invoices:
+                raise GenerationError("No invoices selected, use selectors, filters or '--all'.")
+            return self._generate_combined(invoices, jobs, force, combined)
+        if len(selector) > 1 or all or query:
+            invoices = self._select_invoices(selector, all, query)
+            if generate:
+                return self._generate_batch(invoices, jobs, force)
+            for item in invoices:
+                self._view_pdf(self._pdf_file(item))
+            return
 
-        tmp_path = self.tmp_path.format(year=self.year)
-        output_path = self.output_path.format(year=self.year)
-        log.debug("tmp_path={0}".format(tmp_path))
-
-        tex_template = os.path.join(self.template_path, "invoice.tex")
-        tex_file = os.path.join(tmp_path, "{0}.tex".format(invoice._name))
-        tmp_pdf_file = os.path.join(tmp_path, "{0}.pdf".format(invoice._name))
-        pdf_file = os.path.join(output_path, "{0}.pdf".format(invoice._name))
+        item = self.db.invoices[selector[0] if selector else None]
+        pdf_file = self._pdf_file(item)
 
         if generate:
-            #if(not os.path.exists(pdf_file) or
-            #        os.path.getmtime(invoice._path) > os.path.getmtime(pdf_file)):
-            issuer = self.db.companies[self.my_company]
-            customer = self.db.companies[invoice.company_name]
+            self._check_path(self.tmp_path)
+            self._check_path(os.path.dirname(pdf_file))
+            fingerprints = self._fingerprints()
+            fingerprint = fingerprints.compute(*self._pdf_inputs(item))
+            if force or not fingerprints.is_current(pdf_file, fingerprint):
+                pdf = self._render_native(item)
+                if pdf is not None:
+                    self._write_pdf(pdf_file, pdf)
+                else:
+                    self._compile_pdf(item._name, self._render_tex(item), pdf_file)
+                fingerprints.update(pdf_file, fingerprint)
+                fingerprints.save()
+            else:
+                log.info("PDF file is up to date: %s", pdf_file)
 
-            invoice_data = invoice.data()
-            issuer_data = issuer.data()
-            customer_data = customer.data()
+        self._view_pdf(pdf_file)
 
-            log.debug("Invoice: {0}".format(invoice_data._data))
-            log.debug("Issuer: {0}".format(issuer_data._data))
-            log.debug("Customer: {0}".format(customer_data._data))
+    def _view_pdf(self, pdf_file):
+        if not os.path.exists(pdf_file):
+            raise GenerationError("PDF file not found: {0}. Use '--generate' to create it.".format(pdf_file))
+        log.debug("Running PDF viewer...")
+        self._call((self.pdf_program, pdf_file))
 
-            log.debug("Creating TeX invoice...")
-            self._check_path(self.tmp_path)
-            result = tempita.Template(open(tex_template).read()).substitute(
-                invoice=invoice_data, issuer=issuer_data, customer=customer_data)
-            open(tex_file, "w").write(str(result))
-            assert(os.path.exists(tex_file))
+    def _select_invoices(self, selectors, all, query):
+        """Return invoices matching any of the selectors or the query."""
+        invoices = set(self.db.invoices[selector] for selector in selectors)
+        if all or query:
+            invoices.update(query.items(self.db.invoices))
+        return sorted(invoices)
 
-            log.debug("Creating PDF invoice...")
-            if subprocess.call((self.tex_program, "{0}.tex".format(invoice._name)), cwd=tmp_path) != 0:
-                raise GenerationError("PDF generation failed.")
-            assert(os.path.exists(tmp_pdf_file))
+    def _pdf_file(self, invoice):
+        return os.path.join(self.output_path.format(year=self.year), "{0}.pdf".format(invoice._name))
 
-            log.debug("Moving PDF file to the output directory...")
-            self._check_path(output_path)
-            os.rename(tmp_pdf_file, pdf_file)
+    def _fingerprints(self):
+        return invoice.depends.Fingerprints(os.path.join(
+            self.output_path.format(year=self.year), ".fingerprints"))
 
-        assert(os.path.exists(pdf_file))
-        log.debug("Running PDF viewer...")
-        subprocess.call((self.pdf_program, pdf_file))
+    def _pdf_inputs(self, invoice):
+        """Return paths of files and keys of items a PDF invoice is generated from."""
+        issuer = self.db.companies[self.my_company]
+        customer = self.db.companies[invoice.company_name]
+        paths = (self.templates.path(self._template_name(customer.data())),
+            os.path.join(self.user_path, "config"), os.path.join(self.user_path, "signature.png"))
+        keys = [(item._name, item._key()) for item in (invoice, issuer, customer)]
+        return paths, keys
+
+    def _template_name(self, customer_data):
+        """Return template name, customers can override the configured one."""
+        return customer_data.template or self.template
+
+    def _render_tex(self, item):
+        issuer = self.db.companies[self.my_company]
+        customer = self.db.companies[item.company_name]
+
+        invoice_data = item.data()
+        issuer_data = issuer.data()
+        customer_data = customer.data()
+
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Invoice: %s", invoice_data._data)
+            log.debug("Issuer: %s", issuer_data._data)
+            log.debug("Customer: %s", customer_data._data)
+
+        log.debug("Creating TeX invoice...")
+        template = self.templates.get(self._template_name(customer_data))
+        with invoice.profile.timer("template.render"):
+            return str(template.substitute(
+                invoice=invoice_data, issuer=issuer_data, customer=customer_data))
+
+    def _render_native(self, item):
+        """Return PDF rendered without TeX or None when TeX is to be used.
+
+        The native renderer is used when 'renderer' is set to "pdf" in
+        the config and only for invoices using the standard template. TeX
+        is used as well when the signature image cannot be embedded.
+        """
+        if self.renderer != "pdf":
+            return None
+        import invoice.pdf
+
+        customer_data = self.db.companies[item.company_name].data()
+        if self._template_name(customer_data) != "invoice":
+            log.debug("Using TeX for template: %s", self._template_name(customer_data))
+            return None
+        log.debug("Creating PDF invoice...")
+        with invoice.profile.timer("pdf.render"):
+            try:
+                return invoice.pdf.render_invoice(item.data(), self.db.companies[self.my_company].data(),
+                    customer_data, os.path.join(self.user_path, "signature.png"))
+            except invoice.pdf.ImageError as error:
+                log.warning("%s, using TeX.", error)
+                return None
+
+    def _write_pdf(self, pdf_file, pdf):
+        tmp_file = pdf_file + "~"
+        with open(tmp_file, "wb") as stream:
+            stream.write(pdf)
+        os.replace(tmp_file, pdf_file)
+
+    def _compile_pdf(self, name, tex, pdf_file, quiet=False):
+        """Run TeX on the source in a private scratch directory.
+
+        TeX runs in the common tmp directory so that relative paths in
+        the template keep working, while all files it produces go to
+        the scratch directory. The scratch directory is removed on
+        success and kept for inspection on failure.
+
+        Returns contents of the TeX log file.
+        """
+        job_path = tempfile.mkdtemp(prefix="{0}-".format(name), dir=self.tmp_path)
+        tex_file = os.path.join(job_path, "{0}.tex".format(name))
+        tmp_pdf_file = os.path.join(job_path, "{0}.pdf".format(name))
+        with open(tex_file, "w") as stream:
+            stream.write(tex)
+
+        log.debug("Creating PDF invoice: %s", tex_file)
+        command = (self.tex_program, "-interaction=nonstopmode",
+            "-output-directory", os.path.relpath(job_path, self.tmp_path),
+            os.path.relpath(tex_file, self.tmp_path))
+        output = subprocess.DEVNULL if quiet else None
+        log_file = os.path.join(job_path, "{0}.log".format(name))
+        with invoice.profile.timer("subprocess.tex"):
+            status = subprocess.call(command, cwd=self.tmp_path, stdin=subprocess.DEVNULL,
+                stdout=output, stderr=output)
+        if status != 0 or not os.path.exists(tmp_pdf_file):
+            raise GenerationError("PDF generation failed, see {0}.".format(log_file))
+
+        log.debug("Moving PDF file to the output directory...")
+        os.replace(tmp_pdf_file, pdf_file)
+        try:
+            with open(log_file, encoding="latin-1") as stream:
+                tex_log = stream.read()
+        except FileNotFoundError:
+            tex_log = ""
+        shutil.rmtree(job_path)
+        return tex_log
+
+    def _generate_batch(self, invoices, jobs, force=False):
+        """Generate PDF files for many invoices using a pool of TeX processes."""
+        import concurrent.futures
+
+        self._check_path(self.tmp_path)
+        self._check_path(self.output_path.format(year=self.year))
+        start = time.time()
+
+        # Data files and the template are processed here, the pool only
+        # waits for the external TeX processes.
+        fingerprints = self._fingerprints()
+        results = {}
+        skipped = set()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs or 1, 1)) as executor:
+            futures = {}
+            for item in invoices:
+                pdf_file = self._pdf_file(item)
+                try:
+                    fingerprint = fingerprints.compute(*self._pdf_inputs(item))
+                    if not force and fingerprints.is_current(pdf_file, fingerprint):
+                        skipped.add(item)
+                        continue
+                    pdf = self._render_native(item)
+                    if pdf is not None:
+                        self._write_pdf(pdf_file, pdf)
+                        results[item] = None
+                        fingerprints.update(pdf_file, fingerprint)
+                        continue
+                    tex = self._render_tex(item)
+                except (LookupError, ValueError) as error:
+                    results[item] = error
+                    continue
+                future = executor.submit(self._compile_pdf, item._name, tex, pdf_file, quiet=True)
+                futures[future] = item, pdf_file, fingerprint
+            for future in concurrent.futures.as_completed(futures):
+                item, pdf_file, fingerprint = futures[future]
+                results[item] = future.exception()
+                if not results[item]:
+                    fingerprints.update(pdf_file, fingerprint)
+        fingerprints.save()
+        self._report_batch(results, skipped, start)
+
+    _page_marker = re.compile(r"^invoice-pages:(\d+)$", re.MULTILINE)
+
+    @staticmethod
+    def _split_tex(tex):
+        """Return the preamble and the body of a TeX document."""
+        preamble, begin, rest = tex.partition(r"\begin{document}")
+        body, end, tail = rest.rpartition(r"\end{document}")
+        if not begin or not end:
+            raise ValueError("TeX source is not a LaTeX document.")
+        return preamble, body
+
+    def _combine_tex(self, sources):
+        """Return a LaTeX document with bodies of all sources.
+
+        The sources share the preamble of the first one. The page counter
+        is reset for each invoice and the page numbers at the start of
+        each invoice are written to the log to split the PDF file later.
+        """
+        parts = [sources[0][0], r"\begin{document}"]
+        for preamble, body in sources:
+            parts.append(r"\clearpage\typeout{invoice-pages:\the\value{page}}\setcounter{page}{1}\begingroup")
+            parts.append(body)
+            parts.append(r"\endgroup")
+        parts.append(r"\clearpage\typeout{invoice-pages:\the\value{page}}")
+        parts.append(r"\end{document}")
+        return "\n".join(parts)
+
+    def _compile_combined(self, sources):
+        """Compile TeX sources in a single run and return their PDF files."""
+        import invoice.pdf
+
+        fd, pdf_file = tempfile.mkstemp(prefix="combined-", suffix=".pdf", dir=self.tmp_path)
+        os.close(fd)
+        try:
+            tex_log = self._compile_pdf("combined", self._combine_tex(sources), pdf_file, quiet=True)
+            with open(pdf_file, "rb") as stream:
+                data = stream.read()
+        finally:
+            os.remove(pdf_file)
+        markers = [int(marker) for marker in self._page_marker.findall(tex_log)]
+        page_counts = [marker - 1 for marker in markers[1:]]
+        if len(page_counts) != len(sources) or min(page_counts) < 1:
+            raise GenerationError("Cannot find page numbers of the invoices in the TeX log.")
+        with invoice.profile.timer("pdf.split"):
+            return invoice.pdf.split(data, page_counts)
+
+    def _generate_combined(self, invoices, jobs, force=False, combined=None):
+        """Generate PDF files for many invoices in few TeX runs.
+
+        Invoices sharing the TeX preamble are divided among at most
+        'jobs' TeX runs, so the number of processes doesn't grow with
+        the number of invoices.
+        """
+        import concurrent.futures
+        import invoice.pdf
+
+        self._check_path(self.tmp_path)
+        self._check_path(self.output_path.format(year=self.year))
+        start = time.time()
+
+        fingerprints = self._fingerprints()
+        results = {}
+        skipped = set()
+        groups = {}
+        for item in invoices:
+            pdf_file = self._pdf_file(item)
+            try:
+                fingerprint = fingerprints.compute(*self._pdf_inputs(item))
+                if not force and fingerprints.is_current(pdf_file, fingerprint):
+                    skipped.add(item)
+                    continue
+                pdf = self._render_native(item)
+                if pdf is not None:
+                    self._write_pdf(pdf_file, pdf)
+                    results[item] = None
+                    fingerprints.update(pdf_file, fingerprint)
+                    continue
+                preamble, body = self._split_tex(self._render_tex(item))
+            except (LookupError, ValueError) as error:
+                results[item] = error
+                continue
+            groups.setdefault(preamble, []).append((item, pdf_file, fingerprint, body))
+
+        jobs = max(jobs or 1, 1)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {}
+            for preamble, group in groups.items():
+                size = -(-len(group) // jobs)
+                for offset in range(0, len(group), size):
+                    chunk = group[offset:offset+size]
+                    log.debug("Compiling %s invoices in one TeX run.", len(chunk))
+                    future = executor.submit(self._compile_combined,
+                        [(preamble, body) for item, pdf_file, fingerprint, body in chunk])
+                    futures[future] = chunk
+            for future in concurrent.futures.as_completed(futures):
+                chunk = futures[future]
+                try:
+                    pdfs = future.result()
+                except (GenerationError, ValueError) as error:
+                    results.update((item, error) for item, pdf_file, fingerprint, body in chunk)
+                    continue
+                for (item, pdf_file, fingerprint, body), pdf in zip(chunk, pdfs):
+                    self._write_pdf(pdf_file, pdf)
+                    results[item] = None
+                    fingerprints.update(pdf_file, fingerprint)
+        fingerprints.save()
+
+        if combined and any(results.values()):
+            log.error("Combined PDF file not written as some invoices failed: %s", combined)
+        elif combined:
+            documents = []
+            for item in invoices:
+                with open(self._pdf_file(item), "rb") as stream:
+                    documents.append(stream.read())
+            self._write_pdf(combined, invoice.pdf.merge(documents))
+            log.info("Combined PDF file: %s", combined)
+        self._report_batch(results, skipped, start)
+
+    def _report_batch(self, results, skipped, start):
+        failed = 0
+        for item in sorted(results):
+            error = results[item]
+            if error:
+                failed += 1
+                print("FAILED {0}: {1}".format(item, error))
+            else:
+                print("OK     {0}".format(item))
+        print()
+        print("Generated {0} of {1} invoices ({2} up to date) in {3:.2f} s.".format(
+            len(results) - failed, len(results), len(skipped), time.time() - start))
+        log.debug("Company data cache: %s", self.db.companies.cache_info())
+        if failed:
+            raise GenerationError("{0} invoices failed.".format(failed))
+
+    def do_watch(self, jobs, poll, interval):
+        """Keep PDF files up to date while data files and templates change.
+
+        Invoice and company files of the selected year and the templates
+        are watched, changed items are loaded again and PDF files of the
+        affected invoices are generated in the background. The database
+        is used by one thread at a time.
+        """
+        import concurrent.futures, threading
+
+        if self.storage != "files":
+            raise invoice.db.DatabaseError("Watching requires the file storage.")
+        invoices, companies = self.db.invoices, self.db.companies
+        watcher = invoice.watch.watcher([invoices._path, companies._path, self.template_path],
+            poll=poll, interval=interval)
+        background = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        lock = threading.Lock()
+        try:
+            self._regenerate_later(background, lock, sorted(invoices), jobs)
+            log.info("Watching for changes, press Ctrl+C to stop.")
+            while True:
+                changes = watcher.wait()
+                affected = set()
+                with lock:
+                    for path, name in changes:
+                        if name is None:
+                            for list_ in invoices, companies:
+                                list_._invalidate()
+                            affected.update(invoices)
+                        elif path == invoices._path:
+                            affected.update(invoices.update([name]))
+                        elif path == companies._path:
+                            self._affected_by_company(companies.update([name]), name, affected)
+                        elif name.endswith(self.templates.extension):
+                            self._affected_by_template(name[:-len(self.templates.extension)], affected)
+                if affected:
+                    self._regenerate_later(background, lock, sorted(affected), jobs)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
+            background.shutdown()
+
+    def _affected_by_company(self, updated, name, affected):
+        if name == self.my_company:
+            affected.update(self.db.invoices)
+        elif updated:
+            affected.update(self.db.invoices.select({"company_name": name}))
+
+    def _affected_by_template(self, name, affected):
+        for item in self.db.invoices:
+            try:
+                if self._template_name(self.db.companies[item.company_name].data()) == name:
+                    affected.add(item)
+            except (LookupError, ValueError):
+                pass
+
+    def _regenerate_later(self, executor, lock, invoices, jobs):
+        """Generate outdated PDF files in the background, used by the watch command."""
+        executor.submit(self._regenerate, lock, invoices, jobs).add_done_callback(self._regenerated)
+
+    def _regenerate(self, lock, invoices, jobs):
+        with lock:
+            try:
+                self._generate_batch(invoices, jobs)
+            finally:
+                self.db.flush()
+
+    @staticmethod
+    def _regenerated(future):
+        """Report errors of background generation."""
+        if future.cancelled():
+            return
+        try:
+            future.result()
+        except GenerationError as error:
+            log.error(error)
+        except Exception:
+            log.exception("Generating PDF files failed.")
 
     def _check_path(self, path):
         if not os.path.exists(path):
             raise LookupError("Directory doesn't exist: {0}".format(path))
 
+    def do_check(self, jobs):
+        """Check invoice and company data for errors.
+
+        All data files of the year, or of the years given by '--years',
+        are parsed in parallel and all errors are reported. Invoices are
+        also checked for gaps and duplicates in numbers, unknown companies
+        and payment dates before the issue date.
+        """
+        import invoice.check
+
+        start = time.time()
+        databases = self.history.databases if self.history else [self.db]
+        config = {"data_path": self.data_path, "storage": self.storage, "sqlite_path": self.sqlite_path,
+            "archive_path": self.archive_path}
+        problems, files = invoice.check.check(databases, config, jobs)
+        errors = 0
+        for problem in problems:
+            if not problem.warning:
+                errors += 1
+            print("{0} {1}: {2}{3}".format(problem.year, problem.name or "-",
+                "warning: " if problem.warning else "", problem.message))
+        print("Checked {0} files in {1:.2f} s, {2} errors, {3} warnings.".format(
+            files, time.time() - start, errors, len(problems) - errors))
+        if errors:
+            raise invoice.db.DatabaseError("Data check failed.")
+
     def do_delete(self, selector, force):
         """List invoices."""
         if selector:
@@ -218,7 +1201,7 @@ class Application:
     def do_new_company(self, name):
         """Create and edit a new company."""
         item = self.db.companies.new(name)
-        self._edit(item._path)
+        self._edit_item(item)
 
     def do_edit_company(self, selector):
         """Edit company in external editor.
@@ -227,7 +1210,7 @@ class Application:
         using 'vim' as the default. Item is edited in-place.
         """
         item = self.db.companies[selector]
-        self._edit(item._path)
+        self._edit_item(item)
 
     def do_show_company(self, selector):
         """View company in external viewer.
@@ -237,21 +1220,32 @@ class Application:
         """
         item = self.db.companies[selector]
         print("# {0}".format(item._name))
-        self._show(item._path)
+        self._show_item(item)
 
-    def _show(self, path):
-        log.debug("Viewing file: {0}".format(path))
+    def _show(self, path, title=None):
+        log.debug("Viewing file: %s", path)
         assert os.path.exists(path)
-        print("# {0}".format(path))
-        subprocess.call((self.viewer, path))
+        print("# {0}".format(title or path))
+        self._call((self.viewer, path))
+
+    def _company_invoices(self, name, years=None):
+        """Return (year, name) pairs of invoices of a company in all or the given years."""
+        self.company_index.refresh(self._database(year).invoices for year in self._find_years())
+        return [(year, invoice_name) for year, invoice_name in self.company_index.invoices(name)
+            if years is None or year in years]
+
+    def do_company_invoices(self, name):
+        """List invoices of a company in all years."""
+        for year, invoice_name in self._company_invoices(name):
+            print(invoice_name)
 
     def do_delete_company(self, selector, force):
-        """Delete a company."""
+        """Delete a company of the year, refused while its invoices of the year exist."""
         company = self.db.companies[selector]
         if not force:
-            invoices = self.db.invoices.select({"company_name": company._name})
+            invoices = self._company_invoices(company._name, [int(self.year)])
             if invoices:
-                for invoice in invoices:
-                    log.info("Dependent invoice: {0}".format(invoice))
+                for year, name in invoices:
+                    log.info("Dependent invoice: %s", name)
                 raise SanityCheckError("This company is used by some invoices. You should not delete it.")
         company.delete()
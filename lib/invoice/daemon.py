@@ -0,0 +1,115 @@
+#!/usr/bin/python3
+"""Running invoice commands in a long-running process.
+
+The server keeps the database warm between commands. The client part
+only uses the standard library modules imported here so that forwarding
+a command is much cheaper than running it.
+"""
+
+import os, sys, socket, json, subprocess, signal
+
+import logging
+log = logging.getLogger()
+
+socket_name = "daemon.sock"
+default_user_path = "~/.invoice"
+forwarded_variables = "EDITOR", "PAGER"
+
+def socket_path(user_path=default_user_path):
+    return os.path.join(os.path.expanduser(user_path), socket_name)
+
+def _receive(connection):
+    chunks = []
+    while True:
+        chunk = connection.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    return json.loads(b"".join(chunks).decode("utf-8"))
+
+def _send(connection, message):
+    connection.sendall(json.dumps(message).encode("utf-8"))
+    connection.shutdown(socket.SHUT_WR)
+
+def _local_only(argv):
+    """Check whether the command must not be forwarded."""
+    for arg in argv:
+        if arg in ("-d", "--user-data") or arg.startswith("--user-data="):
+            return True
+        if arg == "daemon":
+            return True
+    return not argv
+
+def forward(argv):
+    """Run a command in the daemon.
+
+    Returns the exit status or None when no daemon is running or the
+    command must run locally.
+    """
+    if _local_only(argv):
+        return
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path())
+    except (FileNotFoundError, ConnectionRefusedError):
+        connection.close()
+        return
+    with connection:
+        _send(connection, {"argv": argv, "cwd": os.getcwd(), "environ": dict((variable, os.environ.get(variable))
+            for variable in forwarded_variables)})
+        response = _receive(connection)
+    if response["status"] is None:
+        return
+    sys.stdout.write(response["stdout"])
+    sys.stderr.write(response["stderr"])
+    sys.stdout.flush()
+    for command in response["commands"]:
+        subprocess.call(command)
+    return response["status"]
+
+class Server(object):
+    """Unix socket server running commands one at a time.
+
+    The handler is called with the request dict holding the argument
+    list, the client's working directory and its editor and pager
+    variables. It returns a response
+    dict with 'status', 'stdout', 'stderr' and a list of external
+    'commands' (like the editor) the client should run. A 'status' of
+    None tells the client to run the command itself.
+    """
+    def __init__(self, path, handler):
+        self._path = path
+        self._handler = handler
+
+    def serve(self):
+        if os.path.exists(self._path):
+            os.unlink(self._path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            listener.bind(self._path)
+            os.chmod(self._path, 0o600)
+            listener.listen(16)
+            log.info("Listening on %s.", self._path)
+            while True:
+                connection, address = listener.accept()
+                with connection:
+                    self._handle(connection)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            listener.close()
+            os.unlink(self._path)
+
+    def _handle(self, connection):
+        try:
+            request = _receive(connection)
+            response = self._handler(request)
+        except Exception as error:
+            log.exception("Request failed.")
+            response = {"status": 1, "stdout": "", "commands": [],
+                "stderr": "Error: Daemon request failed: {0}\n".format(error)}
+        try:
+            _send(connection, response)
+        except OSError as error:
+            log.warning("Cannot send response: %s", error)
@@ -1,8 +1,40 @@
+import os
+
 from .base import DatabaseError
+from .history import History
 
 class Database:
-    def __init__(self, **config):
+    """Database of a single year.
+
+    Set 'storage' to "sqlite" and 'sqlite_path' to keep the data in an
+    SQLite database instead of data files. A CompanyIndex given as
+    'index' is updated when invoices are created or deleted. When an
+    archive exists at 'archive_path', the year is frozen and read from
+    the archive only.
+    """
+    def __init__(self, storage="files", sqlite_path=None, index=None, archive_path=None, **config):
         from . import companies
         from . import invoices
+        if archive_path and os.path.exists(archive_path):
+            from . import archive as archive_module
+            archive = archive_module.Archive(archive_path)
+            config["storage"] = lambda list_: archive_module.ArchiveStorage(archive, list_)
+        elif storage == "sqlite":
+            from . import storage as storage_module
+            connection = storage_module.connect(sqlite_path)
+            config["storage"] = lambda list_: storage_module.SQLiteStorage(connection, list_)
+        elif storage != "files":
+            raise DatabaseError("Unknown storage: {0}".format(storage))
+        self.index = index
         self.companies = companies.Companies(db=self, **config)
         self.invoices = invoices.Invoices(db=self, **config)
+
+    def flush(self):
+        """Write back cached data."""
+        self.companies.flush()
+        self.invoices.flush()
+
+    def expire(self):
+        """Forget storage keys found by scans, items may have changed in place."""
+        self.companies.expire()
+        self.invoices.expire()
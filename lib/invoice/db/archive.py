@@ -0,0 +1,156 @@
+#!/usr/bin/python3
+"""Read-only archives of frozen years.
+
+An archive keeps the invoices and companies of a year in a single file
+accessed through mmap. It starts with a section per list pointing to an
+index of fixed-width records sorted by item name. Each record holds the
+offsets of the item text and of its parsed data, pickled like in the
+data cache. Parsed data are used only if the list data format is the one
+the archive was written with, otherwise the text is parsed again. Items
+are looked up by a binary search of the index in the mapped file, names
+are only decoded when a list is scanned.
+
+    header    magic, number of sections
+    section   directory, item count, name width, index offset, data format digest
+    record    name (padded to name width), text offset and length, data offset and length
+"""
+
+import os, mmap, pickle, struct, hashlib
+
+import logging
+log = logging.getLogger()
+
+from invoice.db.base import DatabaseError
+from invoice.db.storage import Storage
+
+class FrozenError(DatabaseError):
+    pass
+
+_magic = b"INVFRZ01"
+_header = struct.Struct("<8sI")
+_section = struct.Struct("<16sIIQ20s")
+_offsets = struct.Struct("<QIQI")
+
+def data_format(list_):
+    """Return digest identifying the format of parsed data of a list."""
+    return hashlib.sha1(repr(list_._cache_version()).encode("utf-8")).digest()
+
+def write(path, sections):
+    """Write an archive atomically.
+
+    Takes (directory, data format, items) triples, items being (name,
+    text, data) triples.
+    """
+    sections = [(directory, digest, sorted(items)) for directory, digest, items in sections]
+    blobs = []
+    position = _header.size + _section.size * len(sections)
+    table = []
+    for directory, digest, items in sections:
+        width = max((len(name.encode("utf-8")) for name, text, data in items), default=1)
+        table.append((directory, len(items), width, position, digest))
+        position += (width + _offsets.size) * len(items)
+    records = []
+    for (directory, digest, items), (_, count, width, offset, _) in zip(sections, table):
+        for name, text, data in items:
+            text = text.encode("utf-8")
+            data = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+            records.append(name.encode("utf-8").ljust(width, b"\0")
+                + _offsets.pack(position, len(text), position + len(text), len(data)))
+            blobs.extend((text, data))
+            position += len(text) + len(data)
+
+    tmp_path = path + "~"
+    with open(tmp_path, "wb") as stream:
+        stream.write(_header.pack(_magic, len(sections)))
+        for directory, count, width, offset, digest in table:
+            stream.write(_section.pack(directory.encode("ascii"), count, width, offset, digest))
+        stream.writelines(records)
+        stream.writelines(blobs)
+    os.replace(tmp_path, path)
+
+class Archive(object):
+    """Memory mapped archive file."""
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as stream:
+            self._map = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+            self.version = os.fstat(stream.fileno()).st_mtime_ns
+        self._view = memoryview(self._map)
+        magic, count = _header.unpack_from(self._map, 0)
+        if magic != _magic:
+            raise DatabaseError("Not an invoice archive: {0}".format(path))
+        self._sections = {}
+        for n in range(count):
+            directory, items, width, offset, digest = _section.unpack_from(self._map,
+                _header.size + _section.size * n)
+            self._sections[directory.rstrip(b"\0").decode("ascii")] = items, width, offset, digest
+
+    def names(self, directory):
+        """Generate item names of a list with their record positions."""
+        count, width, offset, digest = self._sections.get(directory, (0, 0, 0, None))
+        size = width + _offsets.size
+        for position in range(offset, offset + count * size, size):
+            yield bytes(self._view[position:position+width]).rstrip(b"\0").decode("utf-8"), position + width
+
+    def find(self, directory, name):
+        """Return record position of an item or None if it is not archived."""
+        count, width, offset, digest = self._sections.get(directory, (0, 0, 0, None))
+        key = name.encode("utf-8")
+        if len(key) > width:
+            return None
+        key = key.ljust(width, b"\0")
+        size = width + _offsets.size
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            position = offset + middle * size
+            if self._map[position:position+width] < key:
+                low = middle + 1
+            else:
+                high = middle
+        position = offset + low * size
+        if low < count and self._map[position:position+width] == key:
+            return position + width
+
+    def data_format(self, directory):
+        return self._sections.get(directory, (0, 0, 0, None))[3]
+
+    def text(self, position):
+        text_offset, text_length, data_offset, data_length = _offsets.unpack_from(self._map, position)
+        return str(self._view[text_offset:text_offset+text_length], "utf-8")
+
+    def data(self, position):
+        text_offset, text_length, data_offset, data_length = _offsets.unpack_from(self._map, position)
+        return pickle.loads(self._view[data_offset:data_offset+data_length])
+
+class ArchiveStorage(Storage):
+    """Read-only storage of a list in an archive."""
+    def __init__(self, archive, list_):
+        self._archive = archive
+        self._directory = list_._directory
+        self._year = list_._year
+        self._current_format = archive.data_format(self._directory) == data_format(list_)
+
+    def version(self):
+        return self._archive.version
+
+    def scan(self, regex):
+        return dict((name, position) for name, position in self._archive.names(self._directory) if regex.match(name))
+
+    def key(self, name):
+        position = self._archive.find(self._directory, name)
+        if position is None:
+            raise FileNotFoundError("Item not found in {0}: {1}".format(self._archive.path, name))
+        return position
+
+    def load(self, name, key):
+        if self._current_format:
+            return self._archive.data(key)
+
+    def read(self, name):
+        return self._archive.text(self.key(name))
+
+    def _frozen(self, *args):
+        raise FrozenError("Year {0} is frozen, use 'unfreeze' to change it.".format(self._year))
+
+    create = write = write_many = append = remove = drop = allocate = release = check_writable = _frozen
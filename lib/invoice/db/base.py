@@ -1,10 +1,15 @@
 #!/usr/bin/python3
 
-import os, sys, re, time, datetime
+import os, sys, io, re, time, bisect, string, datetime
+from sys import intern
 
 import logging
 log = logging.getLogger()
 
+from invoice.db.cache import DataCache
+from invoice.db.storage import FileStorage
+from invoice import profile
+
 class DatabaseError(Exception):
     pass
 
@@ -17,19 +22,72 @@ class ItemNameCheckError(DatabaseError, ValueError):
 class ItemExistsError(DatabaseError):
     pass
 
+class Snapshot(object):
+    """Items found in a list storage with indexes on selector attributes.
+
+    Storage keys found by the scan are kept in 'item_keys' until they
+    expire.
+    """
+    def __init__(self, items, keys, version, item_keys):
+        self.items = sorted(items)
+        self.version = version
+        self.item_keys = item_keys
+        self.names = dict((item._name, item) for item in self.items)
+        self.index = dict((key, {}) for key in keys)
+        for item in self.items:
+            for key, index in self.index.items():
+                index.setdefault(getattr(item, key), []).append(item)
+
+    def add(self, item, key):
+        self.remove(item._name)
+        bisect.insort(self.items, item)
+        self.names[item._name] = item
+        self.item_keys[item._name] = key
+        for key, index in self.index.items():
+            bisect.insort(index.setdefault(getattr(item, key), []), item)
+
+    def remove(self, name):
+        item = self.names.pop(name, None)
+        self.item_keys.pop(name, None)
+        if item is None:
+            return
+        self.items.remove(item)
+        for key, index in self.index.items():
+            items = index[getattr(item, key)]
+            items.remove(item)
+            if not items:
+                del index[getattr(item, key)]
+
 class List(object):
     """Base class for database lists.
     
     This class provides a real-time view to a file-based database. It can be
     used as an iterable with a little bit of magic (like indexing by a
     dictionary of matching attributes).
+
+    Items are kept in a snapshot that is rebuilt when the storage
+    version (directory modification time for files) changes or when the
+    list is modified through the API.
+
+    Items are stored in files by default, 'storage' can be a callable
+    returning another storage object for the list.
     """
-    def __init__(self, year, data_path, db=None):
+    def __init__(self, year, data_path, cache_path=None, db=None, storage=None):
         self._year = year
         self._path = os.path.expanduser(data_path.format(
             year=year, directory=self._directory))
+        if storage is None:
+            cache = None
+            if cache_path:
+                cache = DataCache(os.path.expanduser(cache_path.format(
+                    year=year, directory=self._directory)), self._cache_version())
+            self._storage = FileStorage(self._path, cache)
+        else:
+            self._storage = storage(self)
         self._db = db
-        log.debug("{0}: {1}".format(self.__class__.__name__, self._path))
+        self._current = None
+        self._selector_keys = {}
+        log.debug("%s: %s", self.__class__.__name__, self._path)
 
     def _item_class(self):
         """Returns class object used to instantiate items.
@@ -38,17 +96,152 @@ class List(object):
         """
         return Item
 
+    def _cache_version(self):
+        """Return a key identifying the format of cached item data."""
+        data_class = self._item_class()._data_class()
+        return (data_class.__name__, data_class._version,
+            tuple(data_class._fields), tuple(data_class._multivalue_fields))
+
     def _item_name(self):
         return self._item_class().__name__.lower()
 
     def __iter__(self):
-        for name in os.listdir(self._path):
+        return iter(self._snapshot().items)
+
+    def _snapshot(self):
+        """Return an up-to-date snapshot of list items."""
+        version = self._storage.version()
+        if self._current is None or self._current.version != version:
+            self._current = self._scan(version)
+        return self._current
+
+    def _scan(self, version):
+        log.debug("Scanning %s: %s", self._item_name(), self._path)
+        item_class = self._item_class()
+        keys = self._storage.scan(self._regex)
+        items = [item_class(self, name, year=self._year, **self._regex.match(name).groupdict())
+            for name in keys]
+        return Snapshot(items, self._regex.groupindex, version, keys)
+
+    def _invalidate(self):
+        self._current = None
+
+    def expire(self, names=None):
+        """Forget storage keys found by the scan.
+
+        Use when items may have been changed in place, e.g. by an editor
+        or by writing to the storage directly. Keys of the given names or
+        of all items are then read from the storage again.
+        """
+        if self._current is None:
+            return
+        if names is None:
+            self._current.item_keys.clear()
+        for name in names or ():
+            self._current.item_keys.pop(name, None)
+
+    def _item_key(self, name):
+        """Return storage key of an item, as found by the scan unless expired."""
+        snapshot = self._current
+        if snapshot is not None and name in snapshot.item_keys:
+            return snapshot.item_keys[name]
+        return self._storage.key(name)
+
+    def update(self, names):
+        """Update items with changed names without scanning the storage.
+
+        Items that exist are added or replaced and their data parsed
+        again, the others are removed. Returns the current items.
+        """
+        snapshot = self._current
+        if snapshot is None:
+            self._snapshot()
+            return [self._current.names[name] for name in names if name in self._current.names]
+        item_class = self._item_class()
+        items = []
+        for name in names:
             match = self._regex.match(name)
-            if match:
-                yield self._item_class()(self, year=self._year, **match.groupdict())
+            if not match:
+                continue
+            try:
+                key = self._storage.key(name)
+            except FileNotFoundError:
+                log.debug("Removed %s: %s", self._item_name(), name)
+                snapshot.remove(name)
+                continue
+            log.debug("Updated %s: %s", self._item_name(), name)
+            item = item_class(self, name, year=self._year, **match.groupdict())
+            snapshot.add(item, key)
+            items.append(item)
+        snapshot.version = self._storage.version()
+        for item in items:
+            try:
+                self._data(item)
+            except ValueError as error:
+                log.warning("Cannot parse %s: %s", item, error)
+        return items
+
+    def _key_index(self, selector):
+        """Return a key to position mapping shared by items with the same selector keys."""
+        keys = tuple(selector)
+        try:
+            return self._selector_keys[keys]
+        except KeyError:
+            return self._selector_keys.setdefault(keys, dict((key, n) for n, key in enumerate(keys)))
+
+    def _data(self, item):
+        """Return data object for an item, reusing parsed data kept by the storage."""
+        data_class = item._data_class()
+        key = self._item_key(item._name)
+        data = self._storage.load(item._name, key)
+        if data is not None:
+            return data_class(item, data)
+        result = data_class(item)
+        self._storage.store(item._name, key, result._data)
+        return result
+
+    def data_many(self, items):
+        """Return data objects for many items.
+
+        Items without valid stored data are read in bulk, file storage
+        reads them all into a single reused buffer. Stored data are
+        validated by the keys found by the scan.
+        """
+        data_class = self._item_class()._data_class()
+        results = {}
+        missing = []
+        for item in items:
+            key = self._item_key(item._name)
+            data = self._storage.load(item._name, key)
+            if data is not None:
+                results[item] = data_class(item, data)
+            else:
+                missing.append((item, key))
+        texts = self._storage.read_many(item._name for item, key in missing)
+        for (item, key), text in zip(missing, texts):
+            result = results[item] = data_class(item, text=text)
+            self._storage.store(item._name, key, result._data)
+        return [results[item] for item in items]
+
+    def query(self, query):
+        """Return sorted items matching name predicates of an invoice query.
+
+        The storage may narrow the items by predicates on their data too.
+        """
+        items = self._select({"company_name": query.company}) if query.company else self._snapshot().items
+        names = self._storage.select(query)
+        return sorted(item for item in items
+            if (names is None or item._name in names) and query.match_item(item))
+
+    def flush(self):
+        """Write back cached data."""
+        self._storage.flush()
 
     def last(self):
-        return max(iter(self), key=lambda item: item._name)
+        items = self._snapshot().items
+        if not items:
+            raise ItemNotFoundError("No {0} found.".format(self._item_name()))
+        return items[-1]
 
     def __contains__(self, selector):
         return bool(self._select(selector))
@@ -59,7 +252,7 @@ class List(object):
         if not items:
             raise ItemNotFoundError("{0} '{1}' not found.".format(self._item_class().__name__, selector))
         item = items[0]
-        log.debug("Found matching item: {0}".format(item))
+        log.debug("Found matching item: %s", item)
         return item
 
     def select(self, selector=None):
@@ -78,16 +271,29 @@ class List(object):
 
         This function specialcases string and int. Other specializations
         can be done in subclasses that should call super()._select() with
-        a dict, str or int argument.
+        a dict, str or int argument. Only the name and the attributes
+        found in item names can be selected.
         """
         if isinstance(selector, str):
             selector = {"name": selector}
         elif isinstance(selector, int):
             selector = {"number": selector}
-        log.debug("Selecting: {0}".format(selector))
+        log.debug("Selecting: %s", selector)
         assert isinstance(selector, dict)
-        return [item for item in self
-            if all(getattr(item, key) == selector[key] for key in selector)]
+        snapshot = self._snapshot()
+        unknown = set(selector) - set(snapshot.index) - {"name"}
+        if unknown:
+            raise DatabaseError("Cannot select {0} by {1}.".format(self._item_name(), ", ".join(sorted(unknown))))
+        items = snapshot.items
+        for key in selector:
+            if key == "name":
+                items = [snapshot.names[selector[key]]] if selector[key] in snapshot.names else []
+                break
+            if key in snapshot.index:
+                items = snapshot.index[key].get(selector[key], [])
+                break
+        return [item for item in items
+            if all((item._name if key == "name" else getattr(item, key)) == selector[key] for key in selector)]
 
     def new(self, name):
         """Create a new item in this list.
@@ -98,36 +304,78 @@ class List(object):
         
         Returns
         """
-        log.info("Creating {0}: {1}".format(self._item_name(), name))
+        log.info("Creating %s: %s", self._item_name(), name)
         if not self._regex.match(name):
             raise ItemNameCheckError("Name {0} doesn't match {1} regex.".format(name, self._item_name()))
         if name in self:
             raise ItemExistsError("Item {0} of type {1} already exists.".format(name, self._item_name()))
-        self._new(os.path.join(self._path, name))
+        self._new(name)
+        self._invalidate()
         return self[name]
 
-    def _new(self, path):
-        log.debug("Creating {0} file: {1}".format(self._item_name(), path))
-        stream = os.fdopen(os.open(path, os.O_WRONLY|os.O_EXCL|os.O_CREAT, 0o644), "w")
-        stream.write(self.data_template)
-        stream.close()
+    def write(self, name, text):
+        """Create an item with the given text or replace its text.
+
+        Returns True when the item was created or changed.
+        """
+        if not self._regex.match(name):
+            raise ItemNameCheckError("Name {0} doesn't match {1} regex.".format(name, self._item_name()))
+        if name in self._snapshot().names:
+            if self._storage.read(name) == text:
+                return False
+            log.debug("Replacing %s: %s", self._item_name(), name)
+            self._storage.write(name, text)
+        else:
+            self._new(name, text)
+        self.update([name])
+        return True
+
+    def _new(self, name, text=None):
+        log.debug("Creating %s: %s", self._item_name(), name)
+        try:
+            self._storage.create(name, self.data_template if text is None else text)
+        except FileExistsError:
+            raise ItemExistsError("Item {0} of type {1} already exists.".format(name, self._item_name()))
 
 class Item(object):
-    """Base class for database list items."""
-    def __init__(self, list_, **selector):
-        self._list = list_
-        self._selector = selector
-        self._postprocess()
-        self._name = self._list._template.format(**selector)
-        self._path = os.path.join(list_._path, self._name)
-        log.debug("{0!r}".format(self))
+    """Base class for database list items.
 
-    def _postprocess(self):
-        """Postprocess the _selector attribute.
+    Items keep the selector values in a tuple, the keys are shared by
+    items of the same list and strings are interned. The name is kept as found in the storage or
+    computed from the selector on first use, the path is computed when
+    needed. Subclasses must define __slots__ as well.
+    """
+    __slots__ = ("_list", "_keys", "_values", "_cached_name")
+
+    def __init__(self, list_, _name=None, **selector):
+        self._list = list_
+        self._postprocess(selector)
+        self._keys = list_._key_index(selector)
+        self._values = tuple(intern(value) if type(value) is str else value for value in selector.values())
+        self._cached_name = _name
+        log.debug("%r", self)
+
+    def _postprocess(self, selector):
+        """Postprocess the selector dict.
         
         Override in subclasses.
         """
 
+    @property
+    def _selector(self):
+        return dict(zip(self._keys, self._values))
+
+    @property
+    def _name(self):
+        name = self._cached_name
+        if name is None:
+            name = self._cached_name = self._list._template.format(**self._selector)
+        return name
+
+    @property
+    def _path(self):
+        return self._list._storage.path(self._name)
+
     def __lt__(self, other):
         return self._name < other._name
 
@@ -138,62 +386,142 @@ class Item(object):
         return self._name
 
     def __getattr__(self, key):
-        return self._selector[key]
+        if key.startswith("_"):
+            raise AttributeError(key)
+        return self._values[self._keys[key]]
 
     def delete(self):
-        log.info("Deleting: {0}".format(self))
-        path = self._path
-        newpath = path + "~"
-        log.debug("Renaming file {0} to {1}.".format(path, newpath))
-        assert os.path.exists(path)
-        os.rename(path, newpath)
+        log.info("Deleting: %s", self)
+        self._list._storage.remove(self._name)
+        self._list._invalidate()
+
+    def _key(self):
+        """Return storage key that changes whenever item data change."""
+        return self._list._storage.key(self._name)
 
     def data(self):
-        """Return item's data.
-       
-        Override in subclasses.
-        """
-        return self._data_class()(self)
+        """Return item's data."""
+        return self._list._data(self)
 
-    def _data_class(self):
+    @classmethod
+    def _data_class(cls):
         return Data
 
+_key_first = frozenset(string.ascii_uppercase)
+_key_chars = frozenset(string.ascii_letters + "-")
+
+FIELD, MULTIVALUE, UNKNOWN = range(3)
+
 class Data(object):
-    """Base class for database list item data objects."""
+    """Base class for database list item data objects.
+
+    Data files consist of 'Key: value' lines and '#' comments. Lines are
+    parsed in a single pass, keys are looked up in a table built once
+    per class.
+
+    While parsing and postprocessing, data are kept in a dict. Afterwards
+    the values are stored in a tuple with keys shared by all data objects
+    of the same layout, strings are interned and '_data' returns a new
+    dict.
+    """
+    __slots__ = ("_item", "_keys", "_values")
+    _version = 1
     _fields = []
     _multivalue_fields = []
-    _line_regex = re.compile(r"^([A-Z][a-zA-Z-]*):\s+(.*?)\s+$")
-    _comment_regex = re.compile(r"^\s*#")
 
-    def __init__(self, item):
+    def __init__(self, item, data=None, text=None):
         self._item = item
-        self._parse(open(self._item._path))
-        self._postprocess()
+        if data is None:
+            with profile.timer("data.parse"):
+                if text is not None:
+                    self._parse(io.StringIO(text))
+                else:
+                    with self._item._list._storage.open(self._item._name) as stream:
+                        self._parse(stream)
+                self._postprocess()
+            data = self._data
+        self._freeze(data)
+
+    @property
+    def _data(self):
+        if self._keys is None:
+            return self._values
+        return dict(zip(self._keys, self._values))
+
+    @_data.setter
+    def _data(self, data):
+        self._keys = None
+        self._values = data
+
+    def _freeze(self, data):
+        layouts = self._table("_layouts")
+        keys = tuple(data)
+        layout = layouts.get(keys)
+        if layout is None:
+            layout = layouts[keys] = dict((key, n) for n, key in enumerate(keys))
+        self._keys = layout
+        self._values = tuple(intern(value) if type(value) is str else value for value in data.values())
 
     def __getattr__(self, key):
-        return self._data[key]
+        if key.startswith("_"):
+            raise AttributeError(key)
+        keys = self._keys
+        if keys is None:
+            return self._values[key]
+        return self._values[keys[key]]
+
+    @classmethod
+    def _table(cls, name):
+        """Return a dict kept as class attribute 'name' of this very class."""
+        table = cls.__dict__.get(name)
+        if table is None:
+            table = {}
+            setattr(cls, name, table)
+        return table
+
+    @classmethod
+    def _key_table(cls):
+        """Return a dict of known file keys mapped to (data key, kind)."""
+        return cls._table("_key_lookup")
+
+    @classmethod
+    def _lookup_key(cls, key):
+        """Validate a file key and add it to the key table, return None if invalid."""
+        if not key or key[0] not in _key_first or not _key_chars.issuperset(key):
+            return None
+        name = key.lower().replace("-", "_")
+        if name in cls._fields:
+            kind = FIELD
+        elif name in cls._multivalue_fields:
+            kind = MULTIVALUE
+        else:
+            kind = UNKNOWN
+        entry = cls._key_table()[key] = name, kind
+        return entry
 
     def _parse(self, stream):
-        self._data = self._item._selector.copy()
+        data = self._data = self._item._selector
         for f in self._fields:
-            self._data[f] = None
+            data[f] = None
         for f in self._multivalue_fields:
-            self._data[f] = []
+            data[f] = []
+        keys = self._key_table()
         for n, line in enumerate(stream):
-            if self._comment_regex.match(line):
+            if line.lstrip().startswith("#"):
                 continue
-            match = self._line_regex.match(line)
-            if not match:
-                log.warning("Ignoring {0}:{1}: {2}".format(n, self._item._name, line))
+            key, colon, rest = line.partition(":")
+            entry = keys.get(key) or colon and self._lookup_key(key)
+            # The value must be surrounded by whitespace, at least the newline.
+            if not entry or len(rest) < 2 or not rest[0].isspace() or not rest[-1].isspace():
+                log.warning("Ignoring %s:%s: %s", n, self._item._name, line)
                 continue
-            key, value = match.groups()
-            key = key.lower().replace("-", "_")
-            if key in self._fields:
-                self._data[key] = value
-            elif key in self._multivalue_fields:
-                self._data[key].append(value)
+            name, kind = entry
+            if kind == FIELD:
+                data[name] = rest.strip()
+            elif kind == MULTIVALUE:
+                data[name].append(rest.strip())
             else:
-                log.warning("Key ignored: {0}".format(key))
+                log.warning("Key ignored: %s", name)
 
     def _postprocess(self):
         """Postprocess item data.
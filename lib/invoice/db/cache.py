@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+
+import os, pickle
+
+import logging
+log = logging.getLogger()
+
+from invoice import profile
+
+class DataCache(object):
+    """Persistent cache of parsed item data.
+
+    Entries are keyed by item name and validated by a stat key of the
+    data file, so that only changed files need to be parsed again. The
+    cache is stored as a single pickle file per list and only written
+    back when it has been modified. A cache written with a different
+    'version' is ignored.
+    """
+    def __init__(self, path, version=None):
+        self._path = path
+        self._version = version
+        self._entries = None
+        self._dirty = False
+
+    @staticmethod
+    def stat_key(stat):
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def _load(self):
+        if self._entries is not None:
+            return
+        try:
+            with open(self._path, "rb") as stream:
+                version, self._entries = pickle.load(stream)
+            if version != self._version:
+                log.debug("Ignoring outdated data cache: %s", self._path)
+                self._entries = {}
+            else:
+                log.debug("Loaded data cache: %s", self._path)
+        except FileNotFoundError:
+            self._entries = {}
+        except Exception as error:
+            log.warning("Ignoring broken data cache %s: %s", self._path, error)
+            self._entries = {}
+
+    def revalidate(self, keys):
+        """Drop entries not matching the 'keys' dict (name -> stat key)."""
+        self._load()
+        for name in list(self._entries):
+            if keys.get(name) != self._entries[name][0]:
+                del self._entries[name]
+                self._dirty = True
+
+    def get(self, name, key):
+        self._load()
+        entry = self._entries.get(name)
+        if entry is not None and entry[0] == key:
+            profile.count("data_cache.hit")
+            return entry[1]
+        profile.count("data_cache.miss")
+
+    def put(self, name, key, data):
+        self._load()
+        self._entries[name] = (key, data)
+        self._dirty = True
+
+    def discard(self, name):
+        self._load()
+        if self._entries.pop(name, None) is not None:
+            self._dirty = True
+
+    def clear(self):
+        """Drop all entries and remove the cache file."""
+        self._entries = {}
+        self._dirty = False
+        try:
+            os.remove(self._path)
+        except FileNotFoundError:
+            pass
+
+    def save(self):
+        if not self._dirty:
+            return
+        log.debug("Saving data cache: %s", self._path)
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        tmp_path = self._path + "~"
+        with open(tmp_path, "wb") as stream:
+            pickle.dump((self._version, self._entries), stream, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self._path)
+        self._dirty = False
@@ -1,11 +1,12 @@
 #!/usr/bin/python3
 
-import os, sys, re, time, datetime
+import os, sys, re, time, datetime, threading, collections
 
 import logging
 log = logging.getLogger()
 
 from invoice.db.base import *
+from invoice import profile
 
 class Companies(List):
     """Company list.
@@ -16,6 +17,7 @@ class Companies(List):
     Address -- company address, repeat to get multiple lines
     Number -- identification number
     Comment -- additional information that you want to see on the invoice
+    Template -- name of the invoice template to use for this customer
     """    
     _directory = "companies"
     _regex = re.compile("^(?P<name>[a-z0-9-]+)$")
@@ -26,15 +28,56 @@ Address:
 Address:
 Number:
 """
+    data_cache_size = 64
+
+    def __init__(self, *args, **kwargs):
+        super(Companies, self).__init__(*args, **kwargs)
+        self._memo = collections.OrderedDict()
+        self._memo_lock = threading.Lock()
+        self.hits = self.misses = 0
+
     def _item_class(self):
         return Company
 
+    def _data(self, item):
+        """Return company data, parsed data are kept in memory.
+
+        Up to 'data_cache_size' companies are kept, the least recently
+        used are dropped first. Entries are validated using storage keys
+        (modification time and size for files).
+        """
+        key = self._storage.key(item._name)
+        with self._memo_lock:
+            entry = self._memo.get(item._name)
+            if entry is not None and entry[0] == key:
+                self._memo.move_to_end(item._name)
+                self.hits += 1
+                profile.count("company_cache.hit")
+                return entry[1]
+            self.misses += 1
+            profile.count("company_cache.miss")
+        data = super(Companies, self)._data(item)
+        with self._memo_lock:
+            self._memo[item._name] = key, data
+            self._memo.move_to_end(item._name)
+            while len(self._memo) > self.data_cache_size:
+                self._memo.popitem(last=False)
+        return data
+
+    def cache_info(self):
+        """Return hits, misses and size of the company data cache."""
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._memo)}
+
 class Company(Item):
-    def _data_class(self):
+    __slots__ = ()
+
+    @classmethod
+    def _data_class(cls):
         return CompanyData
 
 class CompanyData(Data):
-    _fields = ["name", "number", "ic", "bank_account"]
+    __slots__ = ()
+    _fields = ["name", "number", "ic", "bank_account", "template"]
     _multivalue_fields = ["address", "comment"]
 
     def _postprocess(self):
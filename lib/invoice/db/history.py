@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+
+import os, re, concurrent.futures
+
+import logging
+log = logging.getLogger()
+
+from invoice.db.base import *
+
+class History(object):
+    """Database view spanning multiple years.
+
+    Takes a list of per-year databases, scans their directories
+    concurrently and skips years with no data.
+    """
+    def __init__(self, databases, jobs=None):
+        self._jobs = jobs
+        self.databases = [db for db, found in zip(databases, self._map(self._scan, databases)) if found]
+        self.years = [db.invoices._year for db in self.databases]
+        self.invoices = MergedList([db.invoices for db in self.databases])
+        self.companies = MergedList([db.companies for db in self.databases])
+
+    @staticmethod
+    def find_years(data_path):
+        """Return sorted list of years found under the data root."""
+        root = os.path.expanduser(data_path.split("{year}")[0])
+        return sorted(int(name) for name in os.listdir(root) if re.match(r"^[0-9]{4}$", name))
+
+    def _map(self, function, iterable):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._jobs) as executor:
+            return list(executor.map(function, iterable))
+
+    @staticmethod
+    def _scan(db):
+        try:
+            db.invoices._snapshot()
+            db.companies._snapshot()
+        except FileNotFoundError:
+            log.debug("No data for year %s.", db.invoices._year)
+            return False
+        return True
+
+    def data(self, items):
+        """Return data objects for items, parsed concurrently per year."""
+        groups = {}
+        for item in items:
+            groups.setdefault(item._list, []).append(item)
+        results = {}
+        for group in self._map(lambda group: zip(group, group[0]._list.data_many(group)), groups.values()):
+            results.update(group)
+        return [results[item] for item in items]
+
+    def flush(self):
+        for db in self.databases:
+            db.flush()
+
+class MergedList(object):
+    """Read-only view of the same list across multiple years."""
+    def __init__(self, lists):
+        self._lists = lists
+
+    def __iter__(self):
+        for list_ in self._lists:
+            yield from list_
+
+    def last(self):
+        for list_ in reversed(self._lists):
+            if list_._snapshot().items:
+                return list_.last()
+        raise ItemNotFoundError("No items found.")
+
+    def __contains__(self, selector):
+        return any(selector in list_ for list_ in self._lists)
+
+    def __getitem__(self, selector):
+        items = self.select(selector)
+        if len(items) != 1:
+            raise ItemNotFoundError("{0} items match '{1}'.".format(len(items), selector))
+        return items[0]
+
+    def query(self, query):
+        """Return items of all years matching an invoice query, see List.query()."""
+        return sorted(item for list_ in self._lists for item in list_.query(query))
+
+    def select(self, selector=None):
+        """Select items from all years, see List.select()."""
+        if selector is None:
+            return [self.last()]
+        return sorted(item for list_ in self._lists for item in list_._select(selector))
@@ -0,0 +1,99 @@
+#!/usr/bin/python3
+"""Reverse index of invoices by company across years.
+
+The index maps company names to invoice names per year and is kept in a
+pickle file together with the storage version of each year's invoice
+list. Only years whose version changed are scanned again, and only
+their item names are read, no invoices are parsed or instantiated.
+"""
+
+import os, pickle
+
+import logging
+log = logging.getLogger()
+
+class CompanyIndex(object):
+    """Company name to invoice names index spanning multiple years."""
+    _version = 1
+
+    def __init__(self, path=None):
+        self._path = path and os.path.expanduser(path)
+        self._years = {}
+        self._dirty = False
+        if self._path:
+            try:
+                with open(self._path, "rb") as stream:
+                    version, years = pickle.load(stream)
+                if version == self._version:
+                    self._years = years
+            except FileNotFoundError:
+                pass
+            except Exception as error:
+                log.warning("Ignoring broken company index %s: %s", self._path, error)
+
+    def refresh(self, lists):
+        """Bring the index up to date with invoice lists of all years."""
+        years = set()
+        for list_ in lists:
+            year = int(list_._year)
+            try:
+                version = list_._storage.version()
+            except FileNotFoundError:
+                continue
+            years.add(year)
+            entry = self._years.get(year)
+            if entry is None or entry[0] != version:
+                log.debug("Indexing companies: %s", year)
+                self._years[year] = (version, self._scan(list_))
+                self._dirty = True
+        for year in set(self._years) - years:
+            del self._years[year]
+            self._dirty = True
+
+    @staticmethod
+    def _scan(list_):
+        companies = {}
+        for name in list_._storage.scan(list_._regex):
+            company_name = list_._regex.match(name).group("company_name")
+            companies.setdefault(company_name, set()).add(name)
+        return companies
+
+    def update(self, list_, name, before, added):
+        """Record an invoice added to or removed from a list.
+
+        The change is applied only when the index was current at storage
+        version 'before', otherwise the year is scanned on next refresh.
+        """
+        year = int(list_._year)
+        entry = self._years.get(year)
+        if entry is None or entry[0] != before:
+            return
+        version, companies = entry
+        company_name = list_._regex.match(name).group("company_name")
+        names = companies.setdefault(company_name, set())
+        if added:
+            names.add(name)
+        else:
+            names.discard(name)
+            if not names:
+                del companies[company_name]
+        self._years[year] = (list_._storage.version(), companies)
+        self._dirty = True
+
+    def invoices(self, company_name):
+        """Return sorted (year, name) pairs of invoices issued to a company."""
+        return sorted((year, name) for year, (version, companies) in self._years.items()
+            for name in companies.get(company_name, ()))
+
+    def __contains__(self, company_name):
+        return any(company_name in companies for version, companies in self._years.values())
+
+    def save(self):
+        if not self._path or not self._dirty:
+            return
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        tmp_path = self._path + "~"
+        with open(tmp_path, "wb") as stream:
+            pickle.dump((self._version, self._years), stream, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self._path)
+        self._dirty = False
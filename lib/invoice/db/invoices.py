@@ -1,6 +1,6 @@
 #!/usr/bin/python3
 
-import os, sys, re, time, datetime
+import os, sys, re, time, datetime, functools
 
 import logging
 log = logging.getLogger()
@@ -21,7 +21,7 @@ class Invoices(List):
 Item: 
 """
     _directory = "income"
-    _regex = re.compile("^(?P<date>[0-9]{8})-(?P<number>[0-9]{3})-(?P<company_name>[a-z0-9-]+)$")
+    _regex = re.compile("^(?P<date>[0-9]{8})-(?P<number>[0-9]{3,})-(?P<company_name>[a-z0-9-]+)$")
     _template = "{date}-{number:03}-{company_name}"
 
     def _item_class(self):
@@ -43,34 +43,78 @@ Item:
     def new(self, company_name):
         if company_name not in self._db.companies:
             raise ItemNotFoundError("Company '{0}' not found.".format(company_name))
-        try:
-            number = max(item.number for item in self) + 1
-        except ValueError:
-            number = 1
+        number = self._storage.allocate(self._last_number)
+        while number in self._snapshot().index["number"]:
+            log.warning("Invoice number %s already used, sequence out of date.", number)
+            number = self._storage.allocate(self._last_number)
         date = time.strftime("%Y%m%d")
         name = self._template.format(**vars())
-        return super(Invoices, self).new(name)
+        before = self._storage.version()
+        item = super(Invoices, self).new(name)
+        self._update_index(name, before, True)
+        return item
+
+    def write(self, name, text):
+        before = self._storage.version()
+        added = name not in self._snapshot().names
+        changed = super(Invoices, self).write(name, text)
+        if added:
+            self._update_index(name, before, True)
+        return changed
+
+    def _update_index(self, name, before, added):
+        if self._db is not None and self._db.index is not None:
+            self._db.index.update(self, name, before, added)
+
+    def _last_number(self):
+        """Return the highest invoice number found in the list."""
+        return max(self._snapshot().index["number"], default=0)
 
 class Invoice(Item):
-    def _data_class(self):
+    __slots__ = ()
+
+    @classmethod
+    def _data_class(cls):
         return InvoiceData
 
-    def _postprocess(self):
-        self._selector["number"] = int(self.number)
+    def _postprocess(self, selector):
+        selector["number"] = int(selector["number"])
+
+    def delete(self):
+        before = self._list._storage.version()
+        super(Invoice, self).delete()
+        self._list._update_index(self._name, before, False)
+        self._list._storage.release(self.number, self._list._last_number)
+
+_date_regex = re.compile(r"^(\d{4})-?(\d{2})-?(\d{2})$")
+
+@functools.lru_cache(maxsize=4096)
+def parse_date(date):
+    """Parse YYYY-MM-DD or YYYYMMDD date, results are cached."""
+    match = _date_regex.match(date)
+    if not match:
+        raise ValueError("Bad date format: {0}".format(date))
+    return datetime.date(*(int(f) for f in match.groups()))
+
+def split_item(item):
+    """Split 'price: description' item, ';' is accepted as separator."""
+    colon = item.find(":")
+    semicolon = item.find(";")
+    separator = semicolon if colon < 0 or 0 <= semicolon < colon else colon
+    price = item[:separator]
+    digits = price[1:] if price.startswith("-") else price
+    if separator < 0 or not digits.isdecimal():
+        raise ValueError("Bad item format: {0}".format(item))
+    return sys.intern(item[separator+1:].lstrip()), int(price)
 
 class InvoiceData(Data):
+    __slots__ = ()
     _fields = ["due", "paid", "payment"]
     _multivalue_fields = ["item", "address", "note"]
-    _date_regex = re.compile(r"^(\d{4})-?(\d{2})-?(\d{2})$")
-    _item_regex = re.compile(r"^(-?\d+)[:;]\s*(.*)$")
     _number_template = "{year}{number:03}"
 
     def _parse_date(self, date):
-        match = self._date_regex.match(date)
-        if not match:
-            raise ValueError("Bad date format: {0}".format(date))
-        log.debug("Date match: {0}".format(match.groups()))
-        return datetime.date(*(int(f) for f in match.groups()))
+        return parse_date(date)
 
     def _postprocess(self):
         log.debug(self._data)
@@ -85,13 +129,7 @@ class InvoiceData(Data):
             number = self.number)
 
     def _postprocess_items(self):
-        items = []
-        for item in self.item:
-            match = self._item_regex.match(item)
-            if not match:
-                raise ValueError("Bad item format: {0}".format(item))
-            price, description = match.groups()
-            items.append((description, int(price)))
+        items = [split_item(item) for item in self._data["item"]]
         del self._data["item"]
         self._data["items"] = items
         self._data["sum"] = sum(item[1] for item in items)
@@ -108,7 +146,7 @@ class InvoiceData(Data):
                     raise ValueError("Bad due format: {0}".format(self.due))
         else:
             due = datetime.timedelta(14)
-        log.debug("Due: {0}".format(due))
+        log.debug("Due: %s", due)
         if isinstance(due, datetime.timedelta):
             due += date
         self._data["date"] = date
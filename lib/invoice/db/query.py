@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+"""Invoice queries.
+
+A query is split into predicates on item attributes taken from file
+names (date, company) and predicates on parsed data (paid, due, sum).
+Name predicates are evaluated first and only the remaining candidates
+are parsed, lazily, one by one. The SQLite storage evaluates all
+predicates in SQL on its indexed columns first.
+"""
+
+import datetime
+
+import logging
+log = logging.getLogger()
+
+from invoice.db.base import DatabaseError
+from invoice.db.invoices import parse_date
+
+def _name_date(date):
+    """Convert a date in the data file format to the file name format."""
+    if date is None:
+        return None
+    try:
+        return parse_date(date).isoformat().replace("-", "")
+    except ValueError:
+        raise DatabaseError("Bad date: {0}".format(date))
+
+class Query(object):
+    """Invoice query.
+
+    Keyword arguments:
+    date_from, date_to -- issue date range, YYYY-MM-DD or YYYYMMDD, inclusive
+    company -- company name
+    unpaid -- only invoices without a payment date
+    overdue -- only unpaid invoices past their due date
+    min_sum -- minimum invoice total
+    today -- reference date for 'overdue', defaults to today
+    """
+    def __init__(self, date_from=None, date_to=None, company=None,
+            unpaid=False, overdue=False, min_sum=None, today=None):
+        self.date_from = _name_date(date_from)
+        self.date_to = _name_date(date_to)
+        self.company = company
+        self.unpaid = unpaid or overdue
+        self.overdue = overdue
+        self.min_sum = min_sum
+        self.today = today or datetime.date.today()
+
+    def __bool__(self):
+        return bool(self.date_from or self.date_to or self.company or self.needs_data)
+
+    @property
+    def needs_data(self):
+        return bool(self.unpaid or self.min_sum is not None)
+
+    def match_item(self, item):
+        """Evaluate predicates on attributes parsed from the item name."""
+        return ((not self.date_from or item.date >= self.date_from) and
+            (not self.date_to or item.date <= self.date_to) and
+            (not self.company or item.company_name == self.company))
+
+    def match_data(self, data):
+        """Evaluate predicates on parsed item data."""
+        return ((not self.unpaid or not data.paid) and
+            (not self.overdue or data.due < self.today) and
+            (self.min_sum is None or data.sum >= self.min_sum))
+
+    def candidates(self, list_):
+        """Return sorted items matching name predicates without parsing them.
+
+        Storages keeping parsed data leave out items not matching the
+        data predicates as well.
+        """
+        return list_.query(self)
+
+    def items(self, list_):
+        """Generate matching items, parsing only the candidates if needed."""
+        for item in self.candidates(list_):
+            if not self.needs_data or self.match_data(item.data()):
+                yield item
+
+    def data(self, list_):
+        """Generate (item, data) pairs of matching items.
+
+        Data are only parsed for items matching the name predicates and
+        the pairs are produced one by one.
+        """
+        for item in self.candidates(list_):
+            data = item.data()
+            if self.match_data(data):
+                yield item, data
@@ -0,0 +1,555 @@
+#!/usr/bin/python3
+"""Storage backends for database lists.
+
+A storage keeps the text of list items (the 'Key: value' data files)
+and optionally their parsed data. Lists only talk to their storage, so
+the flat file layout can be replaced by other backends.
+"""
+
+import os, io, abc, fcntl, locale, pickle, sqlite3, datetime, threading
+
+import logging
+log = logging.getLogger()
+
+from invoice.db.cache import DataCache
+from invoice import profile
+
+class Storage(object, metaclass=abc.ABCMeta):
+    """Base class for list storage backends.
+
+    Item keys returned by scan() and key() change whenever the item
+    text changes, version() changes whenever items are added or removed.
+    """
+    @abc.abstractmethod
+    def version(self):
+        pass
+
+    @abc.abstractmethod
+    def scan(self, regex):
+        """Return a dict of names matching 'regex' mapped to item keys."""
+
+    @abc.abstractmethod
+    def key(self, name):
+        pass
+
+    def path(self, name):
+        """Return filesystem path of the item or None."""
+
+    def load(self, name, key):
+        """Return stored parsed data for the item if still valid."""
+
+    def store(self, name, key, data):
+        """Store parsed data for the item."""
+
+    def open(self, name):
+        return io.StringIO(self.read(name))
+
+    @abc.abstractmethod
+    def read(self, name):
+        pass
+
+    def read_many(self, names):
+        """Generate texts of many items."""
+        for name in names:
+            yield self.read(name)
+
+    @abc.abstractmethod
+    def create(self, name, text):
+        """Create a new item, raise FileExistsError if it exists."""
+
+    @abc.abstractmethod
+    def write(self, name, text):
+        """Create or replace an item."""
+
+    def write_many(self, texts):
+        """Replace many items, all at once where supported.
+
+        Takes (name, text) pairs.
+        """
+        for name, text in texts:
+            self.write(name, text)
+
+    def append(self, name, text):
+        self.write(name, self.read(name) + text)
+
+    @abc.abstractmethod
+    def remove(self, name):
+        pass
+
+    @abc.abstractmethod
+    def drop(self, names):
+        """Remove archived items without keeping backups.
+
+        Anything else kept with the list, like backups of older versions
+        or the sequence, stays.
+        """
+
+    def allocate(self, rebuild):
+        """Return the next number of the list sequence.
+
+        'rebuild' is called to find the last used number when the
+        sequence is missing. Storages should make allocation atomic.
+        """
+        return rebuild() + 1
+
+    def release(self, number, rebuild):
+        """Give back 'number' if it is the last one allocated.
+
+        Called when the item with the number is removed, the sequence is
+        set to the number returned by 'rebuild' so that it is used again.
+        """
+
+    def check_writable(self):
+        """Raise DatabaseError if items cannot be changed."""
+
+    def select(self, query):
+        """Return names of items that may match an invoice query.
+
+        Storages keeping parsed data can narrow the items to be checked,
+        None means all items have to be checked.
+        """
+        return None
+
+    def flush(self):
+        pass
+
+class FileStorage(Storage):
+    """One text file per item in a directory.
+
+    Parsed data is kept in an optional DataCache.
+    """
+    def __init__(self, path, cache=None):
+        self._path = path
+        self._cache = cache
+
+    def version(self):
+        return os.stat(self._path).st_mtime_ns
+
+    def scan(self, regex):
+        keys = {}
+        with profile.timer("storage.scan"), os.scandir(self._path) as entries:
+            for entry in entries:
+                if regex.match(entry.name):
+                    keys[entry.name] = self._cache and DataCache.stat_key(entry.stat())
+        profile.count("storage.scan.matches", len(keys))
+        if self._cache is not None:
+            self._cache.revalidate(keys)
+        return keys
+
+    def key(self, name):
+        return DataCache.stat_key(os.stat(self.path(name)))
+
+    def path(self, name):
+        return os.path.join(self._path, name)
+
+    def load(self, name, key):
+        if self._cache is not None:
+            return self._cache.get(name, key)
+
+    def store(self, name, key, data):
+        if self._cache is not None:
+            self._cache.put(name, key, data)
+
+    def open(self, name):
+        return open(self.path(name))
+
+    def read(self, name):
+        profile.count("storage.read")
+        with self.open(name) as stream:
+            return stream.read()
+
+    def read_many(self, names):
+        """Generate texts of many files read into a single reused buffer.
+
+        Texts are decoded and newlines translated like in text mode files.
+        """
+        encoding = locale.getpreferredencoding(False)
+        buffer = bytearray(1 << 16)
+        for name in names:
+            profile.count("storage.read")
+            length = 0
+            with open(self.path(name), "rb", buffering=0) as stream:
+                while True:
+                    if length == len(buffer):
+                        buffer.extend(bytes(len(buffer)))
+                    with memoryview(buffer) as view:
+                        count = stream.readinto(view[length:])
+                    if not count:
+                        break
+                    length += count
+            with memoryview(buffer) as view:
+                text = str(view[:length], encoding)
+            if "\r" in text:
+                text = text.replace("\r\n", "\n").replace("\r", "\n")
+            yield text
+
+    def create(self, name, text):
+        path = self.path(name)
+        log.debug("Creating file: %s", path)
+        with os.fdopen(os.open(path, os.O_WRONLY|os.O_EXCL|os.O_CREAT, 0o644), "w") as stream:
+            stream.write(text)
+
+    def write(self, name, text):
+        path = self.path(name)
+        with open(path + "~~", "w") as stream:
+            stream.write(text)
+        os.replace(path + "~~", path)
+
+    def write_many(self, texts):
+        """Write all texts to temporary files first and then replace the items."""
+        paths = []
+        try:
+            for name, text in texts:
+                path = self.path(name)
+                with open(path + "~~", "w") as stream:
+                    stream.write(text)
+                paths.append(path)
+        except BaseException:
+            for path in paths:
+                os.remove(path + "~~")
+            raise
+        for path in paths:
+            os.replace(path + "~~", path)
+
+    def append(self, name, text):
+        with open(self.path(name), "a") as stream:
+            stream.write(text)
+
+    def remove(self, name):
+        path = self.path(name)
+        newpath = path + "~"
+        log.debug("Renaming file %s to %s.", path, newpath)
+        assert os.path.exists(path)
+        os.rename(path, newpath)
+        if self._cache is not None:
+            self._cache.discard(name)
+
+    def drop(self, names):
+        for name in names:
+            path = self.path(name)
+            log.debug("Removing file: %s", path)
+            os.remove(path)
+            if self._cache is not None:
+                self._cache.discard(name)
+        kept = sorted(name for name in os.listdir(self._path) if not name.startswith(".") and not name.endswith("~"))
+        if kept:
+            log.warning("Keeping other files in %s: %s", self._path, ", ".join(kept))
+
+    sequence_name = ".sequence"
+
+    def allocate(self, rebuild):
+        """Allocate a number using a counter file locked with fcntl.
+
+        The file is updated in place so that the directory modification
+        time, and with it the list snapshot, stays the same.
+        """
+        path = os.path.join(self._path, self.sequence_name)
+        with os.fdopen(os.open(path, os.O_RDWR|os.O_CREAT, 0o644), "r+") as stream:
+            fcntl.flock(stream, fcntl.LOCK_EX)
+            try:
+                last = int(stream.read())
+            except ValueError:
+                log.info("Rebuilding sequence: %s", path)
+                last = rebuild()
+            number = last + 1
+            stream.seek(0)
+            stream.truncate()
+            stream.write("{0}\n".format(number))
+            stream.flush()
+            os.fsync(stream.fileno())
+        return number
+
+    def release(self, number, rebuild):
+        path = os.path.join(self._path, self.sequence_name)
+        try:
+            stream = os.fdopen(os.open(path, os.O_RDWR), "r+")
+        except FileNotFoundError:
+            return
+        with stream:
+            fcntl.flock(stream, fcntl.LOCK_EX)
+            try:
+                last = int(stream.read())
+            except ValueError:
+                return
+            if last != number:
+                return
+            log.info("Releasing number %s: %s", number, path)
+            stream.seek(0)
+            stream.truncate()
+            stream.write("{0}\n".format(rebuild()))
+            stream.flush()
+            os.fsync(stream.fileno())
+
+    def flush(self):
+        if self._cache is not None:
+            self._cache.save()
+
+schema = """
+CREATE TABLE IF NOT EXISTS lists (
+    directory TEXT NOT NULL,
+    year INTEGER NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (directory, year));
+CREATE TABLE IF NOT EXISTS records (
+    directory TEXT NOT NULL,
+    year INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    text TEXT NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0,
+    data BLOB,
+    date TEXT,
+    company_name TEXT,
+    due TEXT,
+    paid TEXT,
+    sum INTEGER,
+    PRIMARY KEY (directory, year, name));
+CREATE INDEX IF NOT EXISTS records_date ON records (directory, date);
+CREATE INDEX IF NOT EXISTS records_company_name ON records (directory, company_name);
+CREATE INDEX IF NOT EXISTS records_due ON records (directory, due);
+CREATE INDEX IF NOT EXISTS records_paid ON records (directory, paid);
+CREATE INDEX IF NOT EXISTS records_sum ON records (directory, sum);
+CREATE TABLE IF NOT EXISTS sequences (
+    directory TEXT NOT NULL,
+    year INTEGER NOT NULL,
+    value INTEGER NOT NULL,
+    PRIMARY KEY (directory, year));
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL);
+INSERT OR IGNORE INTO counters (name, value) SELECT 'version', coalesce(max(version), 0) FROM records;
+DROP INDEX IF EXISTS records_number;
+DROP TABLE IF EXISTS items;
+"""
+
+class Connection(object):
+    """SQLite database used from multiple threads.
+
+    SQLite connections must not be used by more threads at once, so each
+    thread gets its own connection. Statements and transactions are run
+    like with an sqlite3 connection.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            log.debug("Opening SQLite database: %s", self.path)
+            connection = self._local.connection = sqlite3.connect(self.path)
+        return connection
+
+    def execute(self, query, params=()):
+        return self._connection().execute(query, params)
+
+    def __enter__(self):
+        return self._connection().__enter__()
+
+    def __exit__(self, *exc_info):
+        return self._connection().__exit__(*exc_info)
+
+def connect(path):
+    """Open an SQLite database and create the schema."""
+    connection = Connection(os.path.expanduser(path))
+    connection._connection().executescript(schema)
+    return connection
+
+def _iso_date(date):
+    """Convert a YYYYMMDD date of item names to the column format."""
+    return "{0}-{1}-{2}".format(date[:4], date[4:6], date[6:])
+
+class SQLiteStorage(Storage):
+    """Items stored as rows of an SQLite database.
+
+    Besides the item text, rows hold the parsed data and indexed columns
+    (date, company_name, due, paid, sum) used to select invoices matching
+    a query in SQL. Parsed columns are filled in when an item is parsed
+    for the first time after it has been written, until then the item is
+    always selected.
+
+    Row versions, used as item keys, are taken from a counter shared by
+    all lists, so an item created again after removal never gets the key
+    of its former self.
+    """
+    _columns = ["date", "company_name", "due", "paid", "sum"]
+
+    def __init__(self, connection, list_):
+        self._connection = connection
+        self._list = list_
+        self._directory = list_._directory
+        self._year = int(list_._year)
+
+    def _execute(self, query, **params):
+        params.update(directory=self._directory, year=self._year)
+        return self._connection.execute(query, params)
+
+    def version(self):
+        row = self._execute("SELECT version FROM lists WHERE directory = :directory AND year = :year").fetchone()
+        if row is None:
+            raise FileNotFoundError("No {0} for year {1} in the SQLite database.".format(
+                self._directory, self._year))
+        return row[0]
+
+    def ensure(self):
+        """Register the list in the database."""
+        with self._connection:
+            self._execute("INSERT OR IGNORE INTO lists (directory, year) VALUES (:directory, :year)")
+
+    def _touch(self):
+        self._execute("UPDATE lists SET version = version + 1 WHERE directory = :directory AND year = :year")
+
+    def scan(self, regex):
+        return dict((name, version) for name, version in
+            self._execute("SELECT name, version FROM records WHERE directory = :directory AND year = :year")
+            if regex.match(name))
+
+    def _row(self, column, name):
+        row = self._execute("SELECT {0} FROM records WHERE directory = :directory AND year = :year AND name = :name"
+            .format(column), name=name).fetchone()
+        if row is None:
+            raise FileNotFoundError("Item not found: {0}".format(name))
+        return row[0]
+
+    def key(self, name):
+        return self._row("version", name)
+
+    def load(self, name, key):
+        row = self._execute("SELECT data FROM records WHERE directory = :directory AND year = :year"
+            " AND name = :name AND version = :version", name=name, version=key).fetchone()
+        if row is not None and row[0] is not None:
+            return pickle.loads(row[0])
+
+    def store(self, name, key, data):
+        values = {}
+        for column in self._columns:
+            value = data.get(column)
+            if isinstance(value, datetime.date):
+                value = value.isoformat()
+            values[column] = value
+        with self._connection:
+            self._execute("UPDATE records SET data = :data, {0}"
+                " WHERE directory = :directory AND year = :year AND name = :name AND version = :version"
+                .format(", ".join("{0} = :{0}".format(column) for column in self._columns)),
+                data=pickle.dumps(data, pickle.HIGHEST_PROTOCOL), name=name, version=key, **values)
+
+    def select(self, query):
+        conditions = []
+        params = {}
+        if query.date_from:
+            conditions.append("date >= :date_from")
+            params["date_from"] = _iso_date(query.date_from)
+        if query.date_to:
+            conditions.append("date <= :date_to")
+            params["date_to"] = _iso_date(query.date_to)
+        if query.company:
+            conditions.append("company_name = :company")
+            params["company"] = query.company
+        if query.unpaid:
+            conditions.append("(paid IS NULL OR paid = '')")
+        if query.overdue:
+            conditions.append("due < :today")
+            params["today"] = query.today.isoformat()
+        if query.min_sum is not None:
+            conditions.append("sum >= :min_sum")
+            params["min_sum"] = query.min_sum
+        if not conditions:
+            return None
+        profile.count("storage.select")
+        return set(name for name, in self._execute("SELECT name FROM records"
+            " WHERE directory = :directory AND year = :year AND (data IS NULL OR ({0}))"
+            .format(" AND ".join(conditions)), **params))
+
+    def read(self, name):
+        return self._row("text", name)
+
+    def _next_version(self):
+        self._connection.execute("UPDATE counters SET value = value + 1 WHERE name = 'version'")
+        return self._connection.execute("SELECT value FROM counters WHERE name = 'version'").fetchone()[0]
+
+    def create(self, name, text):
+        try:
+            with self._connection:
+                self._execute("INSERT INTO records (directory, year, name, text, version)"
+                    " VALUES (:directory, :year, :name, :text, :version)",
+                    name=name, text=text, version=self._next_version())
+                self._touch()
+        except sqlite3.IntegrityError:
+            raise FileExistsError("Item exists: {0}".format(name))
+
+    def _write(self, name, text):
+        version = self._next_version()
+        cursor = self._execute("UPDATE records SET text = :text, version = :version, data = NULL"
+            " WHERE directory = :directory AND year = :year AND name = :name", name=name, text=text, version=version)
+        if not cursor.rowcount:
+            self._execute("INSERT INTO records (directory, year, name, text, version)"
+                " VALUES (:directory, :year, :name, :text, :version)", name=name, text=text, version=version)
+            self._touch()
+
+    def write(self, name, text):
+        with self._connection:
+            self._write(name, text)
+
+    def write_many(self, texts):
+        with self._connection:
+            for name, text in texts:
+                self._write(name, text)
+
+    def remove(self, name):
+        with self._connection:
+            self._execute("DELETE FROM records WHERE directory = :directory AND year = :year AND name = :name",
+                name=name)
+            self._touch()
+
+    def drop(self, names):
+        with self._connection:
+            for name in names:
+                self._execute("DELETE FROM records WHERE directory = :directory AND year = :year AND name = :name",
+                    name=name)
+            self._touch()
+
+    def allocate(self, rebuild):
+        with self._connection:
+            # Take the write lock before reading the sequence.
+            self._connection.execute("BEGIN IMMEDIATE")
+            row = self._execute("SELECT value FROM sequences WHERE directory = :directory AND year = :year").fetchone()
+            if row is None:
+                log.info("Rebuilding sequence: %s/%s", self._year, self._directory)
+                number = rebuild() + 1
+                self._execute("INSERT INTO sequences (directory, year, value) VALUES (:directory, :year, :value)",
+                    value=number)
+            else:
+                number = row[0] + 1
+                self._execute("UPDATE sequences SET value = :value WHERE directory = :directory AND year = :year",
+                    value=number)
+        return number
+
+    def release(self, number, rebuild):
+        with self._connection:
+            self._connection.execute("BEGIN IMMEDIATE")
+            row = self._execute("SELECT value FROM sequences WHERE directory = :directory AND year = :year").fetchone()
+            if row is not None and row[0] == number:
+                log.info("Releasing number %s: %s/%s", number, self._year, self._directory)
+                self._execute("UPDATE sequences SET value = :value WHERE directory = :directory AND year = :year",
+                    value=rebuild())
+
+    @staticmethod
+    def years(connection):
+        return [year for year, in connection.execute("SELECT DISTINCT year FROM lists ORDER BY year")]
+
+def sync(source, target, regex):
+    """Make target storage hold the same items as source.
+
+    Returns numbers of written and removed items.
+    """
+    source_names = source.scan(regex)
+    target_names = target.scan(regex)
+    written = removed = 0
+    for name in sorted(source_names):
+        text = source.read(name)
+        if name not in target_names or target.read(name) != text:
+            target.write(name, text)
+            written += 1
+    for name in sorted(set(target_names) - set(source_names)):
+        target.remove(name)
+        removed += 1
+    return written, removed
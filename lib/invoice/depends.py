@@ -0,0 +1,64 @@
+#!/usr/bin/python3
+
+import os, json, hashlib
+
+import logging
+log = logging.getLogger()
+
+class Fingerprints(object):
+    """Input fingerprints of generated files.
+
+    A fingerprint is a hash over paths, modification times and sizes of
+    all files a target was generated from, and over any additional keys
+    identifying other inputs. The fingerprints of all
+    targets in a directory are kept in a single JSON file.
+    """
+    def __init__(self, path):
+        self._path = path
+        self._stats = {}
+        self._dirty = False
+        try:
+            with open(path) as stream:
+                self._entries = json.load(stream)
+        except FileNotFoundError:
+            self._entries = {}
+        except ValueError as error:
+            log.warning("Ignoring broken fingerprint file %s: %s", path, error)
+            self._entries = {}
+
+    def _stat(self, path):
+        try:
+            return self._stats[path]
+        except KeyError:
+            try:
+                stat = os.stat(path)
+                result = "{0}:{1}".format(stat.st_mtime_ns, stat.st_size)
+            except FileNotFoundError:
+                result = "-"
+            self._stats[path] = result
+            return result
+
+    def compute(self, paths, keys=()):
+        digest = hashlib.sha1()
+        for path in paths:
+            digest.update("{0}\0{1}\0".format(path, self._stat(path)).encode("utf-8"))
+        for key in keys:
+            digest.update("{0!r}\0".format(key).encode("utf-8"))
+        return digest.hexdigest()
+
+    def is_current(self, target, fingerprint):
+        return (self._entries.get(os.path.basename(target)) == fingerprint
+            and os.path.exists(target))
+
+    def update(self, target, fingerprint):
+        self._entries[os.path.basename(target)] = fingerprint
+        self._dirty = True
+
+    def save(self):
+        if not self._dirty:
+            return
+        tmp_path = self._path + "~"
+        with open(tmp_path, "w") as stream:
+            json.dump(self._entries, stream, indent=0, sort_keys=True)
+        os.replace(tmp_path, self._path)
+        self._dirty = False
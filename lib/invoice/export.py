@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+"""Streaming export of invoice data.
+
+Records are produced and written one by one, so memory use doesn't
+depend on the number of exported invoices.
+"""
+
+import json, csv, datetime
+
+import logging
+log = logging.getLogger()
+
+csv_fields = ["name", "number", "date", "due", "paid", "payment", "sum", "company_name", "items", "notes"]
+
+def records(items):
+    """Generate export records from database items, parsing them lazily.
+
+    Items already parsed can be given as (item, data) pairs.
+    """
+    for item in items:
+        if isinstance(item, tuple):
+            item, data = item
+        else:
+            data = item.data()
+        data = data._data
+        record = dict(data)
+        record["name"] = item._name
+        if "items" in record:
+            record["items"] = [{"description": description, "price": price}
+                for description, price in record["items"]]
+        yield record
+
+def _json_default(value):
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    raise TypeError("Cannot serialize {0!r}.".format(value))
+
+def write_jsonl(stream, records):
+    for record in records:
+        stream.write(json.dumps(record, default=_json_default, ensure_ascii=False, sort_keys=True))
+        stream.write("\n")
+
+def write_csv(stream, records):
+    writer = csv.DictWriter(stream, csv_fields, extrasaction="ignore")
+    writer.writeheader()
+    for record in records:
+        row = dict(record)
+        row["items"] = "\n".join("{price}: {description}".format(**item) for item in record.get("items", []))
+        row["notes"] = "\n".join(record.get("notes", []))
+        writer.writerow(row)
+
+def write_yaml(stream, records):
+    """Write records as a YAML sequence, one document fragment per record.
+
+    This requires PyYAML.
+    """
+    import yaml
+    empty = True
+    for record in records:
+        stream.write(yaml.safe_dump([record], default_flow_style=False, allow_unicode=True))
+        empty = False
+    if empty:
+        stream.write("[]\n")
+
+formats = {
+    "jsonl": write_jsonl,
+    "csv": write_csv,
+    "yaml": write_yaml,
+}
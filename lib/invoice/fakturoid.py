@@ -0,0 +1,368 @@
+#!/usr/bin/python3
+"""Import of companies and invoices from Fakturoid.
+
+Pages of the subjects and invoices endpoints of the Fakturoid API are
+fetched over a single keep-alive session by a bounded pool of threads,
+failed requests are retried with exponential backoff. Records of each
+page are written as data files as soon as the page arrives. A cursor is
+saved after every page, an interrupted import continues with the next
+page and a finished one makes the next import ask only for records
+updated since.
+
+Subjects become companies of the importing year, invoices are written to
+the year they were issued in, together with their company. The cursor
+keeps Fakturoid ids mapped to item names, so updated records replace the
+files they were imported to. Subjects never replace companies that were
+not imported from them.
+
+Invoices are numbered by the local sequence, not by Fakturoid. Invoices
+that need a number, new ones or ones moved to another year, are kept in
+a pending file next to the cursor until all pages arrive, then they are
+numbered in the order they were issued and written.
+
+This requires the requests library.
+"""
+
+import os, re, time, json, decimal, unicodedata, collections, concurrent.futures
+
+import logging
+log = logging.getLogger()
+
+import invoice.profile
+
+default_url = "https://app.fakturoid.cz/api/v2"
+endpoints = ("subjects", "invoices")
+
+class FakturoidError(Exception):
+    pass
+
+class Client(object):
+    """Fakturoid API client with a pooled session."""
+    def __init__(self, url, slug, username, key, jobs=4, retries=5, backoff=1.0, timeout=30):
+        import requests, requests.adapters
+        self._requests = requests
+        self._url = "{0}/accounts/{1}/".format(url.rstrip("/"), slug)
+        self._jobs = max(jobs, 1)
+        self._retries = retries
+        self._backoff = backoff
+        self._timeout = timeout
+        self._session = requests.Session()
+        self._session.auth = (username, key)
+        self._session.headers["User-Agent"] = "invoice ({0})".format(username)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self._jobs)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+    def close(self):
+        self._session.close()
+
+    def get(self, endpoint, page, since=None):
+        """Return records of a page, retrying on errors and rate limiting."""
+        params = {"page": page}
+        if since:
+            params["updated_since"] = since
+        url = "{0}{1}.json".format(self._url, endpoint)
+        for attempt in range(self._retries + 1):
+            delay = self._backoff * 2 ** attempt
+            invoice.profile.count("fakturoid.request")
+            try:
+                with invoice.profile.timer("fakturoid.get"):
+                    response = self._session.get(url, params=params, timeout=self._timeout)
+            except self._requests.RequestException as error:
+                failure = error
+            else:
+                if response.status_code == 429 or response.status_code >= 500:
+                    failure = "HTTP {0}".format(response.status_code)
+                    retry_after = response.headers.get("Retry-After", "")
+                    if retry_after.isdigit():
+                        delay = int(retry_after)
+                elif response.status_code >= 400:
+                    raise FakturoidError("{0} page {1}: HTTP {2} {3}".format(
+                        endpoint, page, response.status_code, response.reason))
+                else:
+                    try:
+                        return response.json()
+                    except ValueError as error:
+                        raise FakturoidError("{0} page {1}: {2}".format(endpoint, page, error))
+            if attempt == self._retries:
+                raise FakturoidError("{0} page {1}: {2}".format(endpoint, page, failure))
+            log.warning("Fetching %s page %s failed, retrying in %s s: %s", endpoint, page, delay, failure)
+            time.sleep(delay)
+
+    def pages(self, endpoint, first=1, since=None):
+        """Generate (page, records) pairs in order until an empty page.
+
+        Up to 'jobs' pages are requested ahead of the one being processed.
+        """
+        pending = collections.deque()
+        page = first
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._jobs) as executor:
+            try:
+                while True:
+                    while len(pending) < self._jobs:
+                        pending.append((page, executor.submit(self.get, endpoint, page, since)))
+                        page += 1
+                    number, future = pending.popleft()
+                    records = future.result()
+                    if not records:
+                        return
+                    yield number, records
+            finally:
+                for number, future in pending:
+                    future.cancel()
+
+def slugify(text):
+    """Return a company name made of lowercase ASCII letters, digits and dashes."""
+    text = unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode("ascii")
+    return re.sub("[^a-z0-9]+", "-", text.lower()).strip("-")
+
+def _date(value):
+    """Return YYYY-MM-DD part of an API date or time."""
+    return value[:10] if value else None
+
+def company_text(subject):
+    """Return company data file text for a subject."""
+    lines = ["Name: {0}".format(subject["name"])]
+    city = " ".join(part for part in (subject.get("zip"), subject.get("city")) if part)
+    for part in subject.get("street"), subject.get("street2"), city:
+        if part:
+            lines.append("Address: {0}".format(part))
+    if subject.get("country") and subject["country"] != "CZ":
+        lines.append("Address: {0}".format(subject["country"]))
+    if subject.get("registration_no"):
+        lines.append("Number: {0}".format(subject["registration_no"]))
+    if subject.get("vat_no"):
+        lines.append("Comment: DIČ: {0}".format(subject["vat_no"]))
+    if subject.get("bank_account"):
+        lines.append("Bank-Account: {0}".format(subject["bank_account"]))
+    return "".join(line + "\n" for line in lines)
+
+def invoice_text(record):
+    """Return invoice data file text for an invoice record.
+
+    Item prices are whole numbers, totals of lines are rounded.
+    """
+    lines = []
+    for line in record.get("lines") or ():
+        quantity = decimal.Decimal(str(line.get("quantity") or 1))
+        unit_price = decimal.Decimal(str(line.get("unit_price") or 0))
+        price = (quantity * unit_price).to_integral_value(decimal.ROUND_HALF_UP)
+        if price != quantity * unit_price:
+            log.warning("Rounding price of %s in invoice %s to %s.", line.get("name"), record.get("number"), price)
+        name = " ".join((line.get("name") or "").split())
+        if quantity != 1:
+            name = "{0} ({1:f} {2} × {3:f})".format(name, quantity.normalize(), line.get("unit_name") or "",
+                unit_price.normalize()).replace("  ", " ")
+        lines.append("Item: {0}: {1}".format(price, name))
+    if not lines:
+        lines.append("Item: 0: ")
+    if record.get("due_on"):
+        lines.append("Due: {0}".format(_date(record["due_on"])))
+    if record.get("paid_at") or record.get("paid_on"):
+        lines.append("Paid: {0}".format(_date(record.get("paid_on") or record["paid_at"])))
+    if record.get("payment_method") == "cash":
+        lines.append("Payment: cash")
+    for note in (record.get("note") or "").splitlines():
+        if note.strip():
+            lines.append("Note: {0}".format(note.strip()))
+    return "".join(line + "\n" for line in lines)
+
+class Importer(object):
+    """Writer of Fakturoid records to the databases.
+
+    Takes the client, a function returning the database of a year, the
+    importing year and the cursor file path.
+    """
+    def __init__(self, client, database, year, cursor_path):
+        self._client = client
+        self._database = database
+        self._databases = {}
+        self._year = int(year)
+        self._cursor_path = cursor_path
+        self._cursor = {}
+        if os.path.exists(cursor_path):
+            with open(cursor_path) as stream:
+                self._cursor = json.load(stream)
+        self._companies = self._cursor.setdefault("company_names", {})
+        self._invoices = self._cursor.setdefault("invoice_names", {})
+        self._pending_path = cursor_path + ".pending"
+        self._pending = []
+        self._pending_keys = set(str(record["id"]) for record in self._read_pending())
+        self._texts = {}
+        self.counts = collections.Counter()
+
+    def reset(self):
+        """Forget update times and pages to import everything again, keeping the id mapping."""
+        for endpoint in endpoints:
+            self._cursor.pop(endpoint, None)
+
+    def _save(self):
+        tmp_path = self._cursor_path + "~"
+        os.makedirs(os.path.dirname(self._cursor_path), exist_ok=True)
+        with open(tmp_path, "w") as stream:
+            json.dump(self._cursor, stream, indent=1, sort_keys=True)
+        os.replace(tmp_path, self._cursor_path)
+
+    def _read_pending(self):
+        """Return pending invoice records, the last version of each."""
+        records = {}
+        if os.path.exists(self._pending_path):
+            with open(self._pending_path) as stream:
+                for line in stream:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Blank lines or the end of an interrupted write.
+                        continue
+                    records[record["id"]] = record
+        return list(records.values())
+
+    def _save_pending(self):
+        """Append pending records of a page, before the cursor moves past it."""
+        if self._pending:
+            with open(self._pending_path, "a") as stream:
+                stream.write("".join("\n" + json.dumps(record, sort_keys=True) for record in self._pending))
+            del self._pending[:]
+
+    def run(self):
+        """Import subjects and then invoices, returns counts of written records."""
+        try:
+            for endpoint in endpoints:
+                self._import(endpoint, getattr(self, "_write_" + endpoint[:-1]))
+        finally:
+            self._client.close()
+        self._write_pending()
+        return self.counts
+
+    def _import(self, endpoint, write):
+        state = self._cursor.get(endpoint) or {}
+        since = state.get("since")
+        latest = state.get("latest") or since
+        first = state.get("page", 0) + 1
+        if first > 1:
+            log.info("Resuming import of %s at page %s.", endpoint, first)
+        for page, records in self._client.pages(endpoint, first, since):
+            for record in records:
+                write(record)
+                self.counts[endpoint] += 1
+                if record.get("updated_at") and (latest is None or record["updated_at"] > latest):
+                    latest = record["updated_at"]
+            self._save_pending()
+            self._cursor[endpoint] = {"since": since, "latest": latest, "page": page}
+            self._save()
+        self._cursor[endpoint] = {"since": latest}
+        self._save()
+
+    def _write_subject(self, subject):
+        key = str(subject["id"])
+        name = self._companies.get(key)
+        if name is None:
+            companies = self._db(self._year).companies
+            name = slugify(subject.get("name") or "") or "company"
+            if name in self._companies.values() or name in companies:
+                name = "{0}-{1}".format(name, key)
+            if name in companies:
+                raise FakturoidError("Subject {0} would replace company {1}.".format(key, name))
+            self._companies[key] = name
+        text = self._texts[name] = company_text(subject)
+        self._write(self._db(self._year).companies, name, text)
+
+    def _write_invoice(self, record):
+        key = str(record["id"])
+        if not record.get("issued_on"):
+            log.warning("Skipping invoice %s without issue date.", record.get("number"))
+            self.counts["skipped"] += 1
+            return
+        name = self._name(record)
+        if name is None or key in self._pending_keys:
+            self._pending.append(record)
+            self._pending_keys.add(key)
+        else:
+            self._write_record(record, name)
+
+    def _write_pending(self):
+        """Number pending invoices in the order they were issued and write them.
+
+        Names are saved in the cursor before writing, so writing again
+        after an interruption replaces the same files.
+        """
+        records = sorted(self._read_pending(), key=lambda record: (record["issued_on"], record["id"]))
+        if not records:
+            return
+        for record in records:
+            key = str(record["id"])
+            if self._name(record) is None:
+                if key in self._invoices:
+                    self._remove(self._invoices.pop(key))
+                date = record["issued_on"].replace("-", "")
+                list_ = self._db(date[:4]).invoices
+                self._invoices[key] = list_._template.format(date=date, number=self._number(list_),
+                    company_name=self._company(record))
+        self._save()
+        for record in records:
+            self._write_record(record, self._name(record))
+        os.remove(self._pending_path)
+        self._pending_keys.clear()
+
+    def _name(self, record):
+        """Return the name of an imported invoice, it keeps its number within the year.
+
+        Returns None for invoices that need a number.
+        """
+        company_name = self._company(record)
+        name = self._invoices.get(str(record["id"]))
+        date = record["issued_on"].replace("-", "")
+        match = name and self._db(name[:4]).invoices._regex.match(name)
+        if match and match.group("date")[:4] == date[:4]:
+            return self._db(date[:4]).invoices._template.format(date=date, number=int(match.group("number")),
+                company_name=company_name)
+
+    def _write_record(self, record, name):
+        """Write an invoice with its company, the renamed invoice is removed after."""
+        key = str(record["id"])
+        db = self._db(name[:4])
+        company_name = self._company(record)
+        if company_name not in db.companies:
+            self._write(db.companies, company_name, self._company_text(company_name))
+        self._write(db.invoices, name, invoice_text(record))
+        old_name, self._invoices[key] = self._invoices.get(key), name
+        if old_name and old_name != name:
+            self._remove(old_name)
+
+    def _db(self, year):
+        year = int(year)
+        if year not in self._databases:
+            self._databases[year] = self._database(year)
+        return self._databases[year]
+
+    def _company(self, record):
+        """Return company name of an invoice, the subject must be imported."""
+        name = self._companies.get(str(record.get("subject_id")))
+        if name is None:
+            raise FakturoidError("Invoice {0} of unknown subject {1}.".format(
+                record.get("number"), record.get("subject_id")))
+        return name
+
+    def _company_text(self, name):
+        """Return text of a company for another year."""
+        if name not in self._texts:
+            self._texts[name] = self._db(self._year).companies._storage.read(name)
+        return self._texts[name]
+
+    def _number(self, list_):
+        """Allocate the next number of the local sequence."""
+        used = list_._snapshot().index["number"]
+        number = list_._storage.allocate(list_._last_number)
+        while number in used:
+            number = list_._storage.allocate(list_._last_number)
+        return number
+
+    def _remove(self, name):
+        db = self._db(name[:4])
+        if name in db.invoices:
+            log.info("Removing renamed invoice: %s", name)
+            db.invoices[name].delete()
+
+    def _write(self, list_, name, text):
+        if list_.write(name, text):
+            self.counts["written"] += 1
@@ -0,0 +1,744 @@
+#!/usr/bin/python3
+"""Native PDF rendering of the standard invoice layout.
+
+A small PDF writer using the standard Helvetica fonts, so no fonts are
+embedded and no TeX installation is needed. Text is encoded in cp1250
+with glyph names given for characters missing in WinAnsiEncoding so that
+Czech and other central European texts are displayed correctly.
+
+render_invoice() follows the layout of templates/invoice.tex.
+"""
+
+import os, re, zlib, struct, unicodedata
+
+import logging
+log = logging.getLogger()
+
+encoding = "cp1250"
+
+# Glyphs of cp1250 characters that differ from WinAnsiEncoding.
+_glyphs = {
+    "Ś": "Sacute", "Ť": "Tcaron", "Ź": "Zacute", "ś": "sacute", "ť": "tcaron", "ź": "zacute",
+    "ˇ": "caron", "˘": "breve", "Ł": "Lslash", "Ą": "Aogonek", "Ş": "Scedilla", "Ż": "Zdotaccent",
+    "˛": "ogonek", "ł": "lslash", "ą": "aogonek", "ş": "scedilla", "Ľ": "Lcaron", "˝": "hungarumlaut",
+    "ľ": "lcaron", "ż": "zdotaccent", "Ŕ": "Racute", "Ă": "Abreve", "Ĺ": "Lacute", "Ć": "Cacute",
+    "Č": "Ccaron", "Ę": "Eogonek", "Ě": "Ecaron", "Ď": "Dcaron", "Đ": "Dcroat", "Ń": "Nacute",
+    "Ň": "Ncaron", "Ő": "Ohungarumlaut", "Ř": "Rcaron", "Ů": "Uring", "Ű": "Uhungarumlaut",
+    "Ţ": "Tcommaaccent", "ŕ": "racute", "ă": "abreve", "ĺ": "lacute", "ć": "cacute", "č": "ccaron",
+    "ę": "eogonek", "ě": "ecaron", "ď": "dcaron", "đ": "dcroat", "ń": "nacute", "ň": "ncaron",
+    "ő": "ohungarumlaut", "ř": "rcaron", "ů": "uring", "ű": "uhungarumlaut", "ţ": "tcommaaccent",
+    "˙": "dotaccent",
+}
+
+def _differences():
+    codes = sorted((char.encode(encoding)[0], glyph) for char, glyph in _glyphs.items())
+    return "[" + " ".join("{0} /{1}".format(code, glyph) for code, glyph in codes) + "]"
+
+# Advance widths of ASCII characters 32-126 in 1/1000 of the font size.
+_widths = {
+    "Helvetica": [278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278, 278,
+        556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584, 584, 556,
+        1015, 667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833, 722, 778,
+        667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 278, 278, 278, 469, 556,
+        333, 556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833, 556, 556,
+        556, 556, 333, 500, 278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584],
+    "Helvetica-Bold": [278, 333, 474, 556, 556, 889, 722, 238, 333, 333, 389, 584, 278, 333, 278, 278,
+        556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 333, 333, 584, 584, 584, 611,
+        975, 722, 722, 722, 722, 667, 611, 778, 722, 278, 556, 722, 611, 833, 722, 778,
+        667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 333, 278, 333, 584, 556,
+        333, 556, 611, 556, 611, 556, 333, 611, 611, 278, 278, 556, 278, 889, 611, 611,
+        611, 611, 389, 556, 333, 611, 556, 778, 556, 556, 500, 389, 280, 389, 584],
+}
+
+def text_width(text, font, size):
+    """Return approximate width of text, accented letters use the width of the base letter."""
+    widths = _widths[font]
+    total = 0
+    for char in text:
+        if not " " <= char <= "~":
+            char = unicodedata.normalize("NFD", char)[0]
+        total += widths[ord(char) - 32] if " " <= char <= "~" else 556
+    return total * size / 1000
+
+def _string(text):
+    data = text.encode(encoding, "replace")
+    return b"(" + data.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)") + b")"
+
+class Page(object):
+    """Page content built from text, lines and images."""
+    def __init__(self, document):
+        self._document = document
+        self._content = []
+
+    def text(self, x, y, text, size=10, bold=False, align="left"):
+        font = "Helvetica-Bold" if bold else "Helvetica"
+        if align != "left":
+            width = text_width(text, font, size)
+            x -= width if align == "right" else width / 2
+        self._content.append(b"BT /" + self._document.font(font) + b" %.2f Tf %.2f %.2f Td " % (size, x, y)
+            + _string(text) + b" Tj ET")
+
+    def line(self, x1, y1, x2, y2, width=0.4):
+        self._content.append(b"%.2f w %.2f %.2f m %.2f %.2f l S" % (width, x1, y1, x2, y2))
+
+    def image(self, image, x, y, width, height):
+        self._content.append(b"q %.2f 0 0 %.2f %.2f %.2f cm /%s Do Q" % (width, height, x, y,
+            self._document.image(image)))
+
+    def content(self):
+        return b"\n".join(self._content)
+
+class Document(object):
+    """PDF document with A4 pages using standard fonts."""
+    width, height = 595.28, 841.89
+
+    def __init__(self):
+        self.pages = []
+        self._fonts = {}
+        self._images = {}
+
+    def add_page(self):
+        page = Page(self)
+        self.pages.append(page)
+        return page
+
+    def font(self, name):
+        return self._fonts.setdefault(name, "F{0}".format(len(self._fonts) + 1).encode("ascii"))
+
+    def image(self, image):
+        return self._images.setdefault(image, "I{0}".format(len(self._images) + 1).encode("ascii"))
+
+    def write(self):
+        """Return the document as bytes."""
+        objects = []
+        def add(data):
+            objects.append(data)
+            return len(objects)
+        def stream(dictionary, data):
+            return (b"<< " + dictionary + b" /Length %d >>\nstream\n" % len(data)) + data + b"\nendstream"
+
+        catalog = add(None)
+        pages = add(None)
+        font_refs = b" ".join(b"/%s %d 0 R" % (key, add(
+            b"<< /Type /Font /Subtype /Type1 /BaseFont /" + name.encode("ascii")
+            + b" /Encoding << /Type /Encoding /BaseEncoding /WinAnsiEncoding /Differences "
+            + _differences().encode("ascii") + b" >> >>"))
+            for name, key in self._fonts.items())
+        def add_image(image):
+            dictionary = image.dictionary
+            if image.mask is not None:
+                dictionary += b" /SMask %d 0 R" % add_image(image.mask)
+            return add(stream(dictionary, image.data))
+        image_refs = b" ".join(b"/%s %d 0 R" % (key, add_image(image))
+            for image, key in self._images.items())
+        resources = b"<< /Font << " + font_refs + b" >> /XObject << " + image_refs + b" >> >>"
+        page_refs = []
+        for page in self.pages:
+            content = add(stream(b"/Filter /FlateDecode", zlib.compress(page.content())))
+            page_refs.append(add(b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 %.2f %.2f] /Resources "
+                % (pages, self.width, self.height) + resources + b" /Contents %d 0 R >>" % content))
+        objects[catalog - 1] = b"<< /Type /Catalog /Pages %d 0 R >>" % pages
+        objects[pages - 1] = b"<< /Type /Pages /Kids [" + b" ".join(b"%d 0 R" % ref for ref in page_refs) \
+            + b"] /Count %d >>" % len(page_refs)
+
+        output = [b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n"]
+        offsets = []
+        position = len(output[0])
+        for number, data in enumerate(objects, 1):
+            chunk = b"%d 0 obj\n" % number + data + b"\nendobj\n"
+            offsets.append(position)
+            output.append(chunk)
+            position += len(chunk)
+        output.append(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+        output.extend(b"%010d 00000 n \n" % offset for offset in offsets)
+        output.append(b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+            % (len(objects) + 1, catalog, position))
+        return b"".join(output)
+
+class ImageError(ValueError):
+    pass
+
+def _unfilter(data, row_size, pixel_size):
+    """Return unfiltered rows of PNG image data, rows in 'data' start with the filter type."""
+    rows = []
+    previous = bytearray(row_size)
+    for start in range(0, len(data), row_size + 1):
+        kind, row = data[start], bytearray(data[start+1:start+1+row_size])
+        if kind == 1:
+            for i in range(pixel_size, len(row)):
+                row[i] = (row[i] + row[i-pixel_size]) & 0xff
+        elif kind == 2:
+            for i in range(len(row)):
+                row[i] = (row[i] + previous[i]) & 0xff
+        elif kind == 3:
+            for i in range(len(row)):
+                left = row[i-pixel_size] if i >= pixel_size else 0
+                row[i] = (row[i] + (left + previous[i]) // 2) & 0xff
+        elif kind == 4:
+            for i in range(len(row)):
+                left = row[i-pixel_size] if i >= pixel_size else 0
+                up = previous[i]
+                corner = previous[i-pixel_size] if i >= pixel_size else 0
+                estimate = left + up - corner
+                distances = abs(estimate - left), abs(estimate - up), abs(estimate - corner)
+                if distances[0] <= distances[1] and distances[0] <= distances[2]:
+                    predicted = left
+                elif distances[1] <= distances[2]:
+                    predicted = up
+                else:
+                    predicted = corner
+                row[i] = (row[i] + predicted) & 0xff
+        elif kind != 0:
+            raise ValueError("Unsupported PNG predictor: {0}".format(kind))
+        rows.append(row)
+        previous = row
+    return rows
+
+class _Mask(object):
+    """Soft mask of an image, 8-bit alpha values."""
+    mask = None
+
+    def __init__(self, width, height, alpha):
+        self.data = zlib.compress(alpha)
+        self.dictionary = (b"/Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace /DeviceGray"
+            b" /BitsPerComponent 8 /Filter /FlateDecode" % (width, height))
+
+class PNGImage(object):
+    """Non-interlaced PNG image.
+
+    Grayscale, RGB and palette images are embedded without decoding.
+    Images with an alpha channel, palette transparency or 16-bit samples
+    are decoded, samples are reduced to 8 bits and the transparency is
+    kept in a soft mask. Interlaced images raise ImageError.
+    """
+    _depths = {0: (1, 2, 4, 8, 16), 2: (8, 16), 3: (1, 2, 4, 8), 4: (8, 16), 6: (8, 16)}
+
+    def __init__(self, path):
+        with open(path, "rb") as stream:
+            data = stream.read()
+        if data[:8] != b"\x89PNG\r\n\x1a\n":
+            raise ImageError("Not a PNG image: {0}".format(path))
+        offset = 8
+        chunks = []
+        palette = transparency = None
+        while offset < len(data):
+            length, kind = struct.unpack_from(">I4s", data, offset)
+            body = data[offset+8:offset+8+length]
+            offset += 12 + length
+            if kind == b"IHDR":
+                self.width, self.height, depth, color, compression, filter, interlace = struct.unpack(">IIBBBBB", body)
+            elif kind == b"PLTE":
+                palette = body
+            elif kind == b"tRNS":
+                transparency = body
+            elif kind == b"IDAT":
+                chunks.append(body)
+        if depth not in self._depths.get(color, ()) or interlace or (color == 3 and not palette):
+            raise ImageError("Unsupported PNG format: {0}".format(path))
+        data = b"".join(chunks)
+        self.mask = None
+        channels = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}[color]
+        colors = 3 if color in (2, 6) else 1
+        if color == 3:
+            colorspace = b"[/Indexed /DeviceRGB %d <%s>]" % (len(palette) // 3 - 1, palette.hex().encode("ascii"))
+        else:
+            colorspace = b"/DeviceGray" if colors == 1 else b"/DeviceRGB"
+        if depth < 16 and color in (0, 2) or color == 3 and transparency is None:
+            parameters = (b" /DecodeParms << /Predictor 15 /Colors %d /BitsPerComponent %d /Columns %d >>"
+                % (colors, depth, self.width))
+            if transparency is not None:
+                # Color key transparency, a gray level or an RGB triple.
+                parameters += b" /Mask [%s]" % b" ".join(b"%d %d" % (key, key)
+                    for key in struct.unpack(">%dH" % colors, transparency[:colors * 2]))
+            self.data = data
+        else:
+            self.data, depth = self._decode(data, depth, channels, colors, transparency, path)
+            parameters = b""
+        self.dictionary = (b"/Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace %s"
+            b" /BitsPerComponent %d /Filter /FlateDecode" % (self.width, self.height, colorspace, depth)
+            + parameters)
+
+    def _decode(self, data, depth, channels, colors, transparency, path):
+        """Return 8-bit color samples compressed and their depth, set the mask."""
+        try:
+            data = zlib.decompress(data)
+        except zlib.error as error:
+            raise ImageError("Broken PNG image {0}: {1}".format(path, error))
+        pixel_bits = channels * depth
+        rows = _unfilter(data, (self.width * pixel_bits + 7) // 8, max(1, pixel_bits // 8))
+        if len(rows) != self.height:
+            raise ImageError("Broken PNG image: {0}".format(path))
+        if depth == 16:
+            rows = [row[0::2] for row in rows]
+        elif depth < 8:
+            # Palette indexes packed into bytes.
+            shifts = range(8 - depth, -1, -depth)
+            rows = [bytearray((byte >> shift) & ((1 << depth) - 1) for byte in row for shift in shifts)[:self.width]
+                for row in rows]
+        samples = bytearray(b"".join(rows))
+        if channels == colors + 1:
+            alpha = samples[colors::channels]
+            color_samples = bytearray(len(samples) - len(alpha))
+            for channel in range(colors):
+                color_samples[channel::colors] = samples[channel::channels]
+            samples = color_samples
+        elif transparency is not None and channels == 1 and depth <= 8 and len(transparency) <= 256:
+            # Palette alpha values, missing ones are opaque.
+            alpha = samples.translate(transparency + b"\xff" * (256 - len(transparency)))
+        else:
+            alpha = None
+            if transparency is not None:
+                log.warning("Ignoring color key transparency of 16-bit PNG image: %s", path)
+        if alpha is not None:
+            self.mask = _Mask(self.width, self.height, bytes(alpha))
+        return zlib.compress(samples), 8
+
+def _amount(value):
+    return "{:,}".format(value).replace(",", " ") + " Kč"
+
+def _pairs(first, second):
+    first, second = list(first), list(second)
+    first += (len(second) - len(first)) * [""]
+    second += (len(first) - len(second)) * [""]
+    return zip(first, second)
+
+def render_invoice(invoice, issuer, customer, signature=None):
+    """Return PDF of an invoice from InvoiceData and CompanyData objects.
+
+    'signature' is an optional path to a PNG image placed below the
+    invoice as in the TeX template, ImageError is raised when it cannot
+    be embedded.
+    """
+    document = Document()
+    page = document.add_page()
+    left, right = 72.0, document.width - 72.0
+    middle = (left + right) / 2
+    top = document.height - 72.0
+    small, normal, large = 8, 10, 12
+    state = {"page": page, "y": top - 40}
+
+    def row(height=small + 5):
+        state["y"] -= height
+        if state["y"] < 72:
+            page = state["page"] = document.add_page()
+            state["y"] = top - height
+        return state["page"], state["y"]
+
+    def rule():
+        page, y = row(6)
+        page.line(left, y + 3, right, y + 3)
+
+    # Title box
+    page.line(middle, top, right, top)
+    page.line(middle, top - 30, right, top - 30)
+    page.line(middle, top, middle, top - 30)
+    page.line(right, top, right, top - 30)
+    page.text(middle + 4, top - 20, "Faktura:", large)
+    page.text(right - 4, top - 20, str(invoice.number), large, align="right")
+    frame_top = state["y"] + 10
+
+    page, y = row(4)
+    page, y = row()
+    page.text(left + 4, y, "Dodavatel:", small, bold=True)
+    page.text(middle, y, "Odběratel", small, bold=True)
+    page, y = row(large + 8)
+    page.text(left + 4, y, issuer.name or "", large, bold=True)
+    page.text(middle, y, customer.name or "", large, bold=True)
+    for first, second in _pairs(issuer.address, customer.address):
+        page, y = row(large + 3)
+        page.text(left + 4, y, first, large)
+        page.text(middle, y, second, large)
+    page, y = row(small + 8)
+    page.text(left + 4, y, "IČ: {0}".format(issuer.number), small)
+    page.text(middle, y, "IČ: {0}".format(customer.number), small)
+    for first, second in _pairs(issuer.comments, customer.comments):
+        page, y = row()
+        page.text(left + 4, y, first, small)
+        page.text(middle, y, second, small)
+    row(4)
+    rule()
+
+    page, y = row()
+    page.text(left + 4, y, "Platební podmínky:", small, bold=True)
+    quarter = (right - left) / 4
+    page, y = row(large + 8)
+    page.text(left + 4, y, "Forma úhrady:", large)
+    page.text(left + quarter, y, "hotově" if invoice.payment == "cash" else "převodem", large)
+    page.text(middle, y, "Datum vystavení:", large)
+    page.text(right - 4, y, invoice.date.strftime("%d.%m.%Y"), large, align="right")
+    page, y = row(large + 3)
+    page.text(left + 4, y, "Číslo účtu:", large)
+    page.text(left + quarter, y, issuer.bank_account or "", large)
+    page.text(middle, y, "Datum splatnosti:", large, bold=True)
+    page.text(right - 4, y, invoice.due.strftime("%d.%m.%Y"), large, bold=True, align="right")
+    page, y = row(large + 3)
+    page.text(left + 4, y, "Variabilní symbol:", large)
+    page.text(left + quarter, y, str(invoice.number), large)
+    row(4)
+
+    if invoice.notes:
+        rule()
+        page, y = row()
+        page.text(left + 4, y, "Poznámky:", small, bold=True)
+        row(4)
+        for note in invoice.notes:
+            page, y = row(large + 3)
+            page.text(left + 4, y, note, large)
+        row(4)
+
+    rule()
+    page, y = row()
+    page.text(left + 4, y, "Fakturujeme vám:", small, bold=True)
+    row(4)
+    for description, price in invoice.items:
+        page, y = row(normal + 4)
+        page.text(left + 4, y, description, normal)
+        page.text(right - 4, y, _amount(price), normal, align="right")
+    row(4)
+    rule()
+    page, y = row(large + 8)
+    page.text(left + 4, y, "Celkem k úhradě:", large, bold=True)
+    page.text(right - 4, y, _amount(invoice.sum), large, bold=True, align="right")
+    row(4)
+    rule()
+
+    # Frame around the invoice body on the first page
+    bottom = state["y"] + 3 if state["page"] is document.pages[0] else 72
+    first = document.pages[0]
+    first.line(left, frame_top, right, frame_top)
+    first.line(left, frame_top, left, bottom)
+    first.line(right, frame_top, right, bottom)
+
+    if signature and os.path.exists(signature):
+        image = PNGImage(signature)
+        width, height = image.width * 0.75, image.height * 0.75
+        page, y = row(height + 10)
+        page.image(image, right - 12 - width, y, width, height)
+    return document.write()
+
+# Reading and splitting PDF files
+
+class Name(str):
+    pass
+
+class Ref(tuple):
+    def __new__(cls, number, generation=0):
+        return tuple.__new__(cls, (number, generation))
+
+class Raw(bytes):
+    """Token written back as is (strings, booleans, null)."""
+
+class Stream(dict):
+    def __init__(self, dictionary, data):
+        dict.__init__(self, dictionary)
+        self.data = data
+
+_whitespace = b"\x00\t\n\x0c\r "
+_delimiters = b"()<>[]{}/%"
+_number = re.compile(rb"[+-]?(\d+\.?\d*|\.\d+)$")
+
+class Reader(object):
+    """Minimal PDF reader supporting xref tables, xref streams and object streams."""
+    def __init__(self, data):
+        self._data = data
+        self._offsets = {}
+        self._compressed = {}
+        self._objects = {}
+        self._pages = None
+        self.trailer = {}
+        start = data.rfind(b"startxref")
+        if start < 0:
+            raise ValueError("Not a PDF file.")
+        self._read_xref(int(data[start+9:].split()[0]))
+
+    def _read_xref(self, offset):
+        seen = set()
+        while offset is not None and offset not in seen:
+            seen.add(offset)
+            position = self._skip(offset)
+            if self._data.startswith(b"xref", position):
+                trailer = self._read_table(position + 4)
+            else:
+                trailer = self._read_stream(offset)
+            for key, value in trailer.items():
+                self.trailer.setdefault(key, value)
+            offset = trailer.get("Prev")
+
+    def _read_table(self, position):
+        while True:
+            position = self._skip(position)
+            if self._data.startswith(b"trailer", position):
+                trailer, position = self._parse(position + 7)
+                return trailer
+            start, count = self._data[position:position+40].split()[:2]
+            position = self._data.index(b"\n", position) + 1
+            for number in range(int(start), int(start) + int(count)):
+                entry = self._data[position:position+20]
+                if entry[17:18] == b"n":
+                    self._offsets.setdefault(number, int(entry[:10]))
+                position += 20
+
+    def _read_stream(self, offset):
+        stream = self._object_at(offset)
+        widths = stream["W"]
+        index = stream.get("Index", [0, stream["Size"]])
+        data = self._decode(stream)
+        position = 0
+        for start, count in zip(index[::2], index[1::2]):
+            for number in range(start, start + count):
+                fields = []
+                for width in widths:
+                    fields.append(int.from_bytes(data[position:position+width], "big") if width else None)
+                    position += width
+                kind = 1 if fields[0] is None else fields[0]
+                if kind == 1:
+                    self._offsets.setdefault(number, fields[1])
+                elif kind == 2:
+                    self._compressed.setdefault(number, (fields[1], fields[2]))
+        return stream
+
+    def _decode(self, stream):
+        data = stream.data
+        filters = stream.get("Filter", [])
+        filters = filters if isinstance(filters, list) else [filters]
+        if filters not in ([], ["FlateDecode"]):
+            raise ValueError("Unsupported filter: {0}".format(filters))
+        if filters:
+            data = zlib.decompress(data)
+        parameters = self.resolve(stream.get("DecodeParms")) or {}
+        predictor = parameters.get("Predictor", 1)
+        if predictor >= 10:
+            pixel_bits = parameters.get("Colors", 1) * parameters.get("BitsPerComponent", 8)
+            data = b"".join(_unfilter(data, parameters.get("Columns", 1) * pixel_bits // 8, max(1, pixel_bits // 8)))
+        return data
+
+    def _skip(self, position):
+        data = self._data
+        while position < len(data):
+            if data[position] in _whitespace:
+                position += 1
+            elif data[position] == 37:
+                while position < len(data) and data[position] not in b"\r\n":
+                    position += 1
+            else:
+                break
+        return position
+
+    def _token(self, position):
+        start = position = self._skip(position)
+        while position < len(self._data) and self._data[position] not in _whitespace + _delimiters:
+            position += 1
+        return self._data[start:position], position
+
+    def _parse(self, position):
+        """Return value starting at position and the position after it."""
+        data = self._data
+        position = self._skip(position)
+        if data.startswith(b"<<", position):
+            result = {}
+            position += 2
+            while True:
+                position = self._skip(position)
+                if data.startswith(b">>", position):
+                    return result, position + 2
+                key, position = self._parse(position)
+                result[key], position = self._parse(position)
+        elif data.startswith(b"[", position):
+            result = []
+            position += 1
+            while True:
+                position = self._skip(position)
+                if data.startswith(b"]", position):
+                    return result, position + 1
+                value, position = self._parse(position)
+                result.append(value)
+        elif data.startswith(b"/", position):
+            token, end = self._token(position + 1)
+            return Name(re.sub(rb"#([0-9a-fA-F]{2})", lambda m: bytes([int(m.group(1), 16)]), token)
+                .decode("latin-1")), end
+        elif data.startswith(b"<", position):
+            end = data.index(b">", position) + 1
+            return Raw(data[position:end]), end
+        elif data.startswith(b"(", position):
+            depth, end = 0, position
+            while True:
+                char = data[end]
+                if char == 92:
+                    end += 1
+                elif char == 40:
+                    depth += 1
+                elif char == 41:
+                    depth -= 1
+                    if not depth:
+                        return Raw(data[position:end+1]), end + 1
+                end += 1
+        token, end = self._token(position)
+        if not token:
+            raise ValueError("Unexpected {0!r} at {1}.".format(data[position:position+1], position))
+        if not _number.match(token):
+            return Raw(token), end
+        if b"." in token:
+            return float(token), end
+        generation, after = self._token(end)
+        keyword, after = self._token(after)
+        if generation.isdigit() and keyword == b"R":
+            return Ref(int(token), int(generation)), after
+        return int(token), end
+
+    def _object_at(self, offset):
+        number, position = self._token(offset)
+        generation, position = self._token(position)
+        keyword, position = self._token(position)
+        if keyword != b"obj":
+            raise ValueError("No object at {0}.".format(offset))
+        value, position = self._parse(position)
+        keyword, after = self._token(position)
+        if keyword == b"stream":
+            start = after + (2 if self._data.startswith(b"\r\n", after) else 1)
+            length = self.resolve(value["Length"])
+            value = Stream(value, self._data[start:start+length])
+        return value
+
+    def resolve(self, value):
+        """Return the object a reference points to, other values are returned as they are."""
+        if not isinstance(value, Ref):
+            return value
+        number = value[0]
+        if number not in self._objects:
+            if number in self._offsets:
+                self._objects[number] = self._object_at(self._offsets[number])
+            elif number in self._compressed:
+                self._objects[number] = self._compressed_object(*self._compressed[number])
+            else:
+                self._objects[number] = Raw(b"null")
+        return self._objects[number]
+
+    def _compressed_object(self, container, index):
+        stream = self.resolve(Ref(container))
+        data = self._decode(stream)
+        header = data[:stream["First"]].split()
+        offset = stream["First"] + int(header[index * 2 + 1])
+        return Reader._parse_bytes(data, offset)
+
+    @staticmethod
+    def _parse_bytes(data, offset):
+        reader = Reader.__new__(Reader)
+        reader._data = data
+        return reader._parse(offset)[0]
+
+    def pages(self):
+        """Return references and dictionaries of pages with inherited attributes."""
+        if self._pages is not None:
+            return self._pages
+        result = self._pages = []
+        def walk(ref, inherited):
+            node = self.resolve(ref)
+            inherited = dict(inherited)
+            for key in "Resources", "MediaBox", "CropBox", "Rotate":
+                if key in node:
+                    inherited[key] = node[key]
+            if node.get("Type") == "Pages" or "Kids" in node:
+                for kid in node["Kids"]:
+                    walk(kid, inherited)
+            else:
+                page = dict(inherited)
+                page.update(node)
+                result.append((ref, page))
+        walk(self.resolve(self.trailer["Root"])["Pages"], {})
+        return result
+
+def _serialize(value, refs):
+    if isinstance(value, Ref):
+        number = refs(value)
+        return b"null" if number is None else b"%d 0 R" % number
+    if isinstance(value, Name):
+        return b"/" + "".join(char if char.isascii() and char.isalnum() or char in "-_.+" else "#%02x" % ord(char)
+            for char in value).encode("latin-1")
+    if isinstance(value, dict):
+        return b"<<" + b"".join(_serialize(Name(key), refs) + b" " + _serialize(item, refs) + b" "
+            for key, item in value.items() if key != "Length" or not isinstance(value, Stream)) + b">>"
+    if isinstance(value, list):
+        return b"[" + b" ".join(_serialize(item, refs) for item in value) + b"]"
+    if isinstance(value, bool):
+        return b"true" if value else b"false"
+    if isinstance(value, float):
+        return ("%f" % value).rstrip("0").encode("ascii")
+    if isinstance(value, int):
+        return b"%d" % value
+    return bytes(value)
+
+def _assemble(pages):
+    """Return a document made of (reader, reference, page) triples.
+
+    Objects reachable from the pages are copied with new numbers,
+    references to pages left out are replaced by null.
+    """
+    numbers = {}
+    queue = []
+    page_refs = set((id(reader), ref) for reader, ref, page in pages)
+    all_page_refs = {}
+    def refs_of(reader):
+        if id(reader) not in all_page_refs:
+            all_page_refs[id(reader)] = set(ref for ref, page in reader.pages())
+        def refs(ref):
+            key = id(reader), ref
+            if key not in numbers:
+                if ref in all_page_refs[id(reader)] and key not in page_refs:
+                    return None
+                numbers[key] = len(numbers) + 3
+                queue.append((reader, ref))
+            return numbers[key]
+        return refs
+    selected = dict(((id(reader), ref), page) for reader, ref, page in pages)
+    kids = b" ".join(b"%d 0 R" % refs_of(reader)(ref) for reader, ref, page in pages)
+    objects = {
+        1: b"<< /Type /Catalog /Pages 2 0 R >>",
+        2: b"<< /Type /Pages /Kids [" + kids + b"] /Count %d >>" % len(pages),
+    }
+    while queue:
+        reader, ref = queue.pop(0)
+        value = selected.get((id(reader), ref))
+        if value is not None:
+            value = dict(value)
+            value["Parent"] = Raw(b"2 0 R")
+        else:
+            value = reader.resolve(ref)
+        body = _serialize(value, refs_of(reader))
+        if isinstance(value, Stream):
+            body = body[:-2] + b"/Length %d >>\nstream\n" % len(value.data) + value.data + b"\nendstream"
+        objects[numbers[id(reader), ref]] = body
+
+    output = [b"%PDF-1.5\n%\xe2\xe3\xcf\xd3\n"]
+    offsets = []
+    position = len(output[0])
+    for number in range(1, len(objects) + 1):
+        chunk = b"%d 0 obj\n" % number + objects[number] + b"\nendobj\n"
+        offsets.append(position)
+        output.append(chunk)
+        position += len(chunk)
+    output.append(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+    output.extend(b"%010d 00000 n \n" % offset for offset in offsets)
+    output.append(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+        % (len(objects) + 1, position))
+    return b"".join(output)
+
+def split(data, page_counts):
+    """Split a PDF into documents of the given numbers of consecutive pages."""
+    reader = Reader(data)
+    pages = reader.pages()
+    if sum(page_counts) != len(pages):
+        raise ValueError("Expected {0} pages, found {1}.".format(sum(page_counts), len(pages)))
+    results = []
+    start = 0
+    for count in page_counts:
+        results.append(_assemble([(reader, ref, page) for ref, page in pages[start:start+count]]))
+        start += count
+    return results
+
+def merge(documents):
+    """Join PDF documents into one."""
+    pages = []
+    for data in documents:
+        reader = Reader(data)
+        pages.extend((reader, ref, page) for ref, page in reader.pages())
+    return _assemble(pages)
@@ -0,0 +1,78 @@
+#!/usr/bin/python3
+"""Counters and timers of hot paths.
+
+Instrumented code calls count() and timer() with dotted names like
+"storage.scan". Nothing is recorded unless profiling was started with
+start(), which is what the '--profile' option does, and the disabled
+calls only check a module flag.
+"""
+
+import sys, time, json, threading, contextlib
+
+import logging
+log = logging.getLogger()
+
+enabled = False
+_stats = {}
+_lock = threading.Lock()
+_null = contextlib.nullcontext()
+
+def start():
+    """Clear collected statistics and start collecting."""
+    global enabled
+    _stats.clear()
+    enabled = True
+
+def stop():
+    global enabled
+    enabled = False
+
+def count(name, n=1):
+    """Count an event."""
+    if enabled:
+        with _lock:
+            entry = _stats.setdefault(name, [0, None])
+            entry[0] += n
+
+class _Timer(object):
+    __slots__ = ("_name", "_start")
+
+    def __init__(self, name):
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self._start
+        with _lock:
+            entry = _stats.setdefault(self._name, [0, None])
+            entry[0] += 1
+            entry[1] = (entry[1] or 0) + elapsed
+
+def timer(name):
+    """Return a context manager counting and timing the block it wraps."""
+    return _Timer(name) if enabled else _null
+
+def stats():
+    """Return a dictionary of {"count": ..., "seconds": ...} by name."""
+    with _lock:
+        return dict((name, {"count": calls, "seconds": seconds})
+            for name, (calls, seconds) in sorted(_stats.items()))
+
+def report(stream=None):
+    """Print a table of the collected statistics."""
+    stream = stream or sys.stderr
+    print("{0:<28} {1:>8} {2:>10} {3:>10}".format("", "count", "total ms", "avg ms"), file=stream)
+    for name, entry in stats().items():
+        if entry["seconds"] is None:
+            print("{0:<28} {1:>8}".format(name, entry["count"]), file=stream)
+        else:
+            print("{0:<28} {1:>8} {2:>10.2f} {3:>10.3f}".format(name, entry["count"],
+                entry["seconds"] * 1000, entry["seconds"] * 1000 / entry["count"]), file=stream)
+
+def dump(path):
+    """Write the collected statistics to a JSON file."""
+    with open(path, "w") as stream:
+        json.dump(stats(), stream, indent=2)
+        stream.write("\n")
@@ -0,0 +1,157 @@
+#!/usr/bin/python3
+"""Matching of bank statement payments to unpaid invoices.
+
+Payments are read row by row from a CSV export of a bank statement and
+matched using two hash indexes built once from the unpaid invoices: by
+variable symbol, which is the invoice number, and by company and amount,
+companies being recognized by their bank account. Each row is matched in
+constant time, so reconciliation is linear in the statement size.
+"""
+
+import re, csv, datetime, decimal, collections
+
+import logging
+log = logging.getLogger()
+
+# Lowercase column names used by banks, columns can also be named explicitly.
+columns = {
+    "date": ["date", "booking date", "value date", "datum", "datum zaúčtování", "datum provedení",
+        "datum pohybu"],
+    "amount": ["amount", "credit", "částka", "objem"],
+    "symbol": ["variable symbol", "vs", "variabilní symbol", "var. symbol"],
+    "account": ["account", "counter account", "counterparty account", "protiúčet", "číslo protiúčtu"],
+    "bank_code": ["bank code", "kód banky"],
+}
+required = ("date", "amount")
+
+Payment = collections.namedtuple("Payment", ("line", "date", "amount", "symbol", "account"))
+
+_date_formats = ("%Y-%m-%d", "%d.%m.%Y", "%Y%m%d", "%d/%m/%Y")
+
+def parse_date(text):
+    """Parse a statement date, time of day is ignored."""
+    text = text.strip().split(" ")[0]
+    for date_format in _date_formats:
+        try:
+            return datetime.datetime.strptime(text, date_format).date()
+        except ValueError:
+            pass
+    raise ValueError("Bad date: {0}".format(text))
+
+def parse_amount(text):
+    """Parse an amount using either decimal point or comma and any digit grouping."""
+    text = re.sub(r"[\s ']", "", text)
+    if "," in text and "." in text:
+        separator = "," if text.rfind(",") > text.rfind(".") else "."
+        text = text.replace("." if separator == "," else ",", "")
+    text = text.replace(",", ".")
+    try:
+        return decimal.Decimal(text)
+    except decimal.InvalidOperation:
+        raise ValueError("Bad amount: {0}".format(text))
+
+def normalize_symbol(symbol):
+    return (symbol or "").strip().lstrip("0")
+
+def normalize_account(account):
+    return re.sub(r"\s", "", account or "").lower()
+
+def _find_columns(row, names):
+    """Return field to column index mapping if 'row' is a header."""
+    header = [cell.strip().lower() for cell in row]
+    result = {}
+    for field, aliases in columns.items():
+        if field in names:
+            aliases = [names[field].lower()]
+        for alias in aliases:
+            if alias in header:
+                result[field] = header.index(alias)
+                break
+    if all(field in result for field in required):
+        return result
+
+def read_payments(stream, delimiter=None, names=None):
+    """Generate payments from a CSV statement.
+
+    Lines before the header row, like account details in some exports,
+    are skipped. The delimiter is guessed from the header unless given,
+    'names' maps fields to column names missing in the built-in list.
+    Rows that cannot be parsed are generated as ValueError instances.
+    """
+    names = names or {}
+    lines = iter(stream)
+    number = 0
+    index = None
+    for number, line in enumerate(lines, 1):
+        separator = delimiter or max(";,\t", key=line.count)
+        index = _find_columns(next(csv.reader([line], delimiter=separator)), names)
+        if index:
+            break
+    if not index:
+        raise ValueError("Cannot find a header with {0} columns in the statement.".format(
+            " and ".join(required)))
+    for number, row in enumerate(csv.reader(lines, delimiter=separator), number + 1):
+        if not any(cell.strip() for cell in row):
+            continue
+        cell = lambda field: row[index[field]] if field in index and index[field] < len(row) else ""
+        try:
+            account = cell("account")
+            if cell("bank_code").strip():
+                account = "{0}/{1}".format(account.strip(), cell("bank_code").strip())
+            yield Payment(number, parse_date(cell("date")), parse_amount(cell("amount")),
+                normalize_symbol(cell("symbol")), normalize_account(account))
+        except ValueError as error:
+            yield ValueError("line {0}: {1}".format(number, error))
+
+class Reconciler(object):
+    """Matcher of payments to unpaid invoices.
+
+    Takes (item, data) pairs of unpaid invoices and (name, data) pairs
+    of companies. Matched invoices are removed from the indexes so that
+    each invoice is paid only once.
+    """
+    def __init__(self, invoices, companies):
+        self._by_symbol = collections.defaultdict(list)
+        self._by_amount = collections.defaultdict(list)
+        for item, data in invoices:
+            self._by_symbol[normalize_symbol(data.number)].append((item, data))
+            self._by_amount[item.company_name, data.sum].append((item, data))
+        self._matched = collections.defaultdict(list)
+        self._companies = {}
+        for name, data in companies:
+            if data.bank_account:
+                self._companies[normalize_account(data.bank_account)] = name
+
+    def match(self, payment):
+        """Return status, matching (item, data) pairs and an explanation.
+
+        Status is "paid" for a single matching invoice, "ambiguous" when
+        there are more and "unmatched" when there is none.
+        """
+        candidates = self._by_symbol.get(payment.symbol) if payment.symbol else None
+        if not candidates and payment.symbol in self._matched:
+            return "unmatched", list(self._matched[payment.symbol]), "invoice already paid"
+        if candidates:
+            exact = [(item, data) for item, data in candidates if data.sum == payment.amount]
+            if not exact:
+                return "unmatched", list(candidates), "amount differs from {0}".format(
+                    ", ".join(str(data.sum) for item, data in candidates))
+            reason = "variable symbol"
+        else:
+            company = self._companies.get(payment.account) if payment.account else None
+            if company is None:
+                return "unmatched", [], "unknown variable symbol and account"
+            exact = list(self._by_amount.get((company, payment.amount), ()))
+            if not exact:
+                return "unmatched", [], "no unpaid invoice of {0} with this amount".format(company)
+            reason = "amount and account of {0}".format(company)
+        if len(exact) > 1:
+            return "ambiguous", exact, reason
+        self._remove(*exact[0])
+        return "paid", exact, reason
+
+    def _remove(self, item, data):
+        symbol = normalize_symbol(data.number)
+        self._by_symbol[symbol].remove((item, data))
+        self._matched[symbol].append((item, data))
+        self._by_amount[item.company_name, data.sum].remove((item, data))
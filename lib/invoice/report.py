@@ -0,0 +1,139 @@
+#!/usr/bin/python3
+"""Aggregated invoice reports.
+
+Invoice facts are loaded into compact columns (arrays of integers with
+dates stored as ordinals). Reports order the selected invoices by the
+grouping column and sum each group or bucket as a slice, columns are
+only walked by the built-in map, sorted and sum.
+"""
+
+import bisect, datetime, operator, itertools, collections
+from array import array
+
+import logging
+log = logging.getLogger()
+
+from invoice.db.invoices import parse_date
+
+UNPAID = 0
+PAID_UNKNOWN = -1
+
+def _paid_ordinal(paid):
+    if not paid:
+        return UNPAID
+    try:
+        return parse_date(paid).toordinal()
+    except ValueError:
+        return PAID_UNKNOWN
+
+class Facts(object):
+    """Invoice facts stored in columns."""
+    def __init__(self):
+        self.date = array("l")
+        self.month = array("l")
+        self.due = array("l")
+        self.paid = array("l")
+        self.sum = array("q")
+        self.company = array("l")
+        self.companies = []
+        self._company_ids = {}
+
+    def __len__(self):
+        return len(self.date)
+
+    def add(self, data):
+        """Add facts from an InvoiceData object."""
+        date = data.date
+        self.date.append(date.toordinal())
+        self.month.append(date.year * 12 + date.month - 1)
+        self.due.append(data.due.toordinal())
+        self.paid.append(_paid_ordinal(data.paid))
+        self.sum.append(data.sum)
+        name = data.company_name
+        if name not in self._company_ids:
+            self._company_ids[name] = len(self.companies)
+            self.companies.append(name)
+        self.company.append(self._company_ids[name])
+
+    @classmethod
+    def load(cls, data):
+        facts = cls()
+        for item in data:
+            facts.add(item)
+        return facts
+
+def _order(values, selected=None):
+    """Return indexes of the selected values in the order of the values."""
+    indexes = range(len(values))
+    if selected is not None:
+        indexes = itertools.compress(indexes, selected)
+    return sorted(indexes, key=values.__getitem__)
+
+def _take(column, order):
+    return list(map(column.__getitem__, order))
+
+def _grouped(keys, facts):
+    """Sum invoices by key column, returns {key: [count, total, paid]}."""
+    counts = collections.Counter(keys)
+    order = _order(keys)
+    totals = _take(facts.sum, order)
+    paid = list(map(operator.mul, totals, map(bool, _take(facts.paid, order))))
+    groups = {}
+    start = 0
+    for key in sorted(counts):
+        end = start + counts[key]
+        groups[key] = [counts[key], sum(totals[start:end]), sum(paid[start:end])]
+        start = end
+    return groups
+
+def _bucketed(values, facts, selected, buckets):
+    """Return rows (label, count, amount) of selected invoices by value in (low, high, label) buckets."""
+    order = _order(values, selected)
+    values = _take(values, order)
+    amounts = _take(facts.sum, order)
+    rows = []
+    start = 0
+    for low, high, label in buckets:
+        end = len(values) if high is None else bisect.bisect_right(values, high, start)
+        rows.append((label, end - start, sum(amounts[start:end])))
+        start = end
+    return rows
+
+def by_month(facts):
+    """Return rows (month, count, total, paid) sorted by month."""
+    groups = _grouped(facts.month, facts)
+    return [("{0}-{1:02}".format(key // 12, key % 12 + 1),) + tuple(groups[key])
+        for key in sorted(groups)]
+
+def by_company(facts):
+    """Return rows (company, count, total, paid) sorted by total."""
+    groups = _grouped(facts.company, facts)
+    return sorted(((facts.companies[key],) + tuple(group) for key, group in groups.items()),
+        key=lambda row: (-row[2], row[0]))
+
+aging_buckets = [(None, 0, "not due"), (1, 30, "1-30 days"), (31, 60, "31-60 days"),
+    (61, 90, "61-90 days"), (91, None, "over 90 days")]
+
+def aging(facts, today=None):
+    """Return rows (bucket, count, amount) of unpaid invoices by days overdue."""
+    today = (today or datetime.date.today()).toordinal()
+    overdue = list(map(operator.sub, itertools.repeat(today), facts.due))
+    return _bucketed(overdue, facts, map(operator.not_, facts.paid), aging_buckets)
+
+payment_buckets = [(None, -1, "before issue"), (0, 14, "up to 14 days"), (15, 30, "15-30 days"),
+    (31, 60, "31-60 days"), (61, 90, "61-90 days"), (91, None, "over 90 days")]
+
+def days_to_pay(facts):
+    """Return rows (bucket, count, amount) of paid invoices by days to payment.
+
+    Invoices paid before they were issued are counted separately.
+    """
+    days = list(map(operator.sub, facts.paid, facts.date))
+    return _bucketed(days, facts, map(UNPAID.__lt__, facts.paid), payment_buckets)
+
+reports = {
+    "month": (by_month, ("Month", "Count", "Total", "Paid")),
+    "company": (by_company, ("Company", "Count", "Total", "Paid")),
+    "aging": (aging, ("Overdue", "Count", "Unpaid")),
+    "days-to-pay": (days_to_pay, ("Paid after", "Count", "Amount")),
+}
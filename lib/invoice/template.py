@@ -0,0 +1,79 @@
+#!/usr/bin/python3
+
+import os, pickle
+
+import logging
+log = logging.getLogger()
+
+from invoice import profile
+
+class TemplateLoader(object):
+    """Loader of named Tempita templates.
+
+    Templates are compiled once and kept in memory as long as the
+    template file doesn't change. When 'cache_path' is set, compiled
+    templates are also stored there and reused by later processes.
+
+    This requires Tempita 0.5.
+    """
+    extension = ".tex"
+
+    def __init__(self, template_path, cache_path=None):
+        self._template_path = template_path
+        self._cache_path = cache_path
+        self._templates = {}
+
+    def path(self, name):
+        return os.path.join(self._template_path, name + self.extension)
+
+    def get(self, name):
+        """Return compiled template 'name'."""
+        path = self.path(name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            raise LookupError("Template not found: {0}".format(path))
+        key = (stat.st_mtime_ns, stat.st_size)
+        cached = self._templates.get(name)
+        if cached is not None and cached[0] == key:
+            profile.count("template.cache.hit")
+            return cached[1]
+        template = self._load(name, key)
+        if template is None:
+            template = self._compile(name, path)
+            self._store(name, key, template)
+        self._templates[name] = key, template
+        return template
+
+    def _compile(self, name, path):
+        import tempita
+        log.debug("Compiling template: %s", path)
+        with profile.timer("template.compile"), open(path) as stream:
+            return tempita.Template(stream.read(), name=path)
+
+    def _cache_file(self, name):
+        return os.path.join(self._cache_path, name + ".pickle")
+
+    def _load(self, name, key):
+        if not self._cache_path:
+            return
+        try:
+            with open(self._cache_file(name), "rb") as stream:
+                cached_key, template = pickle.load(stream)
+        except FileNotFoundError:
+            return
+        except Exception as error:
+            log.warning("Ignoring broken template cache for %s: %s", name, error)
+            return
+        if cached_key == key:
+            log.debug("Loaded compiled template: %s", name)
+            return template
+
+    def _store(self, name, key, template):
+        if not self._cache_path:
+            return
+        os.makedirs(self._cache_path, exist_ok=True)
+        path = self._cache_file(name)
+        with open(path + "~", "wb") as stream:
+            pickle.dump((key, template), stream, pickle.HIGHEST_PROTOCOL)
+        os.replace(path + "~", path)
@@ -0,0 +1,110 @@
+#!/usr/bin/python3
+"""Watching directories for changed files.
+
+Linux inotify is used through ctypes when available, other systems
+fall back to polling modification times. Both watchers report changes
+as (directory, name) pairs and group events arriving in quick
+succession, as editors often write a file in several steps.
+"""
+
+import os, time, select, struct, ctypes, ctypes.util
+
+import logging
+log = logging.getLogger()
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+
+_event = struct.Struct("iIII")
+
+class Inotify(object):
+    """Watcher using Linux inotify."""
+    mask = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+
+    def __init__(self, paths, settle=0.2):
+        self._settle = settle
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = libc.inotify_init1(os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._paths = {}
+        for path in paths:
+            wd = libc.inotify_add_watch(self._fd, os.fsencode(path), self.mask)
+            if wd < 0:
+                os.close(self._fd)
+                raise OSError(ctypes.get_errno(), "Cannot watch {0}".format(path))
+            self._paths[wd] = path
+
+    def _read(self, changes):
+        data = os.read(self._fd, 65536)
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _event.unpack_from(data, offset)
+            offset += _event.size
+            name = os.fsdecode(data[offset:offset+length].rstrip(b"\0"))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                log.warning("Event queue overflow, reporting all directories as changed.")
+                changes.update((path, None) for path in self._paths.values())
+            elif wd in self._paths and name:
+                changes.add((self._paths[wd], name))
+
+    def wait(self, timeout=None):
+        """Return a set of changed (directory, name) pairs.
+
+        Name is None when changes in the directory may have been lost.
+        Returns an empty set when nothing changed within 'timeout'.
+        """
+        changes = set()
+        while select.select([self._fd], [], [], timeout)[0]:
+            self._read(changes)
+            timeout = self._settle
+        return changes
+
+    def close(self):
+        os.close(self._fd)
+
+class Poller(object):
+    """Watcher comparing modification times and sizes of files."""
+    def __init__(self, paths, interval=1.0):
+        self._interval = interval
+        self._states = dict((path, self._scan(path)) for path in paths)
+
+    @staticmethod
+    def _scan(path):
+        state = {}
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    stat = entry.stat()
+                    state[entry.name] = stat.st_mtime_ns, stat.st_size
+        return state
+
+    def wait(self, timeout=None):
+        """Return a set of changed (directory, name) pairs, see Inotify.wait()."""
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            changes = set()
+            for path, old in self._states.items():
+                new = self._states[path] = self._scan(path)
+                changes.update((path, name) for name in set(old) | set(new) if old.get(name) != new.get(name))
+            if changes or deadline is not None and time.time() >= deadline:
+                return changes
+            time.sleep(self._interval if deadline is None else
+                max(min(self._interval, deadline - time.time()), 0))
+
+    def close(self):
+        pass
+
+def watcher(paths, poll=False, interval=1.0):
+    """Return an inotify watcher or a poller if inotify is not available."""
+    if not poll:
+        try:
+            return Inotify(paths)
+        except (OSError, AttributeError) as error:
+            log.info("Inotify not available, polling for changes: %s", error)
+    return Poller(paths, interval)
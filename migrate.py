@@ -2,28 +2,24 @@
 
 import os
 import sys
-import glob
 import yaml
 
 data_dir = os.path.expanduser("~/.local/paperwork")
 
 def read_from_0_1():
+    """Generate (year, records) pairs, records are parsed lazily."""
     data_path = os.path.join(data_dir, "{year}/data/{directory}")
-    years = [int(os.path.basename(year)) for year in glob.glob(os.path.join(data_dir, "????"))]
-
     sys.path.append("lib")
     import invoice.db
+    import invoice.export
 
-    data = {}
-    for year in years:
-        try:
-            db = invoice.db.Database(year=year, data_path=data_path)
-            for item in db.invoices:
-               data.setdefault(year, []).append(item.data()._data)
-        except FileNotFoundError:
-            pass
+    history = invoice.db.History([invoice.db.Database(year=year, data_path=data_path)
+        for year in invoice.db.History.find_years(data_path)])
+    for db in history.databases:
+        yield db.invoices._year, invoice.export.records(sorted(db.invoices))
 
-    return data
-    
 if __name__ == "__main__":
-    print(yaml.safe_dump(read_from_0_1()))
+    for year, records in read_from_0_1():
+        print("{0}:".format(year))
+        for record in records:
+            sys.stdout.write(yaml.safe_dump([record], default_flow_style=False, allow_unicode=True))
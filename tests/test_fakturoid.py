@@ -0,0 +1,154 @@
+#!/usr/bin/python3
+
+import os, json, base64, tempfile, threading, unittest, collections, urllib.parse, http.server
+
+import invoice.db
+
+try:
+    import requests
+except ImportError:
+    requests = None
+else:
+    import invoice.fakturoid
+
+per_page = 5
+subjects = [{"id": 100 + i, "name": "Firma Čížek {0} s.r.o.".format(i % 3), "street": "Ulice {0}".format(i),
+    "city": "Praha", "zip": "11000", "registration_no": str(10000000 + i),
+    "updated_at": "2017-01-{0:02}T10:00:00+01:00".format(1 + i)} for i in range(6)]
+invoices = [{"id": 5000 + i, "number": "{0}-{1:04}".format(2016 + i % 2, 40 + i), "subject_id": 100 + i % 6,
+    "issued_on": "{0}-{1:02}-{2:02}".format(2016 + i % 2, 12 - i % 12, 1 + i), "due_on": "2017-12-31",
+    "lines": [{"name": "Práce", "quantity": "2.0", "unit_name": "h", "unit_price": "500.0"}],
+    "updated_at": "2017-02-{0:02}T10:00:00+01:00".format(1 + i)} for i in range(23)]
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """Fakturoid stand-in failing the first requests of some pages."""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        endpoint = url.path.rsplit("/", 1)[1][:-len(".json")]
+        page = int(query["page"][0])
+        since = query.get("updated_since", [None])[0]
+        if self.headers.get("Authorization") != "Basic " + base64.b64encode(b"me@example.com:secret").decode():
+            return self.send(401, {})
+        with server.lock:
+            server.requests.append((endpoint, page, since))
+            first = server.requests.count((endpoint, page, since)) == 1
+        if (endpoint, page) == server.broken:
+            return self.send(404, {})
+        if first and page == 2:
+            return self.send(503, {})
+        if first and page == 3:
+            return self.send(429, {}, {"Retry-After": "0"})
+        records = [record for record in server.data[endpoint] if not since or record["updated_at"] > since]
+        self.send(200, records[(page - 1) * per_page:page * per_page])
+
+    def send(self, code, body, headers={}):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+@unittest.skipUnless(requests, "requires requests")
+class ImporterTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        self.server.broken = None
+        self.server.data = {"subjects": subjects, "invoices": invoices}
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        os.makedirs(os.path.join(self.root, "2017", "data", "companies"))
+        with open(os.path.join(self.root, "2017", "data", "companies", "firma-cizek-0-s-r-o"), "w") as stream:
+            stream.write("Name: Firma Čížek\n")
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        self.tmp.cleanup()
+
+    def database(self, year):
+        db = invoice.db.Database(year=year, data_path=os.path.join(self.root, "{year}", "data", "{directory}"))
+        for list_ in db.companies, db.invoices:
+            os.makedirs(list_._path, exist_ok=True)
+        return db
+
+    def run_import(self):
+        client = invoice.fakturoid.Client("http://127.0.0.1:{0}".format(self.server.server_port), "test",
+            "me@example.com", "secret", jobs=3, backoff=0)
+        importer = invoice.fakturoid.Importer(client, self.database, 2017,
+            os.path.join(self.root, "cache", "fakturoid.json"))
+        return importer.run()
+
+    def names(self, year, directory):
+        path = os.path.join(self.root, str(year), "data", directory)
+        return sorted(name for name in os.listdir(path) if not name.startswith(".") and not name.endswith("~"))
+
+    def assertNumbered(self, ordered=True):
+        for year in 2016, 2017:
+            items = sorted(self.database(year).invoices, key=lambda item: item.number)
+            self.assertEqual([item.number for item in items], list(range(1, len(items) + 1)))
+            if ordered:
+                self.assertEqual([item.date for item in items], sorted(item.date for item in items))
+
+    def assertImported(self):
+        self.assertEqual(len(self.names(2017, "companies")), len(subjects) + 1)
+        self.assertNumbered()
+        self.assertEqual(len(self.names(2016, "income")) + len(self.names(2017, "income")), len(invoices))
+        self.assertFalse(os.path.exists(os.path.join(self.root, "cache", "fakturoid.json.pending")))
+
+    def test_import(self):
+        counts = self.run_import()
+        self.assertEqual((counts["subjects"], counts["invoices"]), (len(subjects), len(invoices)))
+        self.assertImported()
+        with open(os.path.join(self.root, "2017", "data", "companies", "firma-cizek-0-s-r-o")) as stream:
+            self.assertEqual(stream.read(), "Name: Firma Čížek\n")
+        self.assertIn("firma-cizek-0-s-r-o-100", self.names(2017, "companies"))
+        pages = collections.Counter((endpoint, page) for endpoint, page, since in self.server.requests)
+        self.assertEqual(pages["invoices", 1], 1)
+        self.assertEqual(pages["invoices", 2], 2)
+        self.assertEqual(pages["invoices", 3], 2)
+        self.assertEqual(pages["invoices", 5], 1)
+
+    def test_resume(self):
+        self.server.broken = ("invoices", 4)
+        with self.assertRaises(invoice.fakturoid.FakturoidError):
+            self.run_import()
+        self.assertFalse(os.path.exists(os.path.join(self.root, "2016")))
+        self.assertTrue(os.path.exists(os.path.join(self.root, "cache", "fakturoid.json.pending")))
+        self.server.broken = None
+        del self.server.requests[:]
+        self.run_import()
+        self.assertEqual(min(page for endpoint, page, since in self.server.requests if endpoint == "invoices"), 4)
+        self.assertImported()
+
+    def test_update(self):
+        self.run_import()
+        names = self.names(2016, "income") + self.names(2017, "income")
+        del self.server.requests[:]
+        moved = dict(invoices[0], issued_on="2016-12-31", updated_at="2017-03-01T10:00:00+01:00")
+        added = dict(invoices[1], id=6000, updated_at="2017-03-02T10:00:00+01:00")
+        self.server.data = {"subjects": subjects, "invoices": [moved] + invoices[1:] + [added]}
+        counts = self.run_import()
+        self.assertEqual((counts["subjects"], counts["invoices"]), (0, 2))
+        self.assertTrue(all(since for endpoint, page, since in self.server.requests))
+        self.assertEqual(len(self.names(2016, "income") + self.names(2017, "income")), len(names) + 1)
+        self.assertIn("20161231-011-firma-cizek-0-s-r-o-100", self.names(2016, "income"))
+        self.assertIn("20171102-012-firma-cizek-1-s-r-o", self.names(2017, "income"))
+        self.assertNumbered(ordered=False)
+
+if __name__ == "__main__":
+    unittest.main()
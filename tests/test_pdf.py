@@ -0,0 +1,252 @@
+#!/usr/bin/python3
+
+import os, re, zlib, struct, shutil, tempfile, subprocess, collections, unittest
+
+import invoice.db
+import invoice.pdf
+import invoice.cli
+
+template_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "templates")
+
+companies = {
+    "my-company": "Name: Dodavatel s.r.o.\nAddress: Hlavní 1\nAddress: 110 00 Praha\nNumber: 12345678\n"
+        "Bank-Account: 123456789/0100\n",
+    "acme": "Name: Žluťoučký kůň a.s.\nAddress: Čtvrtá 4\nAddress: 602 00 Brno\nNumber: 87654321\n"
+        "Comment: DIČ: CZ87654321\n",
+}
+invoice_name = "20170105-001-acme"
+invoice_text = "Item: 12000: Vývoj aplikace\nItem: 500: Hosting (leden)\nDue: 2017-01-19\nNote: Děkujeme.\n"
+
+def make_tree(root):
+    """Create user data with two companies and an invoice of 2017."""
+    for directory in "tmp", "2017/output", "2017/data/companies", "2017/data/income":
+        os.makedirs(os.path.join(root, directory))
+    with open(os.path.join(root, "config"), "w") as stream:
+        stream.write('pdf_program = "true"\n')
+    for name, text in companies.items():
+        with open(os.path.join(root, "2017/data/companies", name), "w") as stream:
+            stream.write(text)
+    with open(os.path.join(root, "2017/data/income", invoice_name), "w") as stream:
+        stream.write(invoice_text)
+
+def page_texts(data):
+    """Return lists of strings shown on each page of a PDF."""
+    reader = invoice.pdf.Reader(data)
+    pages = []
+    for ref, page in reader.pages():
+        content = reader._decode(reader.resolve(page["Contents"]))
+        pages.append([re.sub(rb"\\(.)", rb"\1", match.group(1)).decode(invoice.pdf.encoding)
+            for match in re.finditer(rb"\(((?:\\.|[^\\)])*)\) Tj", content)])
+    return pages
+
+def native_text(data):
+    """Return strings shown on the pages of a PDF made by the native renderer."""
+    return "\n".join(text for texts in page_texts(data) for text in texts)
+
+def document(*texts):
+    """Return a PDF made by the writer with a page for each text."""
+    document = invoice.pdf.Document()
+    for text in texts:
+        document.add_page().text(72, 720, text)
+    return document.write()
+
+def packed_document(text):
+    """Return a one page PDF 1.5 with objects in an object stream and a predicted xref stream.
+
+    This is the layout pdflatex produces, the page inherits its media box.
+    """
+    content = zlib.compress(b"BT /F1 12 Tf 72 720 Td (" + text.encode(invoice.pdf.encoding) + b") Tj ET")
+    packed = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 /MediaBox [0 0 595 842] >>",
+        b"<< /Type /Page /Parent 2 0 R /Resources << /Font << /F1 6 0 R >> >> /Contents 4 0 R >>",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    header, body = [], b""
+    for number, data in zip((1, 2, 3, 6), packed):
+        header.append(b"%d %d" % (number, len(body)))
+        body += data + b"\n"
+    header = b" ".join(header) + b"\n"
+    output = b"%PDF-1.5\n"
+    offsets = {4: len(output)}
+    output += b"4 0 obj\n<< /Filter /FlateDecode /Length %d >>\nstream\n" % len(content) + content \
+        + b"\nendstream\nendobj\n"
+    objects = zlib.compress(header + body)
+    offsets[5] = len(output)
+    output += b"5 0 obj\n<< /Type /ObjStm /N 4 /First %d /Filter /FlateDecode /Length %d >>\nstream\n" \
+        % (len(header), len(objects)) + objects + b"\nendstream\nendobj\n"
+    offsets[7] = len(output)
+    entries = [(0, 0, 65535), (2, 5, 0), (2, 5, 1), (2, 5, 2), (1, offsets[4], 0), (1, offsets[5], 0),
+        (2, 5, 3), (1, offsets[7], 0)]
+    rows, previous = b"", bytes(7)
+    for kind, field, generation in entries:
+        row = bytes([kind]) + field.to_bytes(4, "big") + generation.to_bytes(2, "big")
+        rows += b"\x02" + bytes((a - b) & 0xff for a, b in zip(row, previous))
+        previous = row
+    xref = zlib.compress(rows)
+    output += b"7 0 obj\n<< /Type /XRef /Size 8 /W [1 4 2] /Root 1 0 R /Filter /FlateDecode " \
+        b"/DecodeParms << /Columns 7 /Predictor 12 >> /Length %d >>\nstream\n" % len(xref) + xref \
+        + b"\nendstream\nendobj\nstartxref\n%d\n%%%%EOF\n" % offsets[7]
+    return output
+
+class NativeRendererTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        make_tree(self.root)
+        db = invoice.db.Database(year=2017, data_path=os.path.join(self.root, "{year}", "data", "{directory}"))
+        self.pdf = invoice.pdf.render_invoice(db.invoices[invoice_name].data(),
+            db.companies["my-company"].data(), db.companies["acme"].data())
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_text(self):
+        text = native_text(self.pdf)
+        for expected in ("Faktura:", "2017001", "Žluťoučký kůň a.s.", "Dodavatel s.r.o.", "IČ: 87654321",
+                "Vývoj aplikace", "12 000 Kč", "12 500 Kč", "05.01.2017", "19.01.2017", "Děkujeme.",
+                "123456789/0100", "DIČ: CZ87654321"):
+            self.assertIn(expected, text)
+
+    @unittest.skipUnless(shutil.which("pdflatex") and shutil.which("pdftotext"), "requires pdflatex and pdftotext")
+    def test_same_text_as_tex(self):
+        application = invoice.cli.Application(template_path,
+            ["-d", self.root, "-y", "2017", "pdf", "--generate", invoice_name])
+        self.assertEqual(application.run(), 0)
+        native_path = os.path.join(self.root, "native.pdf")
+        with open(native_path, "wb") as stream:
+            stream.write(self.pdf)
+        words = [collections.Counter(subprocess.check_output(["pdftotext", path, "-"]).decode("utf-8").split())
+            for path in (os.path.join(self.root, "2017/output", invoice_name + ".pdf"), native_path)]
+        self.assertEqual(words[0], words[1])
+
+class ReaderTest(unittest.TestCase):
+    def test_document(self):
+        data = document("Jedna", "Dvě (2)", "Tři \\ 3")
+        self.assertEqual(page_texts(data), [["Jedna"], ["Dvě (2)"], ["Tři \\ 3"]])
+
+    def test_packed(self):
+        reader = invoice.pdf.Reader(packed_document("Čtyři"))
+        [(ref, page)] = reader.pages()
+        self.assertEqual(ref, invoice.pdf.Ref(3))
+        self.assertEqual(page["MediaBox"], [0, 0, 595, 842])
+        self.assertEqual(reader.resolve(page["Resources"]["Font"]["F1"])["BaseFont"], "Helvetica")
+        self.assertEqual(page_texts(packed_document("Čtyři")), [["Čtyři"]])
+
+    def test_not_pdf(self):
+        with self.assertRaises(ValueError):
+            invoice.pdf.Reader(b"%PDF-1.4\n")
+
+class SplitMergeTest(unittest.TestCase):
+    documents = [["A1", "A2"], ["B1"], ["C1", "C2", "C3"]]
+
+    def setUp(self):
+        self.data = [document(*self.documents[0]), packed_document(*self.documents[1]),
+            document(*self.documents[2])]
+
+    def test_merge(self):
+        merged = invoice.pdf.merge(self.data)
+        self.assertEqual(page_texts(merged), [[text] for texts in self.documents for text in texts])
+
+    def test_round_trip(self):
+        parts = invoice.pdf.split(invoice.pdf.merge(self.data), [len(texts) for texts in self.documents])
+        self.assertEqual([page_texts(part) for part in parts],
+            [[[text] for text in texts] for texts in self.documents])
+        self.assertEqual(page_texts(invoice.pdf.merge(parts)), page_texts(invoice.pdf.merge(self.data)))
+
+    def test_inherited_attributes(self):
+        [part] = invoice.pdf.split(self.data[1], [1])
+        [(ref, page)] = invoice.pdf.Reader(part).pages()
+        self.assertEqual(page["MediaBox"], [0, 0, 595, 842])
+        self.assertIn("F1", page["Resources"]["Font"])
+
+    def test_page_count_mismatch(self):
+        with self.assertRaises(ValueError):
+            invoice.pdf.split(self.data[2], [1, 1])
+
+def png(path, width, rows, depth, color, chunks=(), interlace=0):
+    """Write a PNG image of raw rows using all filter types in turn."""
+    pixel_size = max(1, depth * {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}[color] // 8)
+    def paeth(left, up, corner):
+        estimate = left + up - corner
+        return min((abs(estimate - left), 0, left), (abs(estimate - up), 1, up),
+            (abs(estimate - corner), 2, corner))[2]
+    filtered, previous = b"", bytes(len(rows[0]))
+    for n, row in enumerate(rows):
+        kind = n % 5
+        left = lambda i: row[i-pixel_size] if i >= pixel_size else 0
+        corner = lambda i: previous[i-pixel_size] if i >= pixel_size else 0
+        predict = [lambda i: 0, left, lambda i: previous[i], lambda i: (left(i) + previous[i]) // 2,
+            lambda i: paeth(left(i), previous[i], corner(i))][kind]
+        filtered += bytes([kind]) + bytes((row[i] - predict(i)) & 0xff for i in range(len(row)))
+        previous = row
+    def chunk(kind, body):
+        return struct.pack(">I", len(body)) + kind + body + struct.pack(">I", zlib.crc32(kind + body))
+    with open(path, "wb") as stream:
+        stream.write(b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, len(rows),
+            depth, color, 0, 0, interlace)) + b"".join(chunk(kind, body) for kind, body in chunks)
+            + chunk(b"IDAT", zlib.compress(filtered)) + chunk(b"IEND", b""))
+
+class PNGImageTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "signature.png")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_rgb(self):
+        rows = [bytes((x * 40 + y * 7) & 0xff for x in range(9)) for y in range(7)]
+        png(self.path, 3, rows, 8, 2)
+        image = invoice.pdf.PNGImage(self.path)
+        self.assertIn(b"/ColorSpace /DeviceRGB", image.dictionary)
+        self.assertIsNone(image.mask)
+
+    def test_rgba(self):
+        rows = [bytes((x * 40 + y * 7) & 0xff for x in range(12)) for y in range(7)]
+        png(self.path, 3, rows, 8, 6)
+        image = invoice.pdf.PNGImage(self.path)
+        samples = b"".join(rows)
+        self.assertEqual(zlib.decompress(image.data),
+            bytes(value for n, value in enumerate(samples) if n % 4 != 3))
+        self.assertEqual(zlib.decompress(image.mask.data), samples[3::4])
+        self.assertIn(b"/ColorSpace /DeviceRGB /BitsPerComponent 8", image.dictionary)
+
+    def test_gray_alpha_16(self):
+        rows = [bytes((x * 13 + y * 5) & 0xff for x in range(8)) for y in range(6)]
+        png(self.path, 2, rows, 16, 4)
+        image = invoice.pdf.PNGImage(self.path)
+        samples = b"".join(rows)
+        self.assertEqual(zlib.decompress(image.data), samples[0::4])
+        self.assertEqual(zlib.decompress(image.mask.data), samples[2::4])
+
+    def test_palette(self):
+        palette = bytes(range(12))
+        rows = [bytes([0b00011011, 0b01000000]) for y in range(6)]
+        png(self.path, 5, rows, 2, 3, [(b"PLTE", palette), (b"tRNS", b"\x00\x80")])
+        image = invoice.pdf.PNGImage(self.path)
+        self.assertIn(b"/ColorSpace [/Indexed /DeviceRGB 3 <000102030405060708090a0b>]", image.dictionary)
+        self.assertEqual(zlib.decompress(image.data), bytes([0, 1, 2, 3, 1]) * 6)
+        self.assertEqual(zlib.decompress(image.mask.data), bytes([0, 0x80, 0xff, 0xff, 0x80]) * 6)
+        png(self.path, 5, rows, 2, 3, [(b"PLTE", palette)])
+        image = invoice.pdf.PNGImage(self.path)
+        self.assertIsNone(image.mask)
+        self.assertIn(b"/BitsPerComponent 2", image.dictionary)
+
+    def test_interlaced(self):
+        png(self.path, 1, [b"\0"], 8, 0, interlace=1)
+        with self.assertRaises(invoice.pdf.ImageError):
+            invoice.pdf.PNGImage(self.path)
+
+    def test_document(self):
+        rows = [bytes((x * 40 + y * 7) & 0xff for x in range(12)) for y in range(7)]
+        png(self.path, 3, rows, 8, 6)
+        document = invoice.pdf.Document()
+        document.add_page().image(invoice.pdf.PNGImage(self.path), 0, 0, 3, 7)
+        reader = invoice.pdf.Reader(document.write())
+        [(ref, page)] = reader.pages()
+        image = reader.resolve(page["Resources"]["XObject"]["I1"])
+        self.assertEqual(reader._decode(reader.resolve(image["SMask"])), b"".join(rows)[3::4])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+#!/usr/bin/python3
+
+import os, re, datetime, tempfile, unittest, concurrent.futures
+
+import invoice.db
+import invoice.db.storage
+import invoice.db.query
+
+class SQLiteStorageTest(unittest.TestCase):
+    class List(object):
+        _directory = "income"
+        _year = 2017
+        _regex = re.compile("^[a-z0-9-]+$")
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        connection = invoice.db.storage.connect(os.path.join(self.tmp.name, "invoice.sqlite"))
+        self.storage = invoice.db.storage.SQLiteStorage(connection, self.List())
+        self.storage.ensure()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_keys_are_not_reused(self):
+        self.storage.create("a", "Item: 1: x\n")
+        keys = [self.storage.key("a")]
+        self.storage.write("a", "Item: 2: x\n")
+        keys.append(self.storage.key("a"))
+        self.storage.remove("a")
+        self.storage.create("a", "Item: 1: x\n")
+        keys.append(self.storage.key("a"))
+        self.assertEqual(keys, sorted(set(keys)))
+
+    def test_threads(self):
+        def work(n):
+            for i in range(20):
+                name = "item-{0}-{1}".format(n, i)
+                self.storage.write(name, name)
+                self.assertEqual(self.storage.read(name), name)
+                self.storage.scan(self.List._regex)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(work, range(8)))
+        self.assertEqual(len(self.storage.scan(self.List._regex)), 160)
+
+    def test_select(self):
+        for name in "a", "b", "c":
+            self.storage.create(name, "Item: 1: x\n")
+        for name, paid, total in ("a", None, 100), ("b", "2017-02-01", 100):
+            self.storage.store(name, self.storage.key(name), {"date": datetime.date(2017, 1, 1),
+                "company_name": "acme", "due": datetime.date(2017, 1, 15), "paid": paid, "sum": total})
+        Query = invoice.db.query.Query
+        self.assertIsNone(self.storage.select(Query()))
+        # Items not parsed yet are always selected.
+        self.assertEqual(self.storage.select(Query(unpaid=True)), {"a", "c"})
+        self.assertEqual(self.storage.select(Query(min_sum=200)), {"c"})
+        self.assertEqual(self.storage.select(Query(date_from="2017-01-01", company="acme")), {"a", "b", "c"})
+        self.assertEqual(self.storage.select(Query(date_to="2016-12-31")), {"c"})
+
+    def test_drop(self):
+        for name in "a", "b":
+            self.storage.create(name, "Item: 1: x\n")
+        self.storage.drop(["a"])
+        self.assertEqual(list(self.storage.scan(self.List._regex)), ["b"])
+
+    def test_abstract(self):
+        self.assertRaises(TypeError, invoice.db.storage.Storage)
+
+class FileStorageTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.storage = invoice.db.storage.FileStorage(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_drop_keeps_other_files(self):
+        for name in "a", "a~", "b", ".sequence", "README":
+            with open(os.path.join(self.tmp.name, name), "w") as stream:
+                stream.write(name)
+        self.storage.drop(["a", "b"])
+        self.assertEqual(sorted(os.listdir(self.tmp.name)), [".sequence", "README", "a~"])
+
+if __name__ == "__main__":
+    unittest.main()
+
+class ListKeysTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "income")
+        os.makedirs(self.path)
+        for number in 1, 2, 3:
+            with open(os.path.join(self.path, "2017010{0}-00{0}-acme".format(number)), "w") as stream:
+                stream.write("Item: {0}00: x\n".format(number))
+        self.db = invoice.db.Database(year=2017, data_path=os.path.join(self.tmp.name, "{directory}"),
+            cache_path=os.path.join(self.tmp.name, "cache", "{directory}"))
+        self.stats = []
+        key = self.db.invoices._storage.key
+        self.db.invoices._storage.key = lambda name: self.stats.append(name) or key(name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_scan_keys(self):
+        items = list(self.db.invoices)
+        self.assertEqual([data.sum for data in self.db.invoices.data_many(items)], [100, 200, 300])
+        self.assertEqual(items[0].data().sum, 100)
+        self.assertEqual(self.stats, [])
+        with open(items[0]._path, "w") as stream:
+            stream.write("Item: 400: x\n")
+        self.db.expire()
+        self.assertEqual(items[0].data().sum, 400)
+        self.assertEqual(self.stats, [items[0]._name])